@@ -1,20 +1,121 @@
-from collections import defaultdict
+import functools
+import hashlib
+import json
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 
-from flask import Flask, Response
-from flask import render_template
+import click
+from flask import Blueprint, Flask, abort, current_app, jsonify, redirect
+from flask import render_template, request, send_file, send_from_directory, url_for
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import Session
 
-from models.message import ExtMessage, Channel, Media
-
-app = Flask(__name__)
+from models import database, derivatives, queries, readstate
+from models.cache import VersionedCache
+from models.livefeed import LiveFeed
+from models.mediafiles import MediaFiles, get_media_root
+from models.message import ExtMessage
 
 db = SQLAlchemy()
-db_name = "export.db"
-app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_name}"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
-db.init_app(app)
-with app.app_context():
-    db.create_all()
+web = Blueprint("web", __name__, cli_group=None)
+
+# Media files never change once downloaded
+MEDIA_MAX_AGE = 7 * 24 * 3600
+# Neither do their derivatives, which are only ever generated once
+DERIVATIVE_MAX_AGE = 365 * 24 * 3600
+
+# A comment is sent this often on idle live feeds, so closed ones are noticed
+LIVE_KEEPALIVE = 15
+
+# The fields of the channels in the JSON API
+CHANNEL_FIELDS = ("id", "title", "message_count", "last_date", "unread")
+
+
+class Archive:
+    """The export database an app serves, and what is kept next to it"""
+
+    def __init__(self, app, db_path):
+        # What has been read is kept next to the export database, in its own
+        # file, and written through an engine of its own
+        state_path = (
+            os.environ.get("TG_TO_ORG_STATE_DB")
+            or readstate.get_state_filename(db_path)
+        )
+        readstate.attach(db.engine, state_path)
+        self.state_engine = database.create_state_engine(db.engine.url, state_path)
+        # Downloaded media, by default where the Dumper saves it next to the
+        # database, and its downscaled images generated when first requested
+        self.media_files = MediaFiles(
+            os.environ.get("TG_TO_ORG_MEDIA") or get_media_root(db_path)
+        )
+        self.derivatives = derivatives.Derivatives(
+            self.media_files,
+            os.environ.get("TG_TO_ORG_DERIVATIVES")
+            or derivatives.get_derivatives_root(db_path),
+        )
+        # Rendered pages and API results, built again once the data they come
+        # from changes (see queries.data_version)
+        self.page_cache = VersionedCache()
+        self.live_feed = LiveFeed(db.engine, functools.partial(render_live_post, app))
+
+
+def create_app(db_name=None, read_only=True):
+    """
+    Create the app serving the export database `db_name` (by default
+    TG_TO_ORG_DB, e.g. the Dumper's <OutputDirectory>/export.db). The
+    database is only opened when first queried, read only unless asked
+    otherwise, and its schema is never touched.
+    """
+    app = Flask(__name__)
+    db_name = db_name or os.environ.get("TG_TO_ORG_DB", "export.db")
+    app.config["SQLALCHEMY_DATABASE_URI"] = database.get_uri(db_name, read_only)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_size": database.POOL_SIZE}
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
+    db.init_app(app)
+    app.register_blueprint(web)
+    app.add_template_global(derivatives.WIDTHS, "image_widths")
+    with app.app_context():
+        db_path = database.get_filename(db.engine.url)
+        app.extensions["archive"] = Archive(app, db_path)
+        if read_only:
+            # After the read state is attached, which may create its tables
+            database.set_query_only(db.engine)
+    return app
+
+
+def get_archive():
+    """The ``Archive`` of the current app"""
+    return current_app.extensions["archive"]
+
+
+def render_live_post(app, post):
+    """The event of a new post for the live feed, with its rendered HTML"""
+    with app.test_request_context():
+        html = render_template("channel_post.html", post=post)
+    return {
+        "channel": post["channel"],
+        "id": post["id"],
+        "date": post["date"],
+        "html": html,
+    }
+
+
+def is_local_url(url):
+    """
+    Whether a URL is a path on this site, and not on another one once a
+    browser is done with it (like ``//host`` or ``/\\host``)
+    :param url: the URL
+    :return: True if it is safe to redirect to
+    """
+    if not url.startswith("/") or "\\" in url:
+        return False
+    if any(c < " " or c == "\x7f" for c in url):
+        return False
+    parts = urlsplit(url)
+    return not parts.scheme and not parts.netloc
 
 
 def parse(string1, string2):
@@ -31,24 +132,25 @@ def parse(string1, string2):
     return dict(zip(a, b))
 
 
-@app.route("/")
+@web.route("/")
 def index():
     """
     Render main page
     :return:
     """
     try:
-        posts = defaultdict(list)
-        authors = defaultdict(dict)
-        channels = db.session.query(Channel)
-        # TODO: maybe implement unread counter for channel?
-        for channel in channels:
-            items = db.session.query(ExtMessage).filter(ExtMessage.Message != "").filter(
-                ExtMessage.ContextID == channel.ID).limit(5)
-            authors[channel.ID] = {'title': channel.Title, 'description': channel.About}
-            for item in items:
-                posts[item.ContextID].append([item])
-        return render_template("index.html", items=posts, authors=authors)
+        order = request.args.get("order", "unread")
+        if order not in queries.HOME_PAGE_ORDERS:
+            order = "unread"
+        return get_archive().page_cache.get_or_set(
+            ("index", request.full_path),
+            queries.data_version(db.session),
+            lambda: render_template(
+                "index.html",
+                channels=queries.home_page(db.session, order=order),
+                order=order,
+            ),
+        )
     except Exception as exception:
         # e holds description of the error
         error_text = "<p>The error:<br>" + str(exception) + "</p>"
@@ -56,94 +158,400 @@ def index():
         return hed + error_text
 
 
-@app.route("/channels")
+@web.route("/channels")
 def render_channels():
     """
     Render channels page
     :return:
     """
-    items = db.session.query(ExtMessage).filter(ExtMessage.Message != "").order_by(ExtMessage.ContextID).all()
-    posts = defaultdict(list)
-    authors = defaultdict(list)
-    unread = {}
-    for item in items:
-        posts[item.ContextID].append([item])
-        authors[item.ContextID] = db.session.query(Channel).filter(Channel.ID == item.ContextID).all()[0].Title
-    return render_template("authors.html", items=posts, authors=authors, unread=unread)
+    return get_archive().page_cache.get_or_set(
+        ("channels",),
+        queries.data_version(db.session),
+        lambda: render_template(
+            "authors.html", channels=queries.channel_list(db.session)
+        ),
+    )
 
 
-@app.route("/channel/<channel>")
+@web.route("/channel/<int(signed=True):channel>")
 def render_channel(channel):
     """
-    Render channel
+    Render channel, with its latest posts and the cursor to load older ones
+    from /api/channel/<channel>/posts as the page is scrolled
     :param channel: channel id
     :return:
     """
     try:
-        items = (
-            db.session.query(ExtMessage)
-            .filter(ExtMessage.ContextID == channel)
-            .filter(ExtMessage.Message != "")
-            .order_by(ExtMessage.ContextID)
-            .limit(10)
-            .all()
+        row = queries.get_channel(db.session, channel)
+        if row is None:
+            return "<h1>No such channel.</h1>", 404
+        return get_archive().page_cache.get_or_set(
+            ("channel", channel),
+            queries.data_version(db.session, channel),
+            lambda: render_template(
+                "channel.html",
+                channel=row,
+                feed=queries.channel_feed(db.session, row.ID),
+            ),
         )
-        posts = defaultdict(list)
-        authors = defaultdict(dict)
-        attachments = defaultdict(list)
-        channel = db.session.query(Channel).filter(Channel.ID == channel).one()
-        for item in items:
-            if item.MediaID:
-                attachment = db.session.query(Media).filter(Media.ID == item.MediaID).one()
-                attachment = f"{attachment.Type}-{attachment.Name}.{attachment.ID}.jpg"
-                attachments[item.ContextID].append([attachment])
-            posts[item.ContextID].append([item])
-            authors[item.ContextID] = {'title': channel.Title, 'description': channel.About}
-        print(posts)
-        return render_template("index.html", items=posts, authors=authors, attachment=attachments)
     except Exception as exception:
         error_text = "<p>The error:<br>" + str(exception) + "</p>"
         hed = "<h1>Something is broken.</h1>"
         return hed + error_text
 
 
-@app.route("/mp3/<mp3_filename>")
+@web.route("/api/channel/<int(signed=True):channel>/posts")
+def get_channel_posts(channel):
+    """
+    Page through the posts of a channel, newest first.
+    Query parameters: ``before``, the "next" cursor of the previous page,
+    and ``limit``, the number of posts per page.
+    :param channel: channel id
+    :return: JSON with the "posts" and the "next" cursor
+    """
+    try:
+        before = queries.parse_cursor(request.args.get("before"))
+    except ValueError:
+        return jsonify(error="Invalid cursor"), 400
+    limit = request.args.get("limit", queries.FEED_PAGE_SIZE, type=int)
+    return jsonify(
+        get_archive().page_cache.get_or_set(
+            ("posts", channel, before, limit),
+            queries.data_version(db.session, channel),
+            lambda: queries.channel_feed(db.session, channel, before, limit),
+        )
+    )
+
+
+class BadRequest(Exception):
+    """A JSON API request with invalid parameters"""
+
+
+def get_fields(available):
+    """
+    Return the fields requested with ``?fields=a,b`` (all of `available`
+    by default). Raises BadRequest for fields that do not exist.
+    """
+    fields = request.args.get("fields")
+    if not fields:
+        return None
+    fields = fields.split(",")
+    unknown = set(fields).difference(available)
+    if unknown:
+        raise BadRequest("Unknown fields: {}".format(", ".join(sorted(unknown))))
+    return fields
+
+
+def select_fields(items, fields):
+    """Keep only the `fields` (all of them if None) of every dict in `items`"""
+    if fields is None:
+        return items
+    return [{field: item[field] for field in fields} for item in items]
+
+
+def get_cursor(name, parts=2):
+    """The cursor of the query parameter `name`. Raises BadRequest"""
+    try:
+        return queries.parse_cursor(request.args.get(name), parts)
+    except ValueError:
+        raise BadRequest("Invalid cursor")
+
+
+def api_response(version, build):
+    """
+    Return the result of ``build()`` as compact JSON, with an ETag so
+    clients can revalidate with If-None-Match. Both are cached under the
+    request URL until `version` (see ``queries.data_version``) changes.
+    """
+
+    def serialize():
+        body = json.dumps(build(), ensure_ascii=False, separators=(",", ":"))
+        return body, hashlib.sha1(body.encode()).hexdigest()
+
+    try:
+        body, etag = get_archive().page_cache.get_or_set(
+            ("api", request.full_path), version, serialize
+        )
+    except BadRequest as exception:
+        return jsonify(error=str(exception)), 400
+    if body == "null":
+        return jsonify(error="Not found"), 404
+    response = current_app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    # Always revalidated, the 304 is cheap and the data may have changed
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@web.route("/api/v1/channels")
+def api_channels():
+    """
+    List every channel, the most recently active first.
+    Query parameters: ``fields``, a comma-separated subset of
+    CHANNEL_FIELDS to return.
+    :return: JSON with the "channels"
+    """
+
+    def build():
+        fields = get_fields(CHANNEL_FIELDS)
+        channels = [
+            dict(zip(CHANNEL_FIELDS, row)) for row in queries.channel_list(db.session)
+        ]
+        return {"channels": select_fields(channels, fields)}
+
+    return api_response(queries.data_version(db.session), build)
+
+
+@web.route("/api/v1/channels/<int(signed=True):channel>")
+def api_channel(channel):
+    """
+    Get the latest snapshot of a channel
+    :param channel: channel id
+    :return: JSON with its "id", "title", "about", "username" and "picture"
+    """
+
+    def build():
+        row = queries.get_channel(db.session, channel)
+        if row is None:
+            return None
+        return {
+            "id": row.ID,
+            "title": row.Title,
+            "about": row.About,
+            "username": row.Username,
+            "picture": row.PictureID,
+        }
+
+    return api_response(queries.data_version(db.session, channel), build)
+
+
+@web.route("/api/v1/channels/<int(signed=True):channel>/posts")
+def api_channel_posts(channel):
+    """
+    Page through the posts of a channel, newest first, or sync the ones
+    newer than a cursor, oldest first.
+    Query parameters: ``before`` or ``after``, the "next" cursor of the
+    previous page, ``limit``, the number of posts per page, and ``fields``,
+    a comma-separated subset of queries.POST_FIELDS to return.
+    :param channel: channel id
+    :return: JSON with the "posts" and the "next" cursor
+    """
+
+    def build():
+        fields = get_fields(queries.POST_FIELDS)
+        page = queries.channel_feed(
+            db.session,
+            channel,
+            before=get_cursor("before"),
+            after=get_cursor("after"),
+            limit=request.args.get("limit", queries.FEED_PAGE_SIZE, type=int),
+        )
+        page["posts"] = select_fields(page["posts"], fields)
+        return page
+
+    return api_response(queries.data_version(db.session, channel), build)
+
+
+@web.route("/api/v1/channels/<int(signed=True):channel>/posts/<int:post_id>")
+def api_post(channel, post_id):
+    """
+    Get a single post
+    Query parameters: ``fields``, as for the posts of a channel
+    :param channel: channel id
+    :param post_id: id of the post in the channel
+    :return: JSON with the post
+    """
+
+    def build():
+        fields = get_fields(queries.POST_FIELDS)
+        post = queries.get_post(db.session, channel, post_id)
+        return post and select_fields([post], fields)[0]
+
+    return api_response(queries.data_version(db.session, channel), build)
+
+
+@web.route("/api/v1/media/<int:media_id>")
+def api_media(media_id):
+    """
+    Get what a media is, and where to download it from
+    :param media_id: id of the Media row
+    :return: JSON with its "id", "type", "name", "mime_type", "size" and "url"
+    """
+
+    def build():
+        media = queries.get_media(db.session, media_id)
+        if media is None:
+            return None
+        return {
+            "id": media.ID,
+            "type": media.Type,
+            "name": media.Name,
+            "mime_type": media.MimeType,
+            "size": media.Size,
+            "url": url_for(".get_media", media_id=media.ID),
+        }
+
+    return api_response(queries.data_version(db.session), build)
+
+
+@web.route("/api/v1/search")
+def api_search():
+    """
+    Search the text of the posts, newest first.
+    Query parameters: ``q``, the text to search for (at least 3
+    characters, unless searching a single channel), ``channel``, a
+    channel id to search in, and ``before``, ``limit`` and ``fields``, as
+    for the posts of a channel.
+    :return: JSON with the "posts" and the "next" cursor
+    """
+    channel = request.args.get("channel", type=int)
+
+    def build():
+        query = request.args.get("q", "")
+        if not query:
+            raise BadRequest("Missing query")
+        fields = get_fields(queries.POST_FIELDS)
+        try:
+            page = queries.search(
+                db.session,
+                query,
+                channel,
+                before=get_cursor("before", parts=3),
+                limit=request.args.get("limit", queries.FEED_PAGE_SIZE, type=int),
+            )
+        except ValueError as exception:
+            raise BadRequest(str(exception))
+        page["posts"] = select_fields(page["posts"], fields)
+        return page
+
+    return api_response(queries.data_version(db.session, channel), build)
+
+
+@web.route("/api/live")
+def live_posts():
+    """
+    Stream the posts archived from now on as server-sent "post" events,
+    JSON with their "channel", "id", "date" and rendered "html".
+    Query parameters: ``channel``, once per channel to follow (every
+    channel if missing).
+    :return:
+    """
+    channels = request.args.getlist("channel", type=int)
+    live_feed = get_archive().live_feed
+
+    def stream():
+        with live_feed.subscribe(channels) as subscription:
+            yield "retry: 5000\n\n"
+            while not subscription.closed:
+                event = subscription.get(timeout=LIVE_KEEPALIVE)
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "event: post\ndata: {}\n\n".format(
+                        json.dumps(event, separators=(",", ":"))
+                    )
+
+    return current_app.response_class(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@web.route("/media/<int:media_id>")
+def get_media(media_id):
+    """
+    Serve a downloaded media file (or its thumbnail, with ``?thumbnail=1``,
+    falling back to the file itself), with Range requests, ETag and
+    Last-Modified, and the MIME type it was dumped with
+    :param media_id: id of the Media row
+    :return:
+    """
+    media = queries.get_media(db.session, media_id)
+    if media is None:
+        abort(404)
+    thumbnail = request.args.get("thumbnail", type=int, default=0) == 1
+    path = thumbnail and get_archive().media_files.get(media_id, thumbnail=True)
+    if path:
+        mimetype = "image/jpeg"
+    else:
+        path = get_archive().media_files.get(media_id)
+        mimetype = media.MimeType
+    if not path:
+        abort(404)
+    return send_file(
+        path,
+        mimetype=mimetype or mimetypes.guess_type(path)[0],
+        conditional=True,
+        etag=True,
+        max_age=MEDIA_MAX_AGE,
+    )
+
+
+@web.route("/media/<int:media_id>/<int:width>.<fmt>")
+def get_media_derivative(media_id, width, fmt):
+    """
+    Serve an image downscaled to one of the derivatives.WIDTHS, as WebP or
+    JPEG, or redirect to the media itself if it cannot be (e.g. without
+    Pillow installed)
+    :param media_id: id of the Media row
+    :param width: the width of the image
+    :param fmt: "webp" or "jpeg"
+    :return:
+    """
+    if width not in derivatives.WIDTHS or fmt not in derivatives.FORMATS:
+        abort(404)
+    path = get_archive().derivatives.get(media_id, width, fmt)
+    if not path:
+        return redirect(url_for(".get_media", media_id=media_id))
+    response = send_file(
+        path,
+        mimetype=derivatives.FORMATS[fmt][1],
+        conditional=True,
+        etag=True,
+        max_age=DERIVATIVE_MAX_AGE,
+    )
+    response.cache_control.immutable = True
+    return response
+
+
+@web.cli.command("derivatives")
+@click.option("--workers", default=os.cpu_count(), help="Images resized at once")
+def generate_derivatives(workers):
+    """Generate the downscaled images of every photo, e.g. after an export"""
+    if derivatives.Image is None:
+        raise click.ClickException("Pillow is needed to resize images")
+    media_ids = queries.image_media_ids(db.session)
+    with ThreadPoolExecutor(workers) as executor:
+        done = sum(executor.map(get_archive().derivatives.generate, media_ids))
+    click.echo("{} of {} images resized".format(done, len(media_ids)))
+
+
+@web.route("/mp3/<path:mp3_filename>")
 def stream_mp3(mp3_filename):
     """
     Stream audio attachment
     :param mp3_filename: filename of audio attachment
     :return:
     """
+    return send_from_directory(
+        "static/tg_data", mp3_filename, mimetype="audio/mpeg", conditional=True
+    )
 
-    def generate(mp3_filename):
-        with open(f"static/tg_data/{mp3_filename}", "rb") as fmp3:
-            data = fmp3.read(1024)
-            while data:
-                yield data
-                data = fmp3.read(1024)
-
-    return Response(generate(mp3_filename), mimetype="audio/mpeg")
 
-
-@app.route("/mp4/<mp4_filename>")
+@web.route("/mp4/<path:mp4_filename>")
 def stream_mp4(mp4_filename):
     """
     Stream video attachment.
     :param mp4_filename: video filename
     :return:
     """
+    return send_from_directory(
+        "static/tg_data", mp4_filename, mimetype="video/mp4", conditional=True
+    )
 
-    def generate(mp4_filename):
-        with open(f"static/tg_data/{mp4_filename}", "rb") as fmp4:
-            data = fmp4.read(1024)
-            while data:
-                yield data
-                data = fmp4.read(1024)
-
-    return Response(generate(mp4_filename), mimetype="audio/mpeg")
 
-
-@app.route("/api/post/<post_id>")
+@web.route("/api/post/<post_id>")
 def get_post(post_id):
     """
     Render post.
@@ -160,20 +568,59 @@ def get_post(post_id):
     return render_template("post.html", post=post, author=author)
 
 
-@app.route("/api/post/<post_id>/read")
-def toggle_read(post_id):
+@web.route("/api/channel/<int(signed=True):channel>/read", methods=["POST"])
+def mark_channel_read(channel):
+    """
+    Mark a channel read up to a message
+    Parameters: ``up_to``, the message ID (the latest message if missing),
+    and ``next``, where to redirect to instead of returning JSON
+    :param channel: channel id
+    :return: JSON with the "date" and "id" of the message
+    """
+    up_to = request.values.get("up_to", type=int)
+    with Session(get_archive().state_engine) as session:
+        position = readstate.mark_read(session, channel, up_to)
+        if not position:
+            return jsonify(error="No such message"), 404
+        session.commit()
+    next_page = request.values.get("next", "")
+    if is_local_url(next_page):
+        return redirect(next_page)
+    return jsonify(date=position[0], id=position[1])
+
+
+@web.route(
+    "/api/channel/<int(signed=True):channel>/posts/<int:post_id>/read",
+    methods=["POST", "DELETE"],
+)
+def mark_post_read(channel, post_id):
     """
-    Toggle "read" field on the post
-    :param post_id: id of the post to "read"
+    Mark a single post read (POST) or unread (DELETE)
+    :param channel: channel id
+    :param post_id: id of the post
+    :return: JSON with the "read" state of the post
+    """
+    read = request.method == "POST"
+    with Session(get_archive().state_engine) as session:
+        if not readstate.set_message_read(session, channel, post_id, read):
+            return jsonify(error="No such message"), 404
+        session.commit()
+    return jsonify(read=read)
+
+
+@web.app_template_filter("timestamp")
+def format_timestamp(timestamp):
+    """
+    Format a date as stored by the Dumper (seconds since the epoch, UTC)
+    :param timestamp: the date
     :return:
     """
-    item = db.session.query(ExtMessage).filter(ExtMessage.id == post_id).all()[0]
-    item.read = 1
-    db.session.commit()
-    return index()
+    if timestamp is None:
+        return ""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M")
 
 
-@app.template_filter("get_block")
+@web.app_template_filter("get_block")
 def template_filter(block, file):
     """
     IDK what this does, need to fix documentation
@@ -189,10 +636,10 @@ def template_filter(block, file):
     return content
 
 
-# @app.route("/<channel>/get_all")
+# @web.route("/<channel>/get_all")
 # def get_all(channel):
 #     get_messages(channel)
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
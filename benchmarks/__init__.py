@@ -0,0 +1,4 @@
+"""
+Offline benchmarks for the export and formatting code. Run them as modules
+from the repository root, e.g. ``python -m benchmarks.ingest --help``.
+"""
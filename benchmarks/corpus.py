@@ -0,0 +1,56 @@
+"""
+Measure how fast NlpFormatter writes a corpus out of a large database:
+
+    python -m benchmarks.corpus --channels 20 --messages 50000 --gzip
+
+A synthetic database is generated unless --db points to an existing one.
+"""
+import argparse
+import contextlib
+import tempfile
+
+from export.formatters import NlpFormatter
+from benchmarks.synthetic import make_database
+
+
+def run(db, directory, fmt="jsonl", compress=False):
+    """Write the corpus of the database at `db` and return the results"""
+    formatter = NlpFormatter(db)
+    try:
+        result = formatter.write_corpus(directory, fmt=fmt, compress=compress)
+    finally:
+        formatter.dbconn.close()
+    result["mb_per_second"] = result["bytes"] / 1e6 / max(result["seconds"], 1e-9)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", help="database to read instead of a synthetic one")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--format", default="jsonl", choices=("jsonl", "text"))
+    parser.add_argument("--gzip", action="store_true")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        tmp = stack.enter_context(tempfile.TemporaryDirectory())
+        db = args.db
+        if not db:
+            dumper = make_database(
+                tmp, channels=args.channels, messages=args.messages
+            )
+            dumper.conn.close()
+            db = dumper.db_path
+        result = run(db, tmp + "/corpus", fmt=args.format, compress=args.gzip)
+
+    print(
+        "{messages} messages, {mb:.1f} MB in {seconds:.2f}s: "
+        "{mb_per_second:.1f} MB/s into {shards} files".format(
+            mb=result["bytes"] / 1e6, shards=len(result["files"]), **result
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+An in-process stand-in for a TelegramClient, serving synthetic channels so
+that the export code can be driven (and measured) without a network.
+"""
+import asyncio
+import datetime
+import random
+from types import SimpleNamespace
+
+from telethon import utils
+from telethon.errors import FloodWaitError
+from telethon.tl import types, functions
+
+FIRST_CHANNEL_ID = 1000000000
+SELF_USER_ID = 777000
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua telegram export "
+    "channel archive media photo video document forward reply"
+).split()
+
+
+class FakeClient:
+    """
+    Serves `channels` broadcast channels with `messages` posts each.
+
+    A fraction `media_ratio` of the posts has a photo of `media_size`
+    bytes, `forward_ratio` are forwards and `reply_ratio` reply to an
+    earlier post. Every request waits `latency` seconds (plus up to
+    `jitter`), and with probability `flood_rate` raises a FloodWaitError
+    of `flood_seconds` instead. The output is deterministic for a `seed`.
+    """
+
+    def __init__(
+        self,
+        channels=1,
+        messages=1000,
+        media_ratio=0.1,
+        media_size=64 * 1024,
+        forward_ratio=0.1,
+        reply_ratio=0.1,
+        latency=0.0,
+        jitter=0.0,
+        flood_rate=0.0,
+        flood_seconds=1,
+        seed=0,
+    ):
+        self.messages = messages
+        self.media_ratio = media_ratio
+        self.media_size = media_size
+        self.forward_ratio = forward_ratio
+        self.reply_ratio = reply_ratio
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.seed = seed
+        self._random = random.Random(seed)
+        self.start_date = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+        self.channels = {}
+        for i in range(channels):
+            channel = types.Channel(
+                id=FIRST_CHANNEL_ID + i,
+                title="Channel {}".format(i),
+                photo=types.ChatPhotoEmpty(),
+                date=self.start_date,
+                broadcast=True,
+                access_hash=i,
+                username="channel{}".format(i),
+            )
+            self.channels[utils.get_peer_id(channel)] = channel
+
+        self.requests = 0
+        self.flood_waits = 0
+        self.bytes_served = 0
+
+    async def _wait(self, request):
+        """Simulate the network round-trip, and flood limits"""
+        self.requests += 1
+        delay = self.latency + self._random.random() * self.jitter
+        if delay:
+            await asyncio.sleep(delay)
+        if self.flood_rate and self._random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=request, capture=self.flood_seconds)
+
+    def _make_message(self, channel, msg_id):
+        """Build the post `msg_id` of the given channel (always the same)"""
+        rnd = random.Random(hash((self.seed, channel.id, msg_id)))
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 60)))
+        date = self.start_date + datetime.timedelta(minutes=10 * msg_id)
+
+        media = None
+        if rnd.random() < self.media_ratio:
+            photo_id = channel.id * self.messages + msg_id
+            media = types.MessageMediaPhoto(
+                photo=types.Photo(
+                    id=photo_id,
+                    access_hash=photo_id,
+                    file_reference=b"ref",
+                    date=date,
+                    sizes=[
+                        types.PhotoSize("s", 90, 90, self.media_size // 64),
+                        types.PhotoSize("y", 1280, 1280, self.media_size),
+                    ],
+                    dc_id=2,
+                )
+            )
+
+        fwd_from = None
+        if rnd.random() < self.forward_ratio:
+            fwd_from = types.MessageFwdHeader(
+                date=date,
+                from_id=types.PeerChannel(FIRST_CHANNEL_ID + rnd.randrange(100)),
+                channel_post=rnd.randrange(1, 1000),
+            )
+
+        reply_to = None
+        if msg_id > 1 and rnd.random() < self.reply_ratio:
+            reply_to = types.MessageReplyHeader(
+                reply_to_msg_id=rnd.randrange(1, msg_id)
+            )
+
+        return types.Message(
+            id=msg_id,
+            peer_id=types.PeerChannel(channel.id),
+            date=date,
+            message=text,
+            post=True,
+            fwd_from=fwd_from,
+            reply_to=reply_to,
+            media=media,
+            entities=[types.MessageEntityBold(0, min(len(text), 5))],
+            views=rnd.randrange(10000),
+        )
+
+    def _get_channel(self, entity):
+        if not isinstance(entity, int):
+            return self.channels[utils.get_peer_id(entity)]
+        return self.channels[entity]
+
+    async def __call__(self, request):
+        await self._wait(request)
+        if isinstance(request, functions.messages.GetHistoryRequest):
+            channel = self._get_channel(request.peer)
+            top = self.messages
+            if request.offset_id:
+                top = min(request.offset_id - 1, top)
+            bottom = max(top - request.limit, request.min_id)
+            messages = [
+                self._make_message(channel, msg_id)
+                for msg_id in range(top, bottom, -1)
+            ]
+            return types.messages.ChannelMessages(
+                pts=0,
+                count=self.messages,
+                messages=messages,
+                topics=[],
+                chats=[channel],
+                users=[],
+            )
+        if isinstance(request, functions.channels.GetFullChannelRequest):
+            channel = self._get_channel(request.channel)
+            full_chat = SimpleNamespace(
+                id=channel.id,
+                about="About {}".format(channel.title),
+                chat_photo=None,
+                pinned_msg_id=None,
+            )
+            return types.messages.ChatFull(
+                full_chat=full_chat, chats=[channel], users=[]
+            )
+        raise NotImplementedError(type(request).__name__)
+
+    async def get_input_entity(self, entity):
+        return utils.get_input_peer(self._get_channel(entity))
+
+    async def get_entity(self, entity):
+        return self._get_channel(entity)
+
+    async def get_me(self, input_peer=False):
+        if input_peer:
+            return types.InputPeerUser(SELF_USER_ID, 0)
+        return types.User(id=SELF_USER_ID, first_name="Me")
+
+    async def get_dialogs(self, limit=None):
+        return [
+            SimpleNamespace(entity=channel, name=channel.title, id=peer_id)
+            for peer_id, channel in list(self.channels.items())[:limit]
+        ]
+
+    async def download_file(
+        self,
+        input_location,
+        file=None,
+        *,
+        part_size_kb=None,
+        file_size=None,
+        progress_callback=None,
+        **kwargs
+    ):
+        await self._wait(input_location)
+        size = file_size or self.media_size
+        part_size = int((part_size_kb or 64) * 1024)
+        chunk = b"\0" * part_size
+        with open(file, "wb") as f:
+            written = 0
+            while written < size:
+                part = chunk[: min(part_size, size - written)]
+                f.write(part)
+                written += len(part)
+                self.bytes_served += len(part)
+                if progress_callback:
+                    progress_callback(written, file_size)
+
+    async def disconnect(self):
+        pass
@@ -0,0 +1,91 @@
+"""
+Measure the latency of the app's home page on a large archive:
+
+    python -m benchmarks.homepage --channels 1500 --messages 200 --target-ms 300
+
+A synthetic database is generated unless --db points to an existing one.
+The page cache is cleared before every request, so each one builds the
+page; pass --cached to measure cache hits instead. The exit status is 1 if
+the 95th percentile is over --target-ms.
+"""
+import argparse
+import contextlib
+import importlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import make_database
+
+
+def run(db, requests=20, path="/", cached=False):
+    """
+    Request `path` of the app serving `db` and return the latencies in ms,
+    of building the page every time unless `cached` is set.
+    """
+    app = importlib.import_module("app").create_app(os.path.abspath(db))
+    page_cache = app.extensions["archive"].page_cache
+    client = app.test_client()
+    client.get(path)  # warm up the connection and templates
+
+    latencies = []
+    for _ in range(requests):
+        if not cached:
+            page_cache.clear()
+        start = time.perf_counter()
+        response = client.get(path)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError("{} returned {}".format(path, response.status_code))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", help="database to serve instead of a synthetic one")
+    parser.add_argument("--channels", type=int, default=1500)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--snapshots", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--path", default="/")
+    parser.add_argument("--target-ms", type=float, default=300)
+    parser.add_argument(
+        "--cached", action="store_true", help="keep the page cache between requests"
+    )
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        db = args.db
+        if not db:
+            tmp = stack.enter_context(tempfile.TemporaryDirectory())
+            dumper = make_database(
+                tmp,
+                channels=args.channels,
+                messages=args.messages,
+                snapshots=args.snapshots,
+            )
+            dumper.conn.close()
+            db = dumper.db_path
+        latencies = run(db, args.requests, args.path, args.cached)
+
+    p50 = statistics.median(latencies)
+    p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else p50
+    print(
+        "{} {} requests to {}: p50 {:.1f} ms, p95 {:.1f} ms "
+        "(target {:.0f} ms)".format(
+            len(latencies),
+            "cached" if args.cached else "uncached",
+            args.path,
+            p50,
+            p95,
+            args.target_ms,
+        )
+    )
+    if p95 > args.target_ms:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
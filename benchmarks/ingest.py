@@ -0,0 +1,147 @@
+"""
+Measure the ingest path (Exporter, Downloader and Dumper) against a
+FakeClient, reporting messages/s, media bytes/s and peak memory:
+
+    python -m benchmarks.ingest --channels 4 --messages 5000 --latency 0.02
+
+The fixed delays between requests are disabled unless --real-delays is
+given, so that the numbers reflect the cost of the code itself.
+"""
+import argparse
+import asyncio
+import configparser
+import contextlib
+import resource
+import tempfile
+import time
+
+from export import downloader
+from export.dumper import Dumper
+from export.exporter import Exporter
+from benchmarks.fake_client import FakeClient
+
+DELAYS = tuple(
+    prefix + name
+    for prefix in ("", "TAKEOUT_")
+    for name in ("USER_FULL_DELAY", "CHAT_FULL_DELAY", "MEDIA_DELAY", "HISTORY_DELAY")
+) + ("MEDIA_ID_TIMEOUT",)
+
+
+def make_config(
+    output_directory, media_whitelist="photo, document", thumbnails_first=False
+):
+    """Return a config like ``load_config`` would, for the given directory"""
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {
+            "TelegramAPI": {"SessionName": "benchmark"},
+            "Dumper": {
+                "OutputDirectory": output_directory,
+                "DBFileName": "export",
+                "MediaWhitelist": media_whitelist,
+                "MaxSize": str(1024**3),
+                "InvalidationTime": "0",
+                "ChunkSize": "100",
+                "MaxChunks": "0",
+                "MediaFilenameFmt": "usermedia/{name}-{context_id}/{type}-{filename}",
+                "ThumbnailsFirst": str(thumbnails_first),
+            },
+        }
+    )
+    return config
+
+
+@contextlib.contextmanager
+def no_delays():
+    """Temporarily disable the Downloader's delays between requests"""
+    saved = {name: getattr(downloader, name) for name in DELAYS}
+    try:
+        for name in DELAYS:
+            setattr(downloader, name, 0)
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(downloader, name, value)
+
+
+async def _export(client, config):
+    dumper = Dumper(config["Dumper"])
+    exporter = Exporter(client, config, dumper, asyncio.get_running_loop())
+    try:
+        await exporter.start()
+    finally:
+        await exporter.close()
+    return dumper.metrics
+
+
+def run(client, output_directory, real_delays=False, thumbnails_first=False):
+    """
+    Export everything the client serves into the given directory and
+    return a dictionary with the results of the run.
+    """
+    config = make_config(output_directory, thumbnails_first=thumbnails_first)
+    start = time.perf_counter()
+    with contextlib.nullcontext() if real_delays else no_delays():
+        metrics = asyncio.run(_export(client, config))
+    elapsed = time.perf_counter() - start
+
+    messages = metrics.counters[("rows_total", (("table", "Message"),))]
+    return {
+        "elapsed": elapsed,
+        "messages": int(messages),
+        "messages_per_second": messages / elapsed,
+        "media_bytes": client.bytes_served,
+        "media_bytes_per_second": client.bytes_served / elapsed,
+        "requests": client.requests,
+        "flood_waits": client.flood_waits,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "metrics": metrics,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--media-ratio", type=float, default=0.1)
+    parser.add_argument("--media-size", type=int, default=64 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--real-delays", action="store_true")
+    parser.add_argument("--thumbnails-first", action="store_true")
+    parser.add_argument(
+        "--output", help="export into this directory instead of a temporary one"
+    )
+    args = parser.parse_args()
+
+    client = FakeClient(
+        channels=args.channels,
+        messages=args.messages,
+        media_ratio=args.media_ratio,
+        media_size=args.media_size,
+        latency=args.latency,
+        jitter=args.jitter,
+        flood_rate=args.flood_rate,
+        flood_seconds=args.flood_seconds,
+    )
+    with contextlib.ExitStack() as stack:
+        output = args.output or stack.enter_context(tempfile.TemporaryDirectory())
+        result = run(
+            client,
+            output,
+            real_delays=args.real_delays,
+            thumbnails_first=args.thumbnails_first,
+        )
+
+    print(result["metrics"].summary())
+    print(
+        "{messages} messages in {elapsed:.2f}s: {messages_per_second:.0f} msg/s, "
+        "{media_bytes_per_second:,.0f} media B/s, {requests} requests "
+        "({flood_waits} flood waits), peak RSS {peak_rss_kb:,} KB".format(**result)
+    )
+
+
+if __name__ == "__main__":
+    main()
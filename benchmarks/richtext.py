@@ -0,0 +1,103 @@
+"""
+Measure how fast export.richtext renders formatted messages:
+
+    python -m benchmarks.richtext --messages 2000000 --repeat-ratio 0.3
+
+With --baseline, the same messages are also rendered to HTML by decoding
+the Telethon entities and going through ``telethon.extensions.html``.
+"""
+import argparse
+import itertools
+import random
+import time
+
+from export import richtext, utils
+from benchmarks.fake_client import WORDS
+
+KINDS = ("bold", "italic", "code", "pre", "texturl", "url", "mentionname")
+EMOJI = "👍"
+
+
+def make_messages(count, repeat_ratio=0.2, seed=0):
+    """
+    Return `count` ``(text, formatting)`` pairs. A fraction `repeat_ratio`
+    of them repeat an earlier message, like forwarded posts do.
+    """
+    rnd = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        if messages and rnd.random() < repeat_ratio:
+            messages.append(rnd.choice(messages))
+            continue
+        words = rnd.choices(WORDS + [EMOJI], k=rnd.randint(5, 60))
+        text = " ".join(words)
+        # UTF-16 offset of every character, so entities never split one
+        units = list(
+            itertools.accumulate((1 + (c > "\uffff") for c in text), initial=0)
+        )
+        entities = []
+        for _ in range(rnd.randint(0, 4)):
+            start = rnd.randrange(len(text))
+            end = rnd.randint(start + 1, min(start + 20, len(text)))
+            offset, length = units[start], units[end] - units[start]
+            kind = rnd.choice(KINDS)
+            extra = ""
+            if kind == "texturl":
+                extra = ",https://example.com/{}".format(rnd.randrange(1000))
+            elif kind == "mentionname":
+                extra = ",{}".format(rnd.randrange(1, 10**9))
+            entities.append("{},{},{}{}".format(kind, offset, length, extra))
+        messages.append((text, ";".join(entities) or None))
+    return messages
+
+
+def run(messages, fmt="html"):
+    """Render every message and return the seconds it took"""
+    richtext._render.cache_clear()
+    render = richtext.render
+    start = time.perf_counter()
+    for text, formatting in messages:
+        render(text, formatting, fmt)
+    return time.perf_counter() - start
+
+
+def run_baseline(messages):
+    """Render every message to HTML through Telethon's entity objects"""
+    from telethon.extensions import html
+
+    start = time.perf_counter()
+    for text, formatting in messages:
+        html.unparse(text, utils.decode_msg_entities(formatting) or [])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--repeat-ratio", type=float, default=0.2)
+    parser.add_argument(
+        "--format", action="append", choices=richtext.FORMATS, dest="formats"
+    )
+    parser.add_argument("--baseline", action="store_true")
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.repeat_ratio)
+    for fmt in args.formats or richtext.FORMATS:
+        seconds = run(messages, fmt)
+        info = richtext.cache_info()
+        print(
+            "{}: {:.2f}s, {:.0f} messages/s ({} cache hits)".format(
+                fmt, seconds, len(messages) / seconds, info.hits
+            )
+        )
+    if args.baseline:
+        seconds = run_baseline(messages)
+        print(
+            "telethon html: {:.2f}s, {:.0f} messages/s".format(
+                seconds, len(messages) / seconds
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Load test the app served by several worker processes while the Dumper keeps
+writing to the same database:
+
+    python -m benchmarks.serving --workers 1 2 4 --clients 16 --duration 5
+
+For every number of --workers, the app is served the way wsgi.py describes,
+by ``gunicorn -w <workers> -k gthread wsgi:app`` (install the "serve"
+extra), while another process inserts messages and commits every
+--commit-interval seconds. The throughput and the failed requests (e.g.
+"database is locked") are printed for each, and the exit status is 1 if
+any request failed.
+
+With --server werkzeug (the default when gunicorn is not installed), each
+worker is a process running Werkzeug's development server on a port of its
+own, the clients spread over them: those numbers are for the development
+server, not for a production deployment.
+"""
+import argparse
+import configparser
+import contextlib
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks.synthetic import make_database
+
+try:
+    import gunicorn
+except ImportError:
+    gunicorn = None
+
+# Where wsgi.py is
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The threads of every gunicorn worker
+THREADS = 8
+
+
+def free_port():
+    """Return a port nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url, timeout=60):
+    """Wait for `url` to be served"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url).read()
+            return
+        except (urllib.error.URLError, OSError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+@contextlib.contextmanager
+def gunicorn_servers(db, workers):
+    """Serve `db` with ``gunicorn -w <workers> wsgi:app``, yield its base URL"""
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-w",
+            str(workers),
+            "-k",
+            "gthread",
+            "--threads",
+            str(THREADS),
+            "-b",
+            "127.0.0.1:{}".format(port),
+            "--log-level",
+            "error",
+            "wsgi:app",
+        ],
+        cwd=ROOT,
+        env=dict(os.environ, TG_TO_ORG_DB=db),
+    )
+    try:
+        yield ["http://127.0.0.1:{}".format(port)]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@contextlib.contextmanager
+def werkzeug_servers(db, workers):
+    """
+    Serve `db` with `workers` development server processes, yield their
+    base URLs
+    """
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    servers = [
+        context.Process(target=serve, args=(db, ports), daemon=True)
+        for _ in range(workers)
+    ]
+    for server in servers:
+        server.start()
+    try:
+        yield [
+            "http://127.0.0.1:{}".format(ports.get(timeout=60)) for _ in servers
+        ]
+    finally:
+        for server in servers:
+            server.terminate()
+            server.join()
+
+
+SERVERS = {"gunicorn": gunicorn_servers, "werkzeug": werkzeug_servers}
+
+
+def serve(db, ports):
+    """Serve the app on a free port, and put it in `ports`"""
+    from werkzeug.serving import make_server
+
+    from app import create_app
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, create_app(db), threaded=True)
+    ports.put(server.port)
+    server.serve_forever()
+
+
+def write(output_directory, db_name, interval, stop):
+    """Insert a message in every channel and commit, until `stop` is set"""
+    from export.dumper import Dumper
+
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {"Dumper": {"OutputDirectory": output_directory, "DBFileName": db_name}}
+    )
+    dumper = Dumper(config["Dumper"])
+    channels = [
+        row[0]
+        for row in dumper.conn.execute("SELECT ContextID FROM ContextSummary")
+    ]
+    message_id = dumper.conn.execute("SELECT MAX(ID) FROM Message").fetchone()[0]
+    while not stop.is_set():
+        message_id += 1
+        for channel_id in channels:
+            dumper._insert(
+                "Message",
+                (message_id, channel_id, time.time(), None, "Live")
+                + (None,) * 7,
+            )
+        dumper.commit()
+        time.sleep(interval)
+    dumper.conn.close()
+
+
+def load(urls, clients, duration):
+    """Request `urls` from `clients` threads, return (successes, failures)"""
+    counts = [0, 0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(offset):
+        done = [0, 0]
+        i = offset
+        while time.monotonic() < deadline:
+            try:
+                with urllib.request.urlopen(urls[i % len(urls)], timeout=30) as r:
+                    # The pages report their errors with a 200
+                    broken = b"Something is broken" in r.read()
+                done[broken] += 1
+            except (urllib.error.URLError, OSError):
+                done[1] += 1
+            i += 1
+        with lock:
+            counts[0] += done[0]
+            counts[1] += done[1]
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def run(db, workers, clients, duration, commit_interval, paths, server="gunicorn"):
+    """
+    Serve `db` with `workers` processes of `server` and load test it while
+    writing
+    """
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    writer = context.Process(
+        target=write,
+        args=(
+            os.path.dirname(db),
+            os.path.splitext(os.path.basename(db))[0],
+            commit_interval,
+            stop,
+        ),
+    )
+    with SERVERS[server](db, workers) as base_urls:
+        try:
+            urls = [base_url + path for base_url in base_urls for path in paths]
+            for url in urls:  # warm up every server
+                wait_until_up(url)
+            writer.start()
+            successes, failures = load(urls, clients, duration)
+        finally:
+            stop.set()
+            if writer.pid:
+                writer.join()
+    return successes / duration, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", help="database to serve instead of a synthetic one")
+    parser.add_argument("--channels", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--commit-interval", type=float, default=0.2)
+    parser.add_argument(
+        "--server",
+        choices=sorted(SERVERS),
+        default="gunicorn" if gunicorn else "werkzeug",
+        help="gunicorn (the default when installed) or the development server",
+    )
+    args = parser.parse_args()
+    if args.server == "gunicorn" and not gunicorn:
+        parser.error('gunicorn is not installed (install the "serve" extra)')
+    if args.server == "werkzeug":
+        print("Serving with the Werkzeug development server, not gunicorn")
+
+    with contextlib.ExitStack() as stack:
+        db = args.db
+        if not db:
+            tmp = stack.enter_context(tempfile.TemporaryDirectory())
+            dumper = make_database(tmp, channels=args.channels, messages=args.messages)
+            dumper.conn.close()
+            db = dumper.db_path
+        db = os.path.abspath(db)
+        with contextlib.closing(sqlite3.connect(db)) as conn:
+            channel_id = conn.execute(
+                "SELECT MIN(ContextID) FROM ContextSummary"
+            ).fetchone()[0]
+        paths = (
+            "/",
+            "/channels",
+            "/channel/{}".format(channel_id),
+            "/api/v1/channels/{}/posts?limit=20".format(channel_id),
+        )
+        failed = False
+        for workers in args.workers:
+            throughput, failures = run(
+                db,
+                workers,
+                args.clients,
+                args.duration,
+                args.commit_interval,
+                paths,
+                args.server,
+            )
+            print(
+                "{} {} workers, {} clients: {:.0f} requests/s, {} failed".format(
+                    workers, args.server, args.clients, throughput, failures
+                )
+            )
+            failed = failed or failures > 0
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Generate a large export database directly, without going through the
+Downloader, for benchmarks of the code reading it (formatters, the web app):
+
+    python -m benchmarks.synthetic /tmp/synthetic --channels 50 --messages 20000
+"""
+import argparse
+import configparser
+import os
+import random
+
+from export.dumper import Dumper
+from benchmarks.fake_client import FIRST_CHANNEL_ID, SELF_USER_ID, WORDS
+
+START_DATE = 1577836800  # 2020-01-01 UTC
+MESSAGE_INTERVAL = 600
+SNAPSHOT_INTERVAL = 86400
+
+
+def make_database(
+    output_directory,
+    channels=10,
+    messages=1000,
+    forward_ratio=0.1,
+    duplicate_ratio=0.5,
+    service_ratio=0.02,
+    empty_ratio=0.05,
+    media_ratio=0.1,
+    seed=0,
+    db_name="export",
+    snapshots=1,
+):
+    """
+    Create ``<output_directory>/<db_name>.db`` with `channels` broadcast
+    channels of `messages` posts each, and return the Dumper that made it.
+
+    A fraction `forward_ratio` of the posts are forwards, and of those a
+    fraction `duplicate_ratio` forward a post some other message already
+    forwarded. `service_ratio` are service messages, `empty_ratio` have
+    no text and `media_ratio` have a photo. Every channel has `snapshots`
+    Channel rows, of which only the latest is titled "Channel <n>".
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {"Dumper": {"OutputDirectory": output_directory, "DBFileName": db_name}}
+    )
+    dumper = Dumper(config["Dumper"])
+    dumper.check_self_user(SELF_USER_ID)
+    rnd = random.Random(seed)
+
+    forwards = []
+    media_id = dumper.conn.execute("SELECT MAX(ID) FROM Media").fetchone()[0] or 0
+    forward_id = dumper.conn.execute("SELECT MAX(ID) FROM Forward").fetchone()[0] or 0
+    for i in range(channels):
+        channel_id = -(1000000000000 + FIRST_CHANNEL_ID + i)
+        dumper.conn.executemany(
+            "INSERT OR REPLACE INTO Channel VALUES (?,?,?,?,?,?,?)",
+            [
+                (
+                    channel_id,
+                    START_DATE + snapshot * SNAPSHOT_INTERVAL,
+                    "About channel {}".format(i),
+                    "Channel {}".format(i)
+                    if snapshot == snapshots - 1
+                    else "Channel {} (old)".format(i),
+                    "channel{}".format(i),
+                    None,
+                    None,
+                )
+                for snapshot in range(snapshots)
+            ],
+        )
+
+        message_rows = []
+        media_rows = []
+        forward_rows = []
+        for msg_id in range(1, messages + 1):
+            text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 60)))
+            service = None
+            fwd = media = None
+            roll = rnd.random()
+            if roll < service_ratio:
+                text, service = None, "pin"
+            elif roll < service_ratio + empty_ratio:
+                text = ""
+
+            if rnd.random() < forward_ratio:
+                forward_id += 1
+                if forwards and rnd.random() < duplicate_ratio:
+                    original = rnd.choice(forwards)
+                else:
+                    original = (
+                        FIRST_CHANNEL_ID + rnd.randrange(1000),
+                        rnd.randrange(1, 100000),
+                    )
+                    forwards.append(original)
+                forward_rows.append(
+                    (forward_id, START_DATE, original[0], original[1], None)
+                )
+                fwd = forward_id
+
+            if rnd.random() < media_ratio:
+                media_id += 1
+                media_rows.append(
+                    (media_id, None, "image/jpeg", 64 * 1024, None, "photo",
+                     None, None, None, None, media_id, media_id, None)
+                )
+                media = media_id
+
+            message_rows.append(
+                (
+                    msg_id,
+                    channel_id,
+                    START_DATE + msg_id * MESSAGE_INTERVAL,
+                    None,
+                    text,
+                    None,
+                    fwd,
+                    None,
+                    rnd.randrange(10000),
+                    media,
+                    None,
+                    service,
+                )
+            )
+
+        dumper.conn.executemany(
+            "INSERT INTO Forward VALUES (?,?,?,?,?)", forward_rows
+        )
+        dumper.conn.executemany(
+            "INSERT INTO Media VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", media_rows
+        )
+        dumper.conn.executemany(
+            "INSERT OR REPLACE INTO Message VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+            message_rows,
+        )
+    dumper.update_context_summaries()
+    dumper.commit()
+    return dumper
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("output")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--snapshots", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    dumper = make_database(
+        args.output,
+        channels=args.channels,
+        messages=args.messages,
+        seed=args.seed,
+        snapshots=args.snapshots,
+    )
+    print("Created", dumper.db_path)
+
+
+if __name__ == "__main__":
+    main()
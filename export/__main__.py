@@ -5,15 +5,17 @@ Handles arguments and config, then calls the Exporter.
 import asyncio
 import difflib
 import logging
-import os
 from contextlib import suppress
 
-from telethon import TelegramClient, utils
+from telethon import utils
 
+from export.columnar import export_columnar
 from export.dumper import Dumper
 from export.exporter import Exporter
-from export.formatters import NAME_TO_FORMATTER
-from export.main_stuff import parse_args, load_config
+from export.formatters import NAME_TO_FORMATTER, NlpFormatter
+from export.formatting import format_parallel
+from export.main_stuff import parse_args, load_config, start_client
+from export.sharding import run_sharded
 from export.utils import parse_proxy_str
 
 logger = logging.getLogger("")
@@ -128,44 +130,78 @@ async def main(loop):
     if args.contexts:
         dumper.config["Whitelist"] = args.contexts
 
+    if args.export_columnar:
+        schema = export_columnar(dumper.conn, args.export_columnar)
+        for table, info in schema["tables"].items():
+            logger.info("Exported %d rows of %s", info["rows"], table)
+        return
+
+    if args.corpus:
+        result = NlpFormatter(dumper.conn).write_corpus(
+            args.corpus,
+            contexts=args.format_contexts,
+            fmt=args.corpus_format,
+            compress=args.corpus_gzip,
+            shard_bytes=args.corpus_shard_mb * 1024 * 1024,
+        )
+        logger.info(
+            "Wrote %d messages (%.1f MB) into %d files in %.1fs (%.1f MB/s)",
+            result["messages"],
+            result["bytes"] / 1e6,
+            len(result["files"]),
+            result["seconds"],
+            result["bytes"] / 1e6 / max(result["seconds"], 1e-9),
+        )
+        return
+
     if args.format:
-        formatter = NAME_TO_FORMATTER[args.format](dumper.conn)
+        if args.format_workers != 1 and dumper.db_path != ":memory:":
+            dumper.conn.close()
+            format_parallel(
+                dumper.db_path,
+                args.format,
+                config["Dumper"]["OutputDirectory"],
+                contexts=args.format_contexts,
+                workers=args.format_workers,
+                reply_depth=args.reply_depth,
+                config=dict(config["Dumper"]),
+                full=args.full,
+            )
+            return
+
+        formatter = NAME_TO_FORMATTER[args.format](
+            dumper.conn, reply_depth=args.reply_depth, config=config["Dumper"]
+        )
         fmt_contexts = args.format_contexts or formatter.iter_context_ids()
         for cid in fmt_contexts:
-            formatter.format(cid, config["Dumper"]["OutputDirectory"])
+            formatter.format(cid, config["Dumper"]["OutputDirectory"], full=args.full)
         return
 
     proxy = args.proxy_string or dumper.config.get("Proxy")
     if proxy:
         proxy = parse_proxy_str(proxy)
 
-    absolute_session_name = os.path.join(
-        config["Dumper"]["OutputDirectory"], config["TelegramAPI"]["SessionName"]
-    )
-    if config.has_option("TelegramAPI", "SecondFactorPassword"):
-        client = await TelegramClient(
-            absolute_session_name,
-            config["TelegramAPI"]["ApiId"],
-            config["TelegramAPI"]["ApiHash"],
-            loop=loop,
-            proxy=proxy,
-        ).start(
-            config["TelegramAPI"]["PhoneNumber"],
-            password=config["TelegramAPI"]["SecondFactorPassword"],
+    takeout = args.takeout or config["Dumper"].getboolean("Takeout")
+
+    if args.shards > 1:
+        dumper.conn.close()
+        return await loop.run_in_executor(
+            None,
+            run_sharded,
+            args.config_file,
+            args.shards,
+            args.contexts,
+            proxy,
+            args.download_past_media,
+            takeout,
         )
-    else:
-        client = await TelegramClient(
-            absolute_session_name,
-            config["TelegramAPI"]["ApiId"],
-            config["TelegramAPI"]["ApiHash"],
-            loop=loop,
-            proxy=proxy,
-        ).start(config["TelegramAPI"]["PhoneNumber"])
+
+    client = await start_client(config, loop, proxy=proxy)
 
     if args.list_dialogs or args.search_string:
         return await list_or_search_dialogs(args, client)
 
-    exporter = Exporter(client, config, dumper, loop)
+    exporter = Exporter(client, config, dumper, loop, takeout=takeout)
 
     try:
         if args.download_past_media:
@@ -186,7 +222,7 @@ if __name__ == "__main__":
         ret = loop.run_until_complete(main(loop)) or 0
     except KeyboardInterrupt:
         ret = 1
-    for task in asyncio.Task.all_tasks():
+    for task in asyncio.all_tasks(loop):
         task.cancel()
         if hasattr(task._coro, "__name__") and task._coro.__name__ == "main":
             continue
@@ -0,0 +1,282 @@
+"""
+Export the Message, Media, User and Channel tables into a columnar layout
+meant for analytics, where every column is a flat binary file that NumPy
+can memory-map instead of a row at a time through the formatters:
+
+    <directory>/schema.json
+    <directory>/<Table>/<Column>.bin          int64 values (nulls as 0)
+    <directory>/<Table>/<Column>.nulls.bin    uint8, 1 where the value is null
+    <directory>/<Table>/<Column>.dict.json    the strings of a "dict" column,
+                                              whose .bin has int32 indices
+                                              into it (-1 for null)
+    <directory>/<Table>/<Column>.offsets.bin  int64 start of every value of a
+    <directory>/<Table>/<Column>.data.bin     "text" column in its UTF-8 data
+                                              (one more offset than rows)
+
+Rows are read in chunks, and the work of turning them into columns (null
+checks, replacing nulls, encoding text) is left to SQLite as much as
+possible, so that the Python side only hands whole tuples to ``array``.
+"""
+import array
+import itertools
+import json
+import os
+import sys
+
+# The columns exported from every table, and how they are stored. "int64"
+# are plain numbers, "dict" low-cardinality strings and "text" free text.
+TABLES = {
+    "Message": (
+        ("ID", "int64"),
+        ("ContextID", "int64"),
+        ("Date", "int64"),
+        ("FromID", "int64"),
+        ("Message", "text"),
+        ("ReplyMessageID", "int64"),
+        ("ForwardID", "int64"),
+        ("PostAuthor", "dict"),
+        ("ViewCount", "int64"),
+        ("MediaID", "int64"),
+        ("Formatting", "text"),
+        ("ServiceAction", "dict"),
+    ),
+    "Media": (
+        ("ID", "int64"),
+        ("Name", "text"),
+        ("MimeType", "dict"),
+        ("Size", "int64"),
+        ("ThumbnailID", "int64"),
+        ("Type", "dict"),
+        ("LocalID", "int64"),
+        ("VolumeID", "int64"),
+        ("Secret", "int64"),
+        ("MediaID", "int64"),
+        ("AccessHash", "int64"),
+        ("Extra", "text"),
+    ),
+    "User": (
+        ("ID", "int64"),
+        ("DateUpdated", "int64"),
+        ("FirstName", "text"),
+        ("LastName", "text"),
+        ("Username", "text"),
+        ("Phone", "text"),
+        ("Bio", "text"),
+        ("Bot", "int64"),
+        ("CommonChatsCount", "int64"),
+        ("PictureID", "int64"),
+    ),
+    "Channel": (
+        ("ID", "int64"),
+        ("DateUpdated", "int64"),
+        ("About", "text"),
+        ("Title", "text"),
+        ("Username", "text"),
+        ("PictureID", "int64"),
+        ("PinMessageID", "int64"),
+    ),
+}
+
+CHUNK_ROWS = 100000
+SCHEMA_VERSION = 1
+
+# array typecodes of every stored kind of file
+INT64, INT32, UINT8 = "q", "i", "B"
+
+
+def _select(column, kind):
+    """
+    Return the SQL expressions that produce the stored values of a column
+    followed by whether each one is null.
+    """
+    if kind == "int64":
+        return ["IFNULL({}, 0)".format(column), "{} IS NULL".format(column)]
+    if kind == "text":
+        return [
+            "IFNULL(CAST({} AS BLOB), x'')".format(column),
+            "{} IS NULL".format(column),
+        ]
+    return [column]
+
+
+class _ColumnWriter:
+    """Appends the chunks of one column to its files"""
+
+    def __init__(self, directory, column, kind):
+        self.path = os.path.join(directory, column)
+        self.kind = kind
+        self.has_nulls = False
+        self.nulls = None
+        if kind == "dict":
+            self.values = open(self.path + ".bin", "wb")
+            self.dictionary = {}
+            return
+
+        self.nulls = open(self.path + ".nulls.bin", "wb")
+        if kind == "int64":
+            self.values = open(self.path + ".bin", "wb")
+        else:
+            self.values = open(self.path + ".data.bin", "wb")
+            self.offsets = open(self.path + ".offsets.bin", "wb")
+            self.offset = 0
+            array.array(INT64, (0,)).tofile(self.offsets)
+
+    def write(self, values, nulls=None):
+        if nulls is not None:
+            nulls = array.array(UINT8, nulls)
+            self.has_nulls = self.has_nulls or 1 in nulls
+            nulls.tofile(self.nulls)
+
+        if self.kind == "int64":
+            array.array(INT64, values).tofile(self.values)
+        elif self.kind == "text":
+            self.values.write(b"".join(values))
+            ends = array.array(
+                INT64, itertools.accumulate(map(len, values), initial=self.offset)
+            )
+            self.offset = ends[-1]
+            ends[1:].tofile(self.offsets)
+        else:
+            codes = self.dictionary
+            array.array(
+                INT32,
+                [-1 if v is None else codes.setdefault(v, len(codes)) for v in values],
+            ).tofile(self.values)
+
+    def close(self):
+        """Close the files and return the schema of the column"""
+        self.values.close()
+        schema = {"kind": self.kind}
+        if self.nulls:
+            self.nulls.close()
+            schema["nulls"] = self.has_nulls
+        if self.kind == "text":
+            self.offsets.close()
+        elif self.kind == "dict":
+            with open(self.path + ".dict.json", "w", encoding="utf-8") as file:
+                json.dump(list(self.dictionary), file, ensure_ascii=False)
+            schema["dictionary_size"] = len(self.dictionary)
+        return schema
+
+
+def export_table(conn, directory, table, chunk_rows=CHUNK_ROWS):
+    """
+    Write the columns of a table into ``<directory>/<table>`` and return
+    its schema, ``{"rows": ..., "columns": {name: {...}}}``.
+    """
+    columns = TABLES[table]
+    table_dir = os.path.join(directory, table)
+    os.makedirs(table_dir, exist_ok=True)
+
+    selects = [_select(column, kind) for column, kind in columns]
+    query = "SELECT rowid, {} FROM {} WHERE rowid > ? ORDER BY rowid LIMIT ?".format(
+        ", ".join(itertools.chain.from_iterable(selects)), table
+    )
+    writers = [_ColumnWriter(table_dir, column, kind) for column, kind in columns]
+
+    rows = 0
+    last_rowid = -sys.maxsize
+    try:
+        while True:
+            chunk = conn.execute(query, (last_rowid, chunk_rows)).fetchall()
+            if not chunk:
+                break
+            rows += len(chunk)
+            last_rowid = chunk[-1][0]
+            transposed = iter(zip(*chunk))
+            next(transposed)  # rowid
+            for writer, select in zip(writers, selects):
+                values = next(transposed)
+                nulls = next(transposed) if len(select) > 1 else None
+                writer.write(values, nulls)
+    finally:
+        schemas = {
+            column: writer.close() for (column, _), writer in zip(columns, writers)
+        }
+
+    return {"rows": rows, "columns": schemas}
+
+
+def export_columnar(conn, directory, tables=TABLES, chunk_rows=CHUNK_ROWS):
+    """
+    Export the given tables of the database connection into `directory`
+    (see the module documentation for the layout) and return the schema,
+    which is also saved as ``schema.json``.
+    """
+    os.makedirs(directory, exist_ok=True)
+    schema = {
+        "version": SCHEMA_VERSION,
+        "byteorder": sys.byteorder,
+        "tables": {
+            table: export_table(conn, directory, table, chunk_rows)
+            for table in tables
+        },
+    }
+    with open(os.path.join(directory, "schema.json"), "w") as file:
+        json.dump(schema, file, indent=2)
+    return schema
+
+
+class ColumnarReader:
+    """
+    Memory-maps the columns written by export_columnar as NumPy arrays
+    (NumPy is only needed to read them, not to write them).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "schema.json")) as file:
+            self.schema = json.load(file)
+        self._prefix = "<" if self.schema["byteorder"] == "little" else ">"
+
+    def _map(self, table, filename, dtype):
+        import numpy
+
+        path = os.path.join(self.directory, table, filename)
+        if not os.path.getsize(path):
+            return numpy.empty(0, dtype=dtype)
+        return numpy.memmap(path, dtype=dtype, mode="r")
+
+    def rows(self, table):
+        return self.schema["tables"][table]["rows"]
+
+    def array(self, table, column):
+        """
+        The values of an "int64" column, or the dictionary indices of a
+        "dict" column (see ``dictionary``).
+        """
+        kind = self.schema["tables"][table]["columns"][column]["kind"]
+        if kind == "int64":
+            return self._map(table, column + ".bin", self._prefix + "i8")
+        if kind == "dict":
+            return self._map(table, column + ".bin", self._prefix + "i4")
+        raise TypeError("{}.{} is a text column".format(table, column))
+
+    def nulls(self, table, column):
+        """A boolean array, True where the value is null"""
+        info = self.schema["tables"][table]["columns"][column]
+        if info["kind"] == "dict":
+            return self.array(table, column) < 0
+        return self._map(table, column + ".nulls.bin", "u1").view(bool)
+
+    def dictionary(self, table, column):
+        """The list of strings the indices of a "dict" column refer to"""
+        path = os.path.join(self.directory, table, column + ".dict.json")
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+
+    def text(self, table, column):
+        """The ``(offsets, data)`` arrays of a "text" column"""
+        return (
+            self._map(table, column + ".offsets.bin", self._prefix + "i8"),
+            self._map(table, column + ".data.bin", "u1"),
+        )
+
+    def strings(self, table, column):
+        """Decode every value of a "text" column (slow, for small tables)"""
+        offsets, data = self.text(table, column)
+        data = data.tobytes()
+        return [
+            data[start:end].decode("utf-8")
+            for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+        ]
@@ -1,15 +1,16 @@
 #!/bin/env python3
 import asyncio
+import base64
 import datetime
 import itertools
+import json
 import logging
 import os
 import time
-from collections import defaultdict
 
 import tqdm
 from telethon import utils
-from telethon.errors import ChatAdminRequiredError
+from telethon.errors import ChatAdminRequiredError, FloodWaitError
 from telethon.tl import types, functions
 
 from . import utils as export_utils
@@ -25,11 +26,28 @@ BAR_FORMAT = (
 QUEUE_TIMEOUT = 5
 DOWNLOAD_PART_SIZE = 256 * 1024
 
+# Priorities of the media queue, lowest first
+PROMOTED_PRIORITY = 0
+THUMBNAIL_PRIORITY = 1
+FULL_PRIORITY = 2
+
 USER_FULL_DELAY = 1.5
 CHAT_FULL_DELAY = 1.5
 MEDIA_DELAY = 3.0
 HISTORY_DELAY = 1.0
 
+# Takeout sessions have much more lenient flood limits for history, entity
+# and file requests. Any FloodWaitError is still waited out.
+TAKEOUT_USER_FULL_DELAY = 0.3
+TAKEOUT_CHAT_FULL_DELAY = 0.3
+TAKEOUT_MEDIA_DELAY = 0.5
+TAKEOUT_HISTORY_DELAY = 0.1
+
+# How long to wait for the final Media ID of a file (e.g. from the writer of
+# a sharded export) before downloading it under a temporary name anyway
+MEDIA_ID_TIMEOUT = 5.0
+MEDIA_ID_POLL_INTERVAL = 0.1
+
 
 class Downloader:
     """
@@ -37,7 +55,11 @@ class Downloader:
     Make Telegram API requests and sleep for the appropriate time.
     """
 
-    def __init__(self, client, config, dumper, loop):
+    def __init__(self, client, config, dumper, loop, takeout=False):
+        """
+        If `takeout` is set, the client is expected to be a takeout
+        session and the (shorter) takeout delays are used.
+        """
         self.client = client
         self.loop = loop or asyncio.get_event_loop()
         self.max_size = config.getint("MaxSize")
@@ -49,11 +71,24 @@ class Downloader:
         self.media_fmt = os.path.join(
             config["OutputDirectory"], config["MediaFilenameFmt"]
         )
+        self.thumbnails_first = config.getboolean("ThumbnailsFirst", False)
         assert all(x in VALID_TYPES for x in self.types)
         if self.types:
             self.types.add("unknown")
 
+        if takeout:
+            self.user_full_delay = TAKEOUT_USER_FULL_DELAY
+            self.chat_full_delay = TAKEOUT_CHAT_FULL_DELAY
+            self.media_delay = TAKEOUT_MEDIA_DELAY
+            self.history_delay = TAKEOUT_HISTORY_DELAY
+        else:
+            self.user_full_delay = USER_FULL_DELAY
+            self.chat_full_delay = CHAT_FULL_DELAY
+            self.media_delay = MEDIA_DELAY
+            self.history_delay = HISTORY_DELAY
+
         self.dumper = dumper
+        self.metrics = dumper.metrics
         self._checked_entity_ids = set()
         self._media_bar = None
 
@@ -61,11 +96,44 @@ class Downloader:
 
         self._incomplete_download = None
 
-        self._media_queue = asyncio.Queue()
+        # Items are (priority, sequence, thumbnail, (media_id, context_id,
+        # sender_id, date)), the sequence keeping the order within a priority
+        self._media_queue = asyncio.PriorityQueue()
+        self._media_sequence = itertools.count()
+        # The full downloads still queued, by Media ID. Only the first of
+        # the entries for one (e.g. once promoted) is downloaded.
+        self._pending_media = {}
         self._user_queue = asyncio.Queue()
         self._chat_queue = asyncio.Queue()
         self._running = False
 
+    async def _request(self, request):
+        """
+        Invoke the given request, recording its latency. If Telegram asks
+        us to wait because of flood limits, wait and try again.
+        """
+        name = type(request).__name__
+        while True:
+            try:
+                with self.metrics.timed("request_seconds", request=name):
+                    return await self.client(request)
+            except FloodWaitError as e:
+                __log__.warning("Flood wait of %ss on %s", e.seconds, name)
+                self.metrics.inc("floodwait_seconds_total", e.seconds, request=name)
+                await self._sleep("floodwait", e.seconds)
+
+    async def _sleep(self, stage, delay):
+        """Sleep for the given delay, recording it as time spent in `stage`"""
+        delay = max(delay, 0)
+        self.metrics.inc("sleep_seconds_total", delay, stage=stage)
+        await asyncio.sleep(delay)
+
+    def _update_queue_depths(self):
+        """Record the current size of the download queues"""
+        self.metrics.set("queue_depth", self._media_queue.qsize(), queue="media")
+        self.metrics.set("queue_depth", self._user_queue.qsize(), queue="user")
+        self.metrics.set("queue_depth", self._chat_queue.qsize(), queue="chat")
+
     def _check_media(self, media):
         """
         Checks whether the given MessageMedia should be downloaded or not.
@@ -158,58 +226,117 @@ class Downloader:
                 return row[0]
         return ""
 
-    async def _download_media(self, media_id, context_id, sender_id, date, bar):
+    def _get_thumbnail(self, thumbnail_id):
+        """
+        Returns the ``(thumb_size, size, cached_bytes)`` of the thumbnail
+        dumped as the given Media ID, or None if it can't be downloaded.
+        """
+        if not thumbnail_id:
+            return None
+        row = self.dumper.conn.execute(
+            "SELECT Extra, Size FROM Media WHERE ID = ?", (thumbnail_id,)
+        ).fetchone()
+        if not row or not row[0]:
+            return None
+        extra = json.loads(row[0])
+        if extra.get("_") == "PhotoCachedSize":
+            return extra["type"], row[1], base64.b64decode(extra["bytes"])
+        if extra.get("_") == "PhotoSize":
+            return extra["type"], row[1] or extra.get("size"), None
+        return None
+
+    async def _get_file_media_id(self, media_id):
+        """
+        Return the Media ID to name the file of the given Media row after,
+        waiting up to MEDIA_ID_TIMEOUT for it if it is not known yet, or
+        None if it is still unknown then.
+        """
+        file_media_id = self.dumper.get_file_media_id(media_id)
+        if file_media_id is None:
+            # Send the Media row on its way to whoever assigns the ID
+            self.dumper.commit()
+            deadline = time.time() + MEDIA_ID_TIMEOUT
+            while file_media_id is None and time.time() < deadline:
+                await asyncio.sleep(MEDIA_ID_POLL_INTERVAL)
+                file_media_id = self.dumper.get_file_media_id(media_id)
+        return file_media_id
+
+    async def _download_media(
+        self, media_id, context_id, sender_id, date, bar, thumbnail=False
+    ):
+        """
+        Download the given media (or only its smallest thumbnail). Returns
+        True if a download request was made.
+        """
         media_row = self.dumper.conn.execute(
-            "SELECT LocalID, VolumeID, Secret, Type, MimeType, Name, Size, FileReference, MediaID, AccessHash "
+            "SELECT LocalID, VolumeID, Secret, Type, MimeType, Name, Size, "
+            "FileReference, MediaID, AccessHash, ThumbnailID "
             "FROM Media WHERE ID = ?",
             (media_id,),
         ).fetchone()
-        media_type = media_row[3].split(".")
-        media_type, media_subtype = media_type[0], media_type[-1]
+        media_type = media_row[3].split(".")[0]
         if media_type not in ("photo", "document", "video"):
-            return
-
-        formatter = defaultdict(
-            str,
-            context_id=context_id,
-            sender_id=sender_id,
-            type=media_subtype or "unknown",
-            name=self._get_name(context_id) or "unknown",
-            sender_name=self._get_name(sender_id) or "unknown",
-        )
-
-        ext = None
-        filename = media_row[5]
-        if filename:
-            filename, ext = os.path.splitext(filename)
-        else:
-            filename = date.strftime(f"{formatter['type']}_%Y-%m-%d_%H-%M-%S")
+            return False
 
-        if not ext:
-            ext = export_utils.get_extension(media_row[4])
+        thumb_size, file_size = ("y" if media_type == "photo" else "-1"), media_row[6]
+        cached_bytes = None
+        if thumbnail:
+            thumb = self._get_thumbnail(media_row[10])
+            if not thumb:
+                return False
+            thumb_size, file_size, cached_bytes = thumb
+
+        def get_filename(file_media_id):
+            return export_utils.get_media_filename(
+                self.media_fmt,
+                file_media_id,
+                media_row[3],
+                media_row[5],
+                media_row[4],
+                date,
+                context_id,
+                sender_id=sender_id,
+                context_name=self._get_name(context_id),
+                sender_name=self._get_name(sender_id),
+                thumbnail=thumbnail,
+            )
 
-        formatter["filename"] = filename
-        filename = date.strftime(self.media_fmt).format_map(formatter)
-        filename += f".{media_id}{ext}"
+        # The final name is known once the Media ID is, so that a file
+        # someone else (e.g. another shard) saved is not downloaded again.
+        # Failing that, the file is downloaded under a temporary name and
+        # renamed by the Dumper once the ID is known.
+        file_media_id = await self._get_file_media_id(media_id)
+        pending = file_media_id is None
+        if pending:
+            file_media_id = self.dumper.get_pending_file_media_id(media_id)
+        filename = get_filename(file_media_id)
         if os.path.isfile(filename):
             __log__.debug("Skipping already-existing file %s", filename)
-            return
+            return False
 
         __log__.debug("Downloading to %s", filename)
         os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if cached_bytes is not None:
+            with open(filename, "wb") as file:
+                file.write(cached_bytes)
+            if pending:
+                self.dumper.name_media_file(media_id, filename, get_filename)
+            self.metrics.inc("media_files_total", type="thumbnail")
+            return False
+
         if media_type in ["photo"]:
             location = types.InputPhotoFileLocation(
                 id=media_row[8],
                 access_hash=media_row[9],
                 file_reference=media_row[7],
-                thumb_size="y",
+                thumb_size=thumb_size,
             )
         elif media_type in ["document"]:
             location = types.InputDocumentFileLocation(
                 id=media_row[8],
                 access_hash=media_row[9],
                 file_reference=media_row[7],
-                thumb_size="-1",
+                thumb_size=thumb_size,
             )
         else:
             location = types.InputFileLocation(
@@ -219,67 +346,93 @@ class Downloader:
                 file_reference=media_row[7],
             )
 
+        downloaded = 0
+
         def progress(saved, total):
-            """Increment the tqdm progress bar"""
+            """Increment the tqdm progress bar by the newly saved bytes"""
+            nonlocal downloaded
             if total is None:
-                bar.total += saved
-                bar.update(saved)
-            elif saved == total:
-                mod = (saved % DOWNLOAD_PART_SIZE) or DOWNLOAD_PART_SIZE
-                bar.update(mod)
-            else:
-                bar.update(DOWNLOAD_PART_SIZE)
+                bar.total += saved - downloaded
+            bar.update(saved - downloaded)
+            self.metrics.inc("media_bytes_total", saved - downloaded)
+            downloaded = saved
 
-        if media_row[6] is not None:
-            bar.total += media_row[6]
+        if file_size is not None:
+            bar.total += file_size
 
         self._incomplete_download = filename
         try:
-            await self.client.download_file(
-                location,
-                file=filename,
-                file_size=media_row[6],
-                part_size_kb=DOWNLOAD_PART_SIZE // 1024,
-                progress_callback=progress,
+            while True:
+                try:
+                    with self.metrics.timed("request_seconds", request="download_file"):
+                        await self.client.download_file(
+                            location,
+                            file=filename,
+                            file_size=file_size,
+                            part_size_kb=DOWNLOAD_PART_SIZE // 1024,
+                            progress_callback=progress,
+                        )
+                    break
+                except FloodWaitError as e:
+                    __log__.warning("Flood wait of %ss on download_file", e.seconds)
+                    self.metrics.inc(
+                        "floodwait_seconds_total", e.seconds, request="download_file"
+                    )
+                    await self._sleep("floodwait", e.seconds)
+            if pending:
+                self.dumper.name_media_file(media_id, filename, get_filename)
+            self.metrics.inc(
+                "media_files_total", type="thumbnail" if thumbnail else media_type
             )
         except Exception as e:
             print("atatat")
             print(e)
         self._incomplete_download = None
+        return True
 
     async def _media_consumer(self, queue, bar):
         while self._running:
             start = time.time()
-            media_id, context_id, sender_id, date = await queue.get()
+            _, _, thumbnail, item = await queue.get()
+            media_id, context_id, sender_id, date = item
+            if not thumbnail and self._pending_media.pop(media_id, None) is None:
+                # Downloaded already through another entry (e.g. promoted)
+                queue.task_done()
+                self._update_queue_depths()
+                continue
+            downloaded = False
             try:
-                await self._download_media(
+                downloaded = await self._download_media(
                     media_id,
                     context_id,
                     sender_id,
                     datetime.datetime.fromtimestamp(date, datetime.UTC),
                     bar,
+                    thumbnail=thumbnail,
                 )
             except Exception as e:
                 print("atata")
                 print(e)
                 pass
             queue.task_done()
-            await asyncio.sleep(max(MEDIA_DELAY - (time.time() - start), 0))
+            self._update_queue_depths()
+            if downloaded:
+                await self._sleep("media", self.media_delay - (time.time() - start))
 
     async def _user_consumer(self, queue, bar):
         while self._running:
             start = time.time()
+            user = await queue.get()
             try:
                 self._dump_full_entity(
-                    await self.client(
-                        functions.users.GetFullUserRequest(await queue.get())
-                    )
+                    await self._request(functions.users.GetFullUserRequest(user))
                 )
             except:
                 print("trututu")
             queue.task_done()
             bar.update(1)
-            await asyncio.sleep(max(USER_FULL_DELAY - (time.time() - start), 0))
+            self._update_queue_depths()
+            await self._sleep("user", self.user_full_delay - (time.time() - start))
 
     async def _chat_consumer(self, queue, bar):
         while self._running:
@@ -290,7 +443,7 @@ class Downloader:
             else:
                 try:
                     self._dump_full_entity(
-                        await self.client(
+                        await self._request(
                             functions.channels.GetFullChannelRequest(chat)
                         )
                     )
@@ -298,7 +451,8 @@ class Downloader:
                     print("tratata")
             queue.task_done()
             bar.update(1)
-            await asyncio.sleep(max(CHAT_FULL_DELAY - (time.time() - start), 0))
+            self._update_queue_depths()
+            await self._sleep("chat", self.chat_full_delay - (time.time() - start))
 
     def enqueue_entities(self, entities):
         """
@@ -333,6 +487,7 @@ class Downloader:
                     self._user_queue.put_nowait(entity)
                 else:
                     self._chat_queue.put_nowait(entity)
+        self._update_queue_depths()
 
     def enqueue_media(self, media_id, context_id, sender_id, date):
         """
@@ -345,7 +500,36 @@ class Downloader:
             date = int(time.time())
         elif not isinstance(date, int):
             date = int(date.timestamp())
-        self._media_queue.put_nowait((media_id, context_id, sender_id, date))
+        item = (media_id, context_id, sender_id, date)
+        if self.thumbnails_first:
+            self._put_media(THUMBNAIL_PRIORITY, item, thumbnail=True)
+        self._pending_media[media_id] = item
+        self._put_media(FULL_PRIORITY, item)
+
+    def _put_media(self, priority, item, thumbnail=False):
+        self._media_queue.put_nowait(
+            (priority, next(self._media_sequence), thumbnail, item)
+        )
+        self._update_queue_depths()
+
+    def promote_media(self, media_id):
+        """
+        Enqueues the full download of the given Media ID ahead of anything
+        else, e.g. when it is wanted right away in thumbnails-first mode.
+        Returns False if the media is not known to belong to any message.
+        """
+        item = self._pending_media.get(media_id)
+        if item is None:
+            row = self.dumper.conn.execute(
+                "SELECT ContextID, FromID, Date FROM Message WHERE MediaID = ?",
+                (media_id,),
+            ).fetchone()
+            if not row:
+                return False
+            item = (media_id, row[0], row[1], int(row[2]))
+            self._pending_media[media_id] = item
+        self._put_media(PROMOTED_PRIORITY, item)
+        return True
 
     def enqueue_photo(self, photo, photo_id, context, peer_id=None, date=None):
         if not photo_id:
@@ -424,7 +608,7 @@ class Downloader:
             chunks_left = self.dumper.max_chunks
             while self._running:
                 start = time.time()
-                history = await self.client(req)
+                history = await self._request(req)
                 self.enqueue_entities(itertools.chain(history.users, history.chats))
                 ent_bar.total = len(self._checked_entity_ids)
 
@@ -457,7 +641,7 @@ class Downloader:
                     __log__.debug("Reached maximum amount of chunks, done.")
                     break
 
-                await asyncio.sleep(max(HISTORY_DELAY - (time.time() - start), 0))
+                await self._sleep("history", self.history_delay - (time.time() - start))
 
             msg_bar.n = msg_bar.total
             msg_bar.close()
@@ -486,7 +670,10 @@ class Downloader:
 
             media = []
             while not self._media_queue.empty():
-                media.append(self._media_queue.get_nowait())
+                _, _, thumbnail, item = self._media_queue.get_nowait()
+                if not thumbnail and self._pending_media.pop(item[0], None):
+                    media.append(item)
+            self._pending_media.clear()
             self.dumper.save_resume_media(media)
 
             if entities or media:
@@ -519,25 +706,30 @@ class Downloader:
             postfix={"chat": utils.get_display_name(target)},
         )
 
-        msg_cursor = dumper.conn.cursor()
-        msg_cursor.execute(
-            "SELECT ID, Date, FromID, MediaID FROM Message "
-            "WHERE ContextID = ? AND MediaID IS NOT NULL",
-            (target_id,),
-        )
-
-        msg_row = msg_cursor.fetchone()
-        while msg_row:
-            try:
+        # In thumbnails-first mode, every preview is fetched before any
+        # of the full files in a first pass over the messages
+        for thumbnail in ((True, False) if self.thumbnails_first else (False,)):
+            msg_cursor = dumper.conn.cursor()
+            msg_cursor.execute(
+                "SELECT ID, Date, FromID, MediaID FROM Message "
+                "WHERE ContextID = ? AND MediaID IS NOT NULL",
+                (target_id,),
+            )
 
-                await self._download_media(
-                    media_id=msg_row[3],
-                    context_id=target_id,
-                    sender_id=msg_row[2],
-                    date=datetime.datetime.fromtimestamp(msg_row[1], datetime.UTC),
-                    bar=bar,
-                )
-            except Exception as e:
-                print("no")
-                print(e)
             msg_row = msg_cursor.fetchone()
+            while msg_row:
+                try:
+                    await self._download_media(
+                        media_id=msg_row[3],
+                        context_id=target_id,
+                        sender_id=msg_row[2],
+                        date=datetime.datetime.fromtimestamp(
+                            msg_row[1], datetime.UTC
+                        ),
+                        bar=bar,
+                        thumbnail=thumbnail,
+                    )
+                except Exception as e:
+                    print("no")
+                    print(e)
+                msg_row = msg_cursor.fetchone()
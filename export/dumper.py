@@ -7,6 +7,7 @@ import sqlite3
 import sys
 import time
 from base64 import b64encode
+from collections import defaultdict
 from datetime import UTC
 from enum import Enum
 
@@ -17,11 +18,72 @@ from telethon.utils import get_peer_id, resolve_id, get_input_peer
 
 from export import utils
 from export.media import Media
+from export.metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
 DB_VERSION = 1
 
+# The ContextSummary row of the context ?1, or no row if it has no messages.
+# The title is the latest one of the channel or user the context is, and
+# the message count is given by {count}.
+CONTEXT_SUMMARY = """
+SELECT ?1,
+    COALESCE(
+        (SELECT Title FROM Channel WHERE ID = ?1
+         ORDER BY DateUpdated DESC LIMIT 1),
+        (SELECT TRIM(IFNULL(FirstName, '') || ' ' || IFNULL(LastName, ''))
+         FROM User WHERE ID = ?1 ORDER BY DateUpdated DESC LIMIT 1)
+    ),
+    {count},
+    Date,
+    ID
+FROM Message WHERE ContextID = ?1
+ORDER BY Date DESC, ID DESC
+LIMIT 1
+"""
+
+# Counting the messages of a context scans all of them
+COUNT_MESSAGES = "(SELECT COUNT(*) FROM Message WHERE ContextID = ?1)"
+
+# The count kept so far plus the ?2 messages added since
+ADD_MESSAGES = (
+    "IFNULL((SELECT MessageCount FROM ContextSummary WHERE ContextID = ?1), 0) + ?2"
+)
+
+
+# Keep the MessageSearch index (see models.queries.search) up to date with
+# every change to Message. Replacing a message does not fire the DELETE
+# trigger (recursive_triggers is off), so its old text is removed before
+# the new row is inserted.
+MESSAGE_SEARCH_TRIGGERS = (
+    """
+CREATE TRIGGER MessageSearchReplace BEFORE INSERT ON Message BEGIN
+    INSERT INTO MessageSearch(MessageSearch, rowid, Message)
+    SELECT 'delete', rowid, Message FROM Message
+    WHERE ID = new.ID AND ContextID = new.ContextID;
+END
+""",
+    """
+CREATE TRIGGER MessageSearchInsert AFTER INSERT ON Message BEGIN
+    INSERT INTO MessageSearch(rowid, Message) VALUES (new.rowid, new.Message);
+END
+""",
+    """
+CREATE TRIGGER MessageSearchDelete AFTER DELETE ON Message BEGIN
+    INSERT INTO MessageSearch(MessageSearch, rowid, Message)
+    VALUES ('delete', old.rowid, old.Message);
+END
+""",
+    """
+CREATE TRIGGER MessageSearchUpdate AFTER UPDATE OF Message ON Message BEGIN
+    INSERT INTO MessageSearch(MessageSearch, rowid, Message)
+    VALUES ('delete', old.rowid, old.Message);
+    INSERT INTO MessageSearch(rowid, Message) VALUES (new.rowid, new.Message);
+END
+""",
+)
+
 
 class InputFileType(Enum):
     """An enum to specify the type of InputFile"""
@@ -65,11 +127,16 @@ class Dumper:
         object from the config file"s Dumper section".
         """
         self.config = config
+        self.metrics = Metrics()
         if "DBFileName" in self.config:
             where = self.config["DBFileName"]
             if where != ":memory:":
                 where = f"{os.path.join(self.config['OutputDirectory'], self.config['DBFileName'])}.db"
+            self.db_path = where
             self.conn = sqlite3.connect(where, check_same_thread=False)
+            if where != ":memory:":
+                # Readers (e.g. the app) neither block nor wait for writes
+                self.conn.execute("PRAGMA journal_mode=WAL")
         else:
             logger.error("A database filename is required!")
             exit()
@@ -211,6 +278,72 @@ class Dumper:
             )
             self.conn.commit()
 
+        # Formatters read the messages of a context ordered by date, also
+        # on databases created before the index existed
+        c.execute(
+            "CREATE INDEX IF NOT EXISTS MessageContextDate "
+            "ON Message(ContextID, Date, ID)"
+        )
+        # Finding other forwards of the same original post (e.g. to skip
+        # duplicates when building a corpus)
+        c.execute(
+            "CREATE INDEX IF NOT EXISTS ForwardOriginal "
+            "ON Forward(FromID, ChannelPost)"
+        )
+
+        # Bumped for the contexts of every commit, so readers can tell what
+        # changed since they last looked (e.g. to invalidate their caches)
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS ContextVersion("
+            "ContextID INT NOT NULL,"
+            "Version INT NOT NULL,"
+            "PRIMARY KEY (ContextID))"
+        )
+        c.execute(
+            "CREATE INDEX IF NOT EXISTS ContextVersionVersion "
+            "ON ContextVersion(Version)"
+        )
+
+        # {context ID: messages added} of the contexts whose ContextSummary
+        # needs to be updated on commit
+        self._dirty_contexts = defaultdict(int)
+        c.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type='table' AND name='ContextSummary'"
+        )
+        if not c.fetchone():
+            c.execute(
+                "CREATE TABLE ContextSummary("
+                "ContextID INT NOT NULL,"
+                "Title TEXT,"
+                "MessageCount INT NOT NULL,"
+                "LastDate INT,"
+                "LastID INT,"
+                "PRIMARY KEY (ContextID))"
+            )
+            self.update_context_summaries()
+
+        # Full text search over trigrams, so any substring of 3 characters or
+        # more can be looked up. Older SQLite versions lack the tokenizer.
+        c.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type='table' AND name='MessageSearch'"
+        )
+        if not c.fetchone():
+            try:
+                c.execute(
+                    "CREATE VIRTUAL TABLE MessageSearch USING fts5("
+                    "Message, content='Message', content_rowid='rowid', "
+                    "tokenize='trigram')"
+                )
+            except sqlite3.OperationalError as error:
+                logger.warning("Messages will not be indexed for search: %s", error)
+            else:
+                for trigger in MESSAGE_SEARCH_TRIGGERS:
+                    c.execute(trigger)
+                c.execute("INSERT INTO MessageSearch(MessageSearch) VALUES ('rebuild')")
+        self.conn.commit()
+
     def _upgrade_database(self, old):
         """
         This method knows how to migrate from old -> DB_VERSION.
@@ -620,6 +753,30 @@ class Dumper:
 
         return self._insert("Forward", row)
 
+    def get_file_media_id(self, media_id):
+        """
+        Returns the Media ID to use when naming the downloaded file of the
+        given Media row, or None if it is not known yet. This is the row ID
+        itself, but dumpers that do not own the final database (e.g. shard
+        workers) may map it.
+        """
+        return media_id
+
+    def get_pending_file_media_id(self, media_id):
+        """
+        Returns what to name the file of a Media row after while its file
+        Media ID is not known yet (see ``name_media_file``).
+        """
+        return "pending-{}".format(media_id)
+
+    def name_media_file(self, media_id, path, get_filename):
+        """
+        Gives the file downloaded to `path` for a Media row whose file
+        Media ID was not known yet its final name, ``get_filename(id)``,
+        as soon as that ID is known.
+        """
+        os.replace(path, get_filename(self.get_file_media_id(media_id)))
+
     def get_max_message_id(self, context_id):
         """
         Returns the largest saved message ID for the given
@@ -725,6 +882,47 @@ class Dumper:
             "INSERT OR REPLACE INTO ResumeMedia " "VALUES (?,?,?,?)", media_tuples
         )
 
+    def update_context_summaries(self, context_ids=None):
+        """
+        Recompute the ContextSummary (latest title, message count and last
+        message) of the given contexts, or of every context with messages,
+        and bump their ContextVersion. Contexts dumped through this Dumper
+        are updated on every commit, without counting their messages again.
+        """
+        if context_ids is None:
+            context_ids = [
+                row[0]
+                for row in self.conn.execute("SELECT DISTINCT ContextID FROM Message")
+            ]
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO ContextSummary "
+            + CONTEXT_SUMMARY.format(count=COUNT_MESSAGES),
+            ((context_id,) for context_id in context_ids),
+        )
+        self._bump_versions(context_ids)
+
+    def _add_to_context_summaries(self, added):
+        """
+        Update the ContextSummary of the contexts in ``{context ID: number
+        of messages added}``, and bump their ContextVersion.
+        """
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO ContextSummary "
+            + CONTEXT_SUMMARY.format(count=ADD_MESSAGES),
+            added.items(),
+        )
+        self._bump_versions(added)
+
+    def _bump_versions(self, context_ids):
+        """Give the contexts a ContextVersion newer than any other one"""
+        version = self.conn.execute(
+            "SELECT IFNULL(MAX(Version), 0) + 1 FROM ContextVersion"
+        ).fetchone()[0]
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO ContextVersion VALUES (?,?)",
+            ((context_id, version) for context_id in context_ids),
+        )
+
     def _insert_if_valid_date(self, into, values, date_column, where):
         """
         Helper method to self._insert(into, values) after checking that the
@@ -762,13 +960,25 @@ class Dumper:
         given tuple of values into the given table.
         """
         try:
+            if into == "Message":
+                # Replacing a message must not count it twice
+                new = not self.conn.execute(
+                    "SELECT 1 FROM Message WHERE ID = ? AND ContextID = ?",
+                    values[:2],
+                ).fetchone()
             fmt = ",".join("?" * len(values))
             c = self.conn.execute(
                 "INSERT OR REPLACE INTO {} VALUES ({})".format(into, fmt), values
             )
+            self.metrics.inc("rows_total", table=into)
+            if into == "Message":
+                self._dirty_contexts[values[1]] += new
+            elif into in ("Channel", "User"):
+                self._dirty_contexts[values[0]] += 0
             return c.lastrowid
         except sqlite3.IntegrityError as error:
             self.conn.rollback()
+            self._dirty_contexts.clear()
             logger.error("Integrity error: %s", str(error))
             raise
 
@@ -776,4 +986,8 @@ class Dumper:
         """
         Commits the changes made to the database to persist on disk.
         """
-        self.conn.commit()
+        with self.metrics.timed("commit_seconds"):
+            if self._dirty_contexts:
+                self._add_to_context_summaries(self._dirty_contexts)
+                self._dirty_contexts.clear()
+            self.conn.commit()
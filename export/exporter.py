@@ -1,13 +1,24 @@
 """A class to iterate through dialogs and dump them, or save past media"""
 
+import asyncio
 import logging
+import os
 import re
 
 from async_generator import yield_, async_generator
+from telethon import utils
+from telethon.errors import TakeoutInitDelayError
 
 from .downloader import Downloader
 
 
+@async_generator
+async def _aiter(iterable):
+    """Wrap a plain iterable so that it can be used with ``async for``"""
+    for item in iterable:
+        await yield_(item)
+
+
 @async_generator
 async def entities_from_str(method, string):
     """Helper function to load entities from the config file"""
@@ -48,54 +59,150 @@ async def get_entities_iter(mode, in_list, client):
 class Exporter:
     """A class to iterate through dialogs and dump them, or save past media"""
 
-    def __init__(self, client, config, dumper, loop):
+    def __init__(self, client, config, dumper, loop, shard=None, takeout=False):
+        """
+        `shard` may be an ``(index, count)`` tuple, in which case only the
+        dialogs with ``abs(peer_id) % count == index`` are acted on.
+
+        If `takeout` is set, all the requests are made inside a takeout
+        session, which is finished once the dump is done or interrupted.
+        """
         self.client = client
         self.dumper = dumper
-        self.downloader = Downloader(client, config["Dumper"], dumper, loop)
+        self.shard = shard
+        self.takeout = takeout
+        self.downloader = Downloader(
+            client, config["Dumper"], dumper, loop, takeout=takeout
+        )
         self.logger = logging.getLogger("exporter")
 
+        self.metrics = dumper.metrics
+        self.metrics_file = config["Dumper"].get("MetricsFile")
+        if self.metrics_file:
+            self.metrics_file = os.path.join(
+                config["Dumper"]["OutputDirectory"], self.metrics_file
+            )
+        self.metrics_interval = config["Dumper"].getfloat("MetricsInterval", 30)
+        self._metrics_task = None
+
+    async def _write_metrics(self):
+        """Periodically write a metrics snapshot to the metrics file"""
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            self.metrics.write(self.metrics_file)
+
+    def _start_metrics(self):
+        if self.metrics_file and not self._metrics_task:
+            self._metrics_task = asyncio.ensure_future(self._write_metrics())
+
     async def close(self):
         """Gracefully close the exporter"""
         self.logger.info("Closing exporter")
+        if self._metrics_task:
+            self._metrics_task.cancel()
+        if self.metrics_file:
+            self.metrics.write(self.metrics_file)
+        self.logger.info(self.metrics.summary())
         await self.client.disconnect()
         self.dumper.conn.close()
 
-    async def start(self):
-        """Perform a dump of the dialogs we've been told to act on"""
-        self.logger.info("Saving to %s", self.dumper.config["OutputDirectory"])
-        self.dumper.check_self_user((await self.client.get_me(input_peer=True)).user_id)
+    def _takeout_scopes(self):
+        """The data the takeout session needs access to"""
+        return dict(
+            users=True,
+            chats=True,
+            megagroups=True,
+            channels=True,
+            files=bool(self.downloader.types),
+            max_file_size=self.downloader.max_size or None,
+        )
+
+    async def _run(self, method):
+        """
+        Await the given method, inside a takeout session if one was
+        requested. Telethon finishes the session when leaving it, marking
+        it unsuccessful if an error (or a cancellation) interrupted it.
+        """
+        if not self.takeout:
+            return await method()
+
+        client = self.client
+        if client.session.takeout_id is not None:
+            self.logger.info("Resuming an unfinished takeout session")
+            scopes = {}
+        else:
+            scopes = self._takeout_scopes()
+        try:
+            async with client.takeout(finalize=True, **scopes) as takeout:
+                self.client = self.downloader.client = takeout
+                return await method()
+        except TakeoutInitDelayError as e:
+            self.logger.error(
+                "Telegram needs %s seconds before a takeout session can be "
+                "started. Allow the data export from another Telegram app "
+                "and try again later",
+                e.seconds,
+            )
+        finally:
+            self.client = self.downloader.client = client
+
+    @async_generator
+    async def _iter_targets(self):
+        """
+        Yield the entities we've been told to act on. If this exporter is
+        one shard of a sharded export, only the entities that belong to
+        this shard are yielded.
+        """
         if "Whitelist" in self.dumper.config:
-            async for entity in get_entities_iter(
+            entities = get_entities_iter(
                 "whitelist", self.dumper.config["Whitelist"], self.client
-            ):
-                await self.downloader.start(entity)
+            )
         elif "Blacklist" in self.dumper.config:
-            async for entity in get_entities_iter(
+            entities = get_entities_iter(
                 "blacklist", self.dumper.config["Blacklist"], self.client
-            ):
-                await self.downloader.start(entity)
+            )
         else:
-            for dialog in await self.client.get_dialogs(limit=None):
-                await self.downloader.start(dialog.entity)
+            dialogs = await self.client.get_dialogs(limit=None)
+            entities = _aiter(dialog.entity for dialog in dialogs)
+
+        async for entity in entities:
+            if self.shard is None:
+                await yield_(entity)
+                continue
+            index, count = self.shard
+            if abs(utils.get_peer_id(entity)) % count == index:
+                await yield_(entity)
+
+    async def start(self):
+        """Perform a dump of the dialogs we've been told to act on"""
+        return await self._run(self._start)
+
+    async def _start(self):
+        self.logger.info("Saving to %s", self.dumper.config["OutputDirectory"])
+        self.dumper.check_self_user((await self.client.get_me(input_peer=True)).user_id)
+        self._start_metrics()
+        async for entity in self._iter_targets():
+            with self.metrics.timed("dialog_seconds"):
+                await self.downloader.start(entity)
 
     async def download_past_media(self):
         """
         Download past media (media we saw but didn't download before) of the
         dialogs we've been told to act on
         """
+        return await self._run(self._download_past_media)
+
+    async def _download_past_media(self):
         self.logger.info("Saving to %s", self.dumper.config["OutputDirectory"])
         self.dumper.check_self_user((await self.client.get_me(input_peer=True)).user_id)
-
-        if "Whitelist" in self.dumper.config:
-            async for entity in get_entities_iter(
-                "whitelist", self.dumper.config["Whitelist"], self.client
-            ):
-                await self.downloader.download_past_media(self.dumper, entity)
-        elif "Blacklist" in self.dumper.config:
-            async for entity in get_entities_iter(
-                "blacklist", self.dumper.config["Blacklist"], self.client
-            ):
+        self._start_metrics()
+        async for entity in self._iter_targets():
+            with self.metrics.timed("dialog_seconds"):
                 await self.downloader.download_past_media(self.dumper, entity)
-        else:
-            for dialog in await self.client.get_dialogs(limit=None):
-                await self.downloader.download_past_media(self.dumper, dialog.entity)
+
+    def promote_media(self, media_id):
+        """
+        Download the full file of the given Media ID as soon as possible
+        (see ``Downloader.promote_media``).
+        """
+        return self.downloader.promote_media(media_id)
@@ -6,6 +6,7 @@ from .baseformatter import BaseFormatter
 from .textformatter import TextFormatter
 from .htmlformatter import HtmlFormatter
 from .nlpformatter import NlpFormatter
+from .orgformatter import OrgFormatter
 
 
 NAME_TO_FORMATTER = {}
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """Utility to extract data from a telegram-export database"""
+import bisect
 import datetime
+import functools
 import math
 import sqlite3
 import sys
@@ -13,6 +15,52 @@ import os
 from telethon import utils
 from telethon.tl import types
 
+from .. import utils as export_utils
+from .watermarks import Watermarks, get_watermarks_filename
+
+# Media.Type (before the dot) of the media the Downloader saves
+DOWNLOADED_MEDIA_TYPES = ("photo", "document", "video")
+
+# How many levels of replies are resolved by default
+REPLY_DEPTH = 1
+
+# Rows fetched at once while streaming messages, whose replies are
+# then resolved together
+FETCH_WINDOW = 500
+
+# SQLite's default limit of parameters in a single query
+MAX_QUERY_PARAMS = 999
+
+# Message namedtuple fields that can be read directly from the Message table
+MESSAGE_FIELDS = {
+    "id": "ID",
+    "context_id": "ContextID",
+    "date": "Date",
+    "from_id": "FromID",
+    "text": "Message",
+    "reply_message_id": "ReplyMessageID",
+    "forward_id": "ForwardID",
+    "post_author": "PostAuthor",
+    "view_count": "ViewCount",
+    "media_id": "MediaID",
+    "formatting": "Formatting",
+    "service_action": "ServiceAction",
+}
+
+# Fields of the Forward a message has (if any), read by joining FORWARD_JOIN
+FORWARD_FIELDS = {
+    "forward_from_id": "ForwardFromID",
+    "forward_channel_post": "ForwardChannelPost",
+    "forward_post_author": "ForwardPostAuthor",
+}
+
+# Renamed so they do not clash with the columns of Message
+FORWARD_JOIN = (
+    " LEFT JOIN (SELECT ID AS ForwardRowID, FromID AS ForwardFromID, "
+    "ChannelPost AS ForwardChannelPost, PostAuthor AS ForwardPostAuthor "
+    "FROM Forward) ON ForwardRowID = ForwardID"
+)
+
 Message = namedtuple(
     "Message",
     (
@@ -64,6 +112,15 @@ Channel = namedtuple(
     ),
 )
 
+MESSAGE_COLUMNS = ", ".join(MESSAGE_FIELDS.values())
+
+USER_COLUMNS = (
+    "ID, DateUpdated, FirstName, LastName, Username, "
+    "Phone, Bio, Bot, CommonChatsCount, PictureID"
+)
+
+CHANNEL_COLUMNS = "ID, DateUpdated, About, Title, Username, PictureID, PinMessageID"
+
 Media = namedtuple(
     "Media",
     (
@@ -81,13 +138,29 @@ Media = namedtuple(
 )
 
 
+@functools.lru_cache(maxsize=None)
+def _row_type(columns):
+    """Return the namedtuple type for rows with the given columns"""
+    return namedtuple("MessageRow", columns)
+
+
 class BaseFormatter:
     """
     A class to extract data from a given telegram-export database in the form
     of named tuples.
     """
 
-    def __init__(self, db):
+    # Whether new messages can be appended to a previous output
+    appendable = True
+
+    def __init__(self, db, reply_depth=REPLY_DEPTH, config=None):
+        """
+        `db` is a database filename or connection. Messages come with the
+        message they reply to, which in turn comes with the one it replies
+        to and so on, up to `reply_depth` levels (0 to not resolve them).
+        `config` is the (optional) Dumper section of the configuration.
+        """
+        self.config = config or {}
         if isinstance(db, str):
             self.dbconn = sqlite3.connect("file:{}?mode=ro".format(db), uri=True)
         elif isinstance(db, sqlite3.Connection):
@@ -99,6 +172,14 @@ class BaseFormatter:
             "SELECT UserID FROM SelfInformation"
         ).fetchone()[0]
 
+        self.reply_depth = reply_depth
+        self._watermarks = None
+
+        # {(table, ID): ([DateUpdated, ...], [namedtuple, ...])}, sorted by
+        # date, so that looking an entity up at a date is a bisection
+        self._snapshots = {}
+        self._loaded_contexts = set()
+
     @staticmethod
     @abstractmethod
     def name():
@@ -183,59 +264,143 @@ class BaseFormatter:
             return " WHERE " + " AND ".join(query), tuple(param)
         return " ", ()
 
-    @classmethod
-    def _fetch_at_date(cls, cur, query, eid, at_date):
+    def _add_snapshots(self, table, rows):
         """
-        Helper method around the common operation to fetch a type by its ID
-        and a "DateUpdated" parameter.
+        Index the given entity rows, which must be sorted by ID and then
+        DateUpdated and contain all the snapshots of every ID in them.
         """
-        where, query_params = cls._build_query(
-            ("ID = ?", eid), ("DateUpdated <= ?", at_date)
-        )
+        factory = User if table == "User" else Channel
+        for row in rows:
+            dates, entities = self._snapshots.setdefault((table, row[0]), ([], []))
+            entity = factory(*row)
+            dates.append(entity.date_updated)
+            entities.append(
+                entity._replace(
+                    date_updated=datetime.datetime.fromtimestamp(entity.date_updated)
+                )
+            )
+
+    def _load_context(self, context_id):
+        """
+        Load every snapshot of the users who sent messages in the given
+        context with a single query (the context itself is loaded on use).
+        """
+        if context_id in self._loaded_contexts:
+            return
+        self._loaded_contexts.add(context_id)
+        cur = self.dbconn.cursor()
         cur.execute(
-            "{} {} ORDER BY DateUpdated DESC".format(query, where), query_params
-        )
-        row = cur.fetchone()
-        if row:
-            return row
-        where, query_params = cls._build_query(
-            ("ID = ?", eid), ("DateUpdated > ?", at_date)
+            "SELECT {} FROM User WHERE ID IN "
+            "(SELECT DISTINCT FromID FROM Message WHERE ContextID = ?) "
+            "ORDER BY ID, DateUpdated".format(USER_COLUMNS),
+            (context_id,),
         )
-        cur.execute("{} {} ORDER BY DateUpdated ASC".format(query, where), query_params)
-        return cur.fetchone()
+        known = {eid for table, eid in self._snapshots if table == "User"}
+        self._add_snapshots("User", (row for row in cur if row[0] not in known))
+
+    def _fetch_at_date(self, table, eid, at_date):
+        """
+        Return the snapshot of the given entity as it was at the given
+        timestamp (or the earliest one after it, if there is none before).
+        The last known snapshot is returned if the date is None.
+        """
+        entry = self._snapshots.get((table, eid))
+        if entry is None:
+            cur = self.dbconn.cursor()
+            cur.execute(
+                "SELECT {} FROM {} WHERE ID = ? ORDER BY DateUpdated".format(
+                    USER_COLUMNS if table == "User" else CHANNEL_COLUMNS, table
+                ),
+                (eid,),
+            )
+            # Remember unknown IDs too, so they are not looked up again
+            entry = self._snapshots[(table, eid)] = ([], [])
+            self._add_snapshots(table, cur)
+
+        dates, entities = entry
+        if not dates:
+            return None
+        if at_date is None:
+            return entities[-1]
+        return entities[max(bisect.bisect_right(dates, at_date) - 1, 0)]
+
+    def clear_cache(self):
+        """
+        Forget the entities loaded so far, for instance after the database
+        has been updated while the formatter was open.
+        """
+        self._snapshots.clear()
+        self._loaded_contexts.clear()
 
-    def format(self, target, file=None, *args, **kwargs):
+    def get_watermarks(self):
+        """
+        Return the Watermarks of the database being formatted, or None
+        if it is not a file.
+        """
+        if self._watermarks is None:
+            filename = self.dbconn.execute("PRAGMA database_list").fetchone()[2]
+            if not filename:
+                return None
+            self._watermarks = Watermarks(get_watermarks_filename(filename))
+        return self._watermarks
+
+    def format(self, target, file=None, *args, full=False, **kwargs):
         """
         The public method to format target contexts and output them to 'file'.
         Target should be an individual Context ID. File can be a filename or
         file-like object. If it is false, it will be interpreted as stdout.
+
+        When formatting into a filename that already exists, only messages
+        newer than the ones formatted the last time are appended to it
+        (if the formatter is `appendable`), unless `full` is set.
         """
+        if isinstance(target, (User, Channel)):
+            target = target.id
+        elif not isinstance(target, int):
+            raise TypeError("target should be a context ID or context namedtuple")
+
+        watermarks = watermark = latest = None
         if not file:
             file = sys.stdout
         elif isinstance(file, (str, Path)):
             if os.path.isdir(file):
                 file = os.path.join(file, str(target))
-            file = open(file, "w")
+            if self.appendable:
+                watermarks = self.get_watermarks()
+            if watermarks:
+                # Anything dumped while formatting is left for the next run
+                latest = self.dbconn.execute(
+                    "SELECT Date, ID FROM Message WHERE ContextID = ? "
+                    "ORDER BY Date DESC, ID DESC LIMIT 1",
+                    (target,),
+                ).fetchone()
+                if not full and os.path.isfile(file):
+                    watermark = watermarks.get(self.name(), target)
+                if watermark and (not latest or latest <= watermark):
+                    return None
+            file = open(file, "a" if watermark else "w")
         elif not isinstance(file, TextIOWrapper):
             raise TypeError(
                 "Supplied file {} could not be interpreted as a file".format(file)
             )
 
         with file:
-            if isinstance(target, int):
-                return self._format(target, file, *args, **kwargs)
-            if isinstance(target, (User, Channel)):
-                return self._format(target.id, file, *args, **kwargs)
-
-        raise TypeError("target should be a context ID or context namedtuple")
+            result = self._format(
+                target, file, *args, after=watermark, until=latest, **kwargs
+            )
+        if latest:
+            watermarks.set(self.name(), target, latest)
+        return result
 
     @abstractmethod
-    def _format(self, context_id, file, *args, **kwargs):
+    def _format(self, context_id, file, *args, after=None, until=None, **kwargs):
         """
         An abstract method that should be implemented by formatters
         Context ID will always be a Bot API style ID. File will always be
         something like a file object or sys.stdout, suitable for usage with
-        print(file=file).
+        print(file=file). If `after` is set, the file already has the
+        messages up to that ``(date, id)`` and only the ones after it (and
+        up to `until`, if set) should be appended.
         """
         # TODO provide a way to format many targets into one directory with one method, and a format syntax to specify the name scheme of the output files.
         pass
@@ -248,6 +413,8 @@ class BaseFormatter:
         from_user_id=None,
         order="DESC",
         include_service=True,
+        after=None,
+        until=None,
     ):
         """
         Yield Messages from a context. Start and end date should be UTC timestamps
@@ -255,50 +422,175 @@ class BaseFormatter:
         from_user_id is set, as there is no FromID for Channel messages. Order
         should be ASC or DESC. Note that unlike the other methods, context_id
         *must* be in the Bot API format where Channel IDs start with
-        -100 and old-style Chat IDs start with -.
+        -100 and old-style Chat IDs start with -. `after` and `until` are
+        like in iter_message_rows.
         """
-        start_date, end_date = self.get_timestamp(start_date), self.get_timestamp(
-            end_date
-        )
+        self._load_context(context_id)
+        for rows in self._iter_message_pages(
+            context_id,
+            MESSAGE_COLUMNS,
+            after=after,
+            until=until,
+            start_date=start_date,
+            end_date=end_date,
+            from_user_id=from_user_id,
+            order=order,
+            include_service=include_service,
+        ):
+            rows = [row[2:] for row in rows]
+            replies = self._resolve_replies(context_id, rows, self.reply_depth)
+            for row in rows:
+                yield self._message_from_row(row, replies.get(row[5]))
+
+    def iter_message_rows(
+        self,
+        context_id,
+        columns=MESSAGE_FIELDS,
+        after=None,
+        until=None,
+        start_date=None,
+        end_date=None,
+        from_user_id=None,
+        order="ASC",
+        include_service=True,
+        batch_size=FETCH_WINDOW,
+    ):
+        """
+        Yield the raw rows of the messages in a context as namedtuples with
+        only the given `columns` (names from MESSAGE_FIELDS), without
+        looking up any other table but Forward, which is joined in the same
+        query if any of FORWARD_FIELDS is given too. Dates are left as UTC
+        timestamps.
+
+        Messages are read in pages of `batch_size`, ordered by date and ID.
+        To resume an interrupted iteration, pass ``after=(date, id)`` of
+        the last row seen; only rows past it (in the given order) are read.
+        Likewise, no rows past ``until=(date, id)`` are read.
+        The other arguments are like in get_messages_from_context.
+        """
+        columns = tuple(columns)
+        row_type = _row_type(columns)
+        fields = dict(MESSAGE_FIELDS, **FORWARD_FIELDS)
+        for rows in self._iter_message_pages(
+            context_id,
+            ", ".join(fields[c] for c in columns),
+            join=FORWARD_JOIN if set(columns) & FORWARD_FIELDS.keys() else "",
+            after=after,
+            until=until,
+            start_date=start_date,
+            end_date=end_date,
+            from_user_id=from_user_id,
+            order=order,
+            include_service=include_service,
+            batch_size=batch_size,
+        ):
+            for row in rows:
+                yield row_type._make(row[2:])
+
+    def _iter_message_pages(
+        self,
+        context_id,
+        columns,
+        join="",
+        after=None,
+        until=None,
+        start_date=None,
+        end_date=None,
+        from_user_id=None,
+        order="ASC",
+        include_service=True,
+        batch_size=FETCH_WINDOW,
+    ):
+        """
+        Yield lists of ``(Date, ID, *columns)`` message rows, paginating
+        on (Date, ID) so that every page is a cheap range scan over the
+        (ContextID, Date, ID) index rather than one long-lived cursor.
+        `join` is added after the Message table, e.g. FORWARD_JOIN.
+        """
+        order = order.upper()
+        if order not in ("ASC", "DESC"):
+            raise ValueError("Invalid order {}".format(order))
         where, params = self._build_query(
             ("ContextID = ?", context_id),
-            ("Date > ?", start_date),
-            ("Date < ?", end_date),
+            ("Date > ?", self.get_timestamp(start_date)),
+            ("Date < ?", self.get_timestamp(end_date)),
             ("FromID = ?", from_user_id),
         )
-
-        cur = self.dbconn.cursor()
-        exclude_service = "" if include_service else " AND ServiceAction is null"
-        cur.execute(
-            "SELECT ID, ContextID, Date, FromID, Message, ReplyMessageID, "
-            "ForwardID, PostAuthor, ViewCount, MediaID, Formatting, ServiceAction"
-            " FROM Message {}{} ORDER BY Date {}".format(
-                where, exclude_service, order.upper()
-            ),
-            params,
+        if not include_service:
+            where += " AND ServiceAction IS NULL"
+        if until is not None:
+            where += " AND (Date, ID) {} (?, ?)".format(
+                "<=" if order == "ASC" else ">="
+            )
+            params += tuple(until)
+        query = (
+            "SELECT Date, ID, {} FROM Message{}{}{{}} "
+            "ORDER BY Date {}, ID {} LIMIT ?".format(columns, join, where, order, order)
         )
-        row = cur.fetchone()
-        while row:
-            yield self._message_from_row(row)
-            row = cur.fetchone()
-            if not row:
+        keyset = " AND (Date, ID) {} (?, ?)".format(">" if order == "ASC" else "<")
+
+        while True:
+            if after is None:
+                rows = self.dbconn.execute(
+                    query.format(""), (*params, batch_size)
+                ).fetchall()
+            else:
+                rows = self.dbconn.execute(
+                    query.format(keyset), (*params, *after, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < batch_size:
                 return
+            after = rows[-1][:2]
 
-    def _message_from_row(self, row):
+    def _resolve_replies(self, context_id, rows, depth):
+        """
+        Return ``{message ID: Message}`` for the messages the given rows
+        reply to, fetched with one query per level of replies. Only `depth`
+        levels are resolved; deeper replies are left as None.
+        """
+        levels = []
+        reply_ids = {row[5] for row in rows if row[5]}
+        while reply_ids and len(levels) < depth:
+            level = []
+            reply_ids = list(reply_ids)
+            # One parameter is taken by the context ID
+            step = MAX_QUERY_PARAMS - 1
+            for i in range(0, len(reply_ids), step):
+                chunk = reply_ids[i:i + step]
+                level.extend(
+                    self.dbconn.execute(
+                        "SELECT {} FROM Message WHERE ContextID = ? "
+                        "AND ID IN ({})".format(
+                            MESSAGE_COLUMNS, ",".join("?" * len(chunk))
+                        ),
+                        (context_id, *chunk),
+                    )
+                )
+            levels.append(level)
+            reply_ids = {row[5] for row in level if row[5]}
+
+        # Build the messages from the deepest level up
+        replies = {}
+        for level in reversed(levels):
+            replies = {
+                row[0]: self._message_from_row(row, replies.get(row[5]))
+                for row in level
+            }
+        return replies
+
+    def _message_from_row(self, row, reply=None):
         """
         Take a row (ID, ContextID, Date, FromID, Text, ReplyMessageID,
         ForwardID, PostAuthor, ViewCount, MediaID, Formatting, ServiceAction)
-        and add the values for out, reply_message, context, and from_user. Also
-        replace date UTC timestamp with date UTC datetime. Return a Message.
-        Something slightly worrying: if there is a chain of many replies, this
-        is quite inefficient. If the chain is > 1000, possible recursion error.
+        and the Message it replies to (if resolved), and add the values for
+        out, reply_message, context, and from_user. Also replace date UTC
+        timestamp with date UTC datetime. Return a Message.
         """
         # TODO forwards, media
         out = row[3] == self.our_userid
-        if row[5]:
-            reply = self.get_message_by_id(row[1], row[5])
-        else:
-            reply = None
         context = self.get_entity(row[1])
         if row[3]:
             from_user = self.get_user(row[3])
@@ -327,22 +619,19 @@ class BaseFormatter:
 
     def get_message_by_id(self, context_id, msg_id):
         """
-        Returns the unique message with the given context and message ID.
+        Returns the unique message with the given context and message ID,
+        with its replies resolved up to the formatter's reply depth.
         Returns ``None`` if the message has not been dumped.
         """
-        where, params = self._build_query(
-            ("ContextID = ?", context_id), ("ID = ?", msg_id)
-        )
-        cur = self.dbconn.cursor()
-        cur.execute(
-            "SELECT ID, ContextID, Date, FromID, Message, ReplyMessageID, "
-            "ForwardID, PostAuthor, ViewCount, MediaID, Formatting, "
-            "ServiceAction FROM Message {}".format(where),
-            params,
-        )
-        row = cur.fetchone()
+        row = self.dbconn.execute(
+            "SELECT {} FROM Message WHERE ContextID = ? AND ID = ?".format(
+                MESSAGE_COLUMNS
+            ),
+            (context_id, msg_id),
+        ).fetchone()
         if row:
-            return self._message_from_row(row)
+            replies = self._resolve_replies(context_id, [row], self.reply_depth)
+            return self._message_from_row(row, replies.get(row[5]))
 
     def iter_context_ids(self):
         """
@@ -379,18 +668,7 @@ class BaseFormatter:
         """
         at_date = self.get_timestamp(at_date)
         uid = self.ensure_id_marked(uid, types.PeerUser)
-        cur = self.dbconn.cursor()
-        query = (
-            "SELECT ID, DateUpdated, FirstName, LastName, Username, "
-            "Phone, Bio, Bot, CommonChatsCount, PictureID FROM User"
-        )
-        row = self._fetch_at_date(cur, query, uid, at_date)
-        if not row:
-            return None
-        user = User(*row)
-        return user._replace(
-            date_updated=datetime.datetime.fromtimestamp(user.date_updated)
-        )
+        return self._fetch_at_date("User", uid, at_date)
 
     def get_channel(self, cid, at_date=None):
         """
@@ -400,18 +678,7 @@ class BaseFormatter:
         """
         at_date = self.get_timestamp(at_date)
         cid = self.ensure_id_marked(cid, types.PeerChannel)
-        cur = self.dbconn.cursor()
-        query = (
-            "SELECT ID, DateUpdated, About, Title, Username, "
-            "PictureID, PinMessageID FROM Channel"
-        )
-        row = self._fetch_at_date(cur, query, cid, at_date)
-        if not row:
-            return None
-        channel = Channel(*row)
-        return channel._replace(
-            date_updated=datetime.datetime.fromtimestamp(channel.date_updated)
-        )
+        return self._fetch_at_date("Channel", cid, at_date)
 
     def get_media(self, mid):
         """Return the Media with given ID or return None."""
@@ -425,3 +692,32 @@ class BaseFormatter:
         if not row:
             return None
         return Media(*row)
+
+    def get_media_filename(
+        self, media, context_id, sender_id, date, thumbnail=False, output=None
+    ):
+        """
+        Return the filename the Downloader saves the given Media namedtuple
+        as, for a message sent at `date` (a UTC timestamp), or None if it
+        is not a kind of media that gets downloaded. The filename is under
+        the OutputDirectory of the config (or `output`, if there is none).
+        """
+        if not media or not media.type:
+            return None
+        if media.type.split(".")[0] not in DOWNLOADED_MEDIA_TYPES:
+            return None
+
+        output = self.config.get("OutputDirectory") or output or ""
+        return export_utils.get_media_filename(
+            os.path.join(output, self.config.get("MediaFilenameFmt", "")),
+            media.id,
+            media.type,
+            media.name,
+            media.mime_type,
+            datetime.datetime.fromtimestamp(date, datetime.timezone.utc),
+            context_id,
+            sender_id=sender_id,
+            context_name=self.get_display_name(self.get_entity(context_id)),
+            sender_name=self.get_display_name(sender_id and self.get_user(sender_id)),
+            thumbnail=thumbnail,
+        )
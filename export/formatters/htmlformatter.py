@@ -1,36 +1,402 @@
 """
-Formatter to display paginated(?) HTML of a context.
-Very much unfinished and needs a web designer to work on it.
+Formatter to generate a static HTML site of a context: one index page
+listing the months, and every month split into pages of messages.
+
+A manifest kept next to the pages remembers how many messages (and which
+last message ID) each month had when it was rendered, the last message
+(date and ID) of each of its pages, and the other months its replies link
+into. Formatting the same context again after an export only regenerates
+the months that got new messages, and in them only the pages from the
+first one that changed, plus the months linking into a month whose pages
+changed (their links point to the page the replied message is on).
 """
+import bisect
+import datetime
+import html
+import itertools
+import json
+import os
+from pathlib import Path
+from urllib.parse import quote
 
 from . import BaseFormatter
+from .. import richtext
+
+PAGE_SIZE = 500
+MANIFEST_NAME = "manifest.json"
+
+# Bump this whenever the generated HTML changes, to regenerate everything
+MANIFEST_VERSION = 4
+
+STYLE = """
+body { font-family: sans-serif; max-width: 50em; margin: auto; padding: 1em; }
+.message { border-bottom: 1px solid #ddd; padding: 0.5em 0; }
+.meta { color: #777; font-size: small; }
+.reply { border-left: 3px solid #aac; padding-left: 0.5em; color: #555; }
+.media img { max-width: 100%; max-height: 20em; }
+nav { margin: 1em 0; }
+"""
 
 
 class HtmlFormatter(BaseFormatter):
     """A Formatter class to generate HTML"""
 
+    # A page can't be appended to, sites are kept up to date by their manifest
+    appendable = False
+
+    def __init__(self, db, *args, page_size=PAGE_SIZE, **kwargs):
+        super().__init__(db, *args, **kwargs)
+        self.page_size = page_size
+        # {month: [(date, ID) of the last message of every page]} of the
+        # site being generated, to link to replies on other pages
+        self._pages = None
+        # The months linked to by the replies of the pages being generated
+        self._linked_months = None
+
     @staticmethod
     def name():
         return "html"
 
-    def output_header(self, file, context):
-        """Output the header of the page. Context should be a namedtuple"""
-        # TODO HTML
-        print(self.get_display_name(context), file=file)
+    def format(self, target, file=None, *args, full=False, **kwargs):
+        """
+        Generate the site of the target under ``<file>/html/<context ID>``
+        if `file` is a directory, or a single page with all the messages
+        otherwise (see ``BaseFormatter.format``).
+        """
+        if isinstance(file, (str, Path)) and os.path.isdir(file):
+            context_id = target if isinstance(target, int) else target.id
+            return self.generate_site(context_id, file, full=full)
+        return super().format(target, file, *args, full=full, **kwargs)
+
+    @staticmethod
+    def _page_name(month, page):
+        if page == 0:
+            return "{}.html".format(month)
+        return "{}-{}.html".format(month, page + 1)
+
+    def _write_page(self, filename, title, body):
+        tmp = "{}.tmp".format(filename)
+        with open(tmp, "w", encoding="utf-8") as file:
+            file.write(
+                "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+                "<title>{0}</title><style>{1}</style></head>\n"
+                "<body><h1>{0}</h1>\n{2}\n</body></html>\n".format(
+                    html.escape(title), STYLE, body
+                )
+            )
+        os.replace(tmp, filename)
+
+    def _get_months(self, context_id):
+        """Return ``{month: (count, last ID)}`` for the months of a context"""
+        cur = self.dbconn.execute(
+            "SELECT strftime('%Y-%m', Date, 'unixepoch') AS Month, "
+            "COUNT(*), MAX(ID) FROM Message WHERE ContextID = ? "
+            "GROUP BY Month ORDER BY Month",
+            (context_id,),
+        )
+        return {month: (count, last_id) for month, count, last_id in cur}
+
+    @staticmethod
+    def _get_month_range(month):
+        """Return the (start, end) dates to select a month's messages"""
+        start = datetime.datetime.strptime(month, "%Y-%m").replace(
+            tzinfo=datetime.timezone.utc
+        )
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        return start - datetime.timedelta(seconds=1), end
+
+    def _paginate(self, context_id, month):
+        """Return the (date, ID) of the last message of every page of a month"""
+        start_date, end_date = self._get_month_range(month)
+        keys = [
+            (row.date, row.id)
+            for row in self.iter_message_rows(
+                context_id,
+                ("date", "id"),
+                start_date=start_date,
+                end_date=end_date,
+            )
+        ]
+        return keys[self.page_size - 1::self.page_size] + (
+            keys[-1:] if len(keys) % self.page_size else []
+        )
 
-    def generate_message_html(self, message):
+    def generate_site(self, context_id, output_directory, full=False):
+        """
+        Generate (or bring up to date, unless `full` is set) the site of the
+        given context under ``<output_directory>/html/<context ID>``.
+        Returns how many message pages were written.
+        """
+        site = os.path.join(output_directory, "html", str(context_id))
+        os.makedirs(site, exist_ok=True)
+        manifest_file = os.path.join(site, MANIFEST_NAME)
+        try:
+            with open(manifest_file, encoding="utf-8") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            manifest = {}
+        if (
+            full
+            or manifest.get("version") != MANIFEST_VERSION
+            or manifest.get("page_size") != self.page_size
+        ):
+            manifest = {}
+        old_months = manifest.get("months", {})
+
+        months = {}
+        changed = []
+        for month, (count, last_id) in self._get_months(context_id).items():
+            old = old_months.get(month)
+            if (
+                old
+                and old["count"] == count
+                and old["last_id"] == last_id
+                and os.path.isfile(os.path.join(site, self._page_name(month, 0)))
+            ):
+                months[month] = old
+                continue
+            months[month] = {
+                "count": count,
+                "last_id": last_id,
+                "pages": self._paginate(context_id, month),
+            }
+            changed.append(month)
+
+        self._pages = {
+            month: [tuple(key) for key in info["pages"]]
+            for month, info in months.items()
+        }
+        # Replies into months whose pages changed may now be on another page
+        moved = {
+            month
+            for month in changed
+            if month not in old_months
+            or [tuple(key) for key in old_months[month]["pages"]]
+            != self._pages[month]
+        }
+        rewrite = {
+            month: old_months.get(month, {}).get("pages", []) for month in changed
+        }
+        for month, info in months.items():
+            if month not in rewrite and moved.intersection(info.get("links", [])):
+                rewrite[month] = []
+
+        written = 0
+        try:
+            for month in sorted(rewrite):
+                written += self._generate_month(
+                    context_id, site, month, rewrite[month], months[month]
+                )
+        finally:
+            self._pages = None
+
+        name = self.get_display_name(self.get_entity(context_id)) or "unnamed"
+        self._write_page(
+            os.path.join(site, "index.html"),
+            name,
+            "<ul>\n{}\n</ul>".format(
+                "\n".join(
+                    '<li><a href="{}">{}</a> ({} messages)</li>'.format(
+                        self._page_name(month, 0), month, info["count"]
+                    )
+                    for month, info in months.items()
+                )
+            ),
+        )
+
+        with open(manifest_file, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "page_size": self.page_size,
+                    "months": months,
+                },
+                file,
+                indent=1,
+            )
+        self.clear_cache()
+        return written
+
+    def _generate_month(self, context_id, site, month, old_pages, info):
+        """
+        Write the pages of the given month that changed since it was
+        rendered with the last (date, ID) of each page being `old_pages`,
+        and return how many were written. The months the replies link into
+        are kept in the ``links`` of its manifest `info`.
+        """
+        pages = self._pages[month]
+        first = 0
+        while (
+            first < min(len(pages), len(old_pages))
+            and pages[first] == tuple(old_pages[first])
+            and os.path.isfile(os.path.join(site, self._page_name(month, first)))
+        ):
+            first += 1
+        # The last page written before needs a link to the ones after it
+        first = min(first, max(len(old_pages) - 1, 0))
+
+        start_date, end_date = self._get_month_range(month)
+        messages = self.get_messages_from_context(
+            context_id,
+            start_date=start_date,
+            end_date=end_date,
+            order="ASC",
+            after=pages[first - 1] if first else None,
+        )
+        page_count = max(len(pages), 1)
+        name = self.get_display_name(self.get_entity(context_id)) or "unnamed"
+
+        # The pages kept link into the same months as before
+        self._linked_months = set(info.get("links", []) if first else [])
+        for i in range(first, page_count):
+            page = list(itertools.islice(messages, self.page_size))
+            nav = ['<a href="index.html">{}</a>'.format(html.escape(name))]
+            if i > 0:
+                nav.append(
+                    '<a href="{}">previous</a>'.format(self._page_name(month, i - 1))
+                )
+            if i < page_count - 1:
+                nav.append(
+                    '<a href="{}">next</a>'.format(self._page_name(month, i + 1))
+                )
+            nav = "<nav>{}</nav>".format(" | ".join(nav))
+            self._write_page(
+                os.path.join(site, self._page_name(month, i)),
+                "{} - {}{}".format(name, month, " ({})".format(i + 1) if i else ""),
+                "{0}\n{1}\n{0}".format(
+                    nav,
+                    "\n".join(self.generate_message_html(m, site) for m in page),
+                ),
+            )
+        self._linked_months.discard(month)
+        info["links"] = sorted(self._linked_months)
+        self._linked_months = None
+        return page_count - first
+
+    def get_media_link(self, message, site):
+        """
+        Return the path, relative to the `site` directory, of the file the
+        message's media is saved as (see ``utils.get_media_filename``),
+        and of its thumbnail (the file itself if there is no thumbnail), or
+        None if it has no downloadable media.
+        """
+        media = self.get_media(message.media_id)
+
+        def path(thumbnail):
+            return self.get_media_filename(
+                media,
+                message.context_id,
+                message.from_id,
+                message.date.timestamp(),
+                thumbnail=thumbnail,
+                output=os.path.dirname(os.path.dirname(site)),
+            )
+
+        full = path(False)
+        if not full:
+            return None
+        thumb = path(True)
+
+        def link(filename):
+            return quote(os.path.relpath(filename, site).replace(os.sep, "/"))
+
+        return media, link(full), link(thumb if os.path.isfile(thumb) else full)
+
+    def _get_reply_link(self, reply):
+        """
+        Return the link to a replied message: its anchor, preceded by the
+        page it is on when generating a site.
+        """
+        anchor = "#m{}".format(reply.id)
+        if self._pages is None:
+            return anchor
+        date = reply.date.timestamp()
+        month = datetime.datetime.fromtimestamp(date, datetime.timezone.utc)
+        month = month.strftime("%Y-%m")
+        if self._linked_months is not None:
+            self._linked_months.add(month)
+        pages = self._pages.get(month, [])
+        index = bisect.bisect_left(pages, (date, reply.id))
+        if index == len(pages):
+            return anchor
+        return self._page_name(month, index) + anchor
+
+    def generate_message_html(self, message, site=None):
         """
         Return HTML for a message, showing reply message, forward headers,
         view count, post author, and media (if applicable).
         """
-        # TODO HTML
-        from_name = self.get_display_name(message.from_id) or "(???)"
-        return "{}: {}".format(from_name, message.text)
+        from_name = (
+            self.get_display_name(message.from_user)
+            or message.post_author
+            or self.get_display_name(message.context)
+            or "(???)"
+        )
+        meta = [message.date.strftime("%Y-%m-%d %H:%M")]
+        if message.forward_id:
+            meta.append("forwarded")
+        if message.view_count is not None:
+            meta.append("{} views".format(message.view_count))
+
+        parts = [
+            '<div class="message" id="m{}">'.format(message.id),
+            '<div class="meta"><b>{}</b> {}</div>'.format(
+                html.escape(from_name), html.escape(", ".join(meta))
+            ),
+        ]
+        if message.reply_message:
+            parts.append(
+                '<div class="reply"><a href="{}">{}</a></div>'.format(
+                    self._get_reply_link(message.reply_message),
+                    html.escape((message.reply_message.text or "")[:200]),
+                )
+            )
+        elif message.reply_message_id:
+            parts.append('<div class="reply">(in reply to a message)</div>')
+
+        if message.service_action:
+            parts.append("<i>{}</i>".format(html.escape(message.service_action)))
+        if message.text:
+            parts.append(
+                "<div>{}</div>".format(
+                    richtext.render(message.text, message.formatting).replace(
+                        "\n", "<br>"
+                    )
+                )
+            )
+
+        media = None
+        if site and message.media_id:
+            media = self.get_media_link(message, site)
+        if media:
+            media, full, thumb = media
+            is_image = (media.mime_type or "").startswith("image/")
+            if media.type.startswith("photo") or is_image:
+                parts.append(
+                    '<div class="media"><a href="{}">'
+                    '<img src="{}" loading="lazy"></a></div>'.format(full, thumb)
+                )
+            else:
+                parts.append(
+                    '<div class="media"><a href="{}">{}</a></div>'.format(
+                        full, html.escape(media.name or media.type)
+                    )
+                )
+
+        parts.append("</div>")
+        return "\n".join(parts)
 
-    def _format(self, context_id, file, *args, **kwargs):
-        """Format the given context as HTML and output to 'file'"""
+    def _format(self, context_id, file, *args, after=None, until=None, **kwargs):
+        """Format the given context as a single HTML page into 'file'"""
         entity = self.get_entity(context_id)
+        name = self.get_display_name(entity) or "unnamed"
 
-        self.output_header(file, entity)
+        print(
+            "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+            "<title>{0}</title><style>{1}</style></head>\n"
+            "<body><h1>{0}</h1>".format(html.escape(name), STYLE),
+            file=file,
+        )
         for message in self.get_messages_from_context(context_id, order="ASC"):
             print(self.generate_message_html(message), file=file)
+        print("</body></html>", file=file)
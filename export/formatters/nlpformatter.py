@@ -1,7 +1,98 @@
 """A Formatter class to output pure text"""
+import gzip
+import json
+import os
+import time
 
 from . import BaseFormatter
 
+CORPUS_FORMATS = ("jsonl", "text")
+
+# Uncompressed bytes written to a corpus file before starting the next one
+CORPUS_SHARD_BYTES = 256 * 1024 * 1024
+
+# Rows fetched from the database, and written to the file, at once
+CORPUS_BATCH_SIZE = 5000
+
+# Beyond this, compressing gets much slower for little smaller files
+CORPUS_GZIP_LEVEL = 3
+WRITE_BUFFER = 1024 * 1024
+
+# Messages worth having in a corpus: not service messages, not empty, and
+# if they are forwards, only the first time the original post was seen
+# (the Forward rows of a post share its FromID and ChannelPost) among the
+# forwards in the corpus, which may be restricted with `forwards`
+CORPUS_QUERY = (
+    "SELECT Message.ContextID, Message.ID, Message.Date, Message.Message "
+    "FROM Message LEFT JOIN Forward ON Forward.ID = Message.ForwardID "
+    "WHERE Message.ServiceAction IS NULL AND Message.Message != '' "
+    "AND (Forward.ChannelPost IS NULL OR Forward.ID = ("
+    "SELECT MIN(F.ID) FROM Forward F WHERE F.FromID = Forward.FromID "
+    "AND F.ChannelPost = Forward.ChannelPost{forwards})){messages} "
+    "ORDER BY Message.ContextID, Message.Date, Message.ID"
+)
+
+
+class CorpusWriter:
+    """
+    Writes lines into numbered corpus files of up to `shard_bytes` bytes
+    (before compression), named ``corpus-00000.<ext>`` and so on.
+    """
+
+    def __init__(
+        self, directory, ext, compress=False, shard_bytes=CORPUS_SHARD_BYTES
+    ):
+        self.directory = directory
+        self.ext = ext + (".gz" if compress else "")
+        self.compress = compress
+        self.shard_bytes = shard_bytes
+        self.files = []
+        self.bytes = 0
+        self._file = self._raw = None
+        self._file_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        filename = os.path.join(
+            self.directory, "corpus-{:05d}.{}".format(len(self.files), self.ext)
+        )
+        self.files.append(filename)
+        self._file_bytes = 0
+        raw = open(filename, "wb", buffering=WRITE_BUFFER)
+        if self.compress:
+            return gzip.GzipFile(
+                fileobj=raw, mode="wb", compresslevel=CORPUS_GZIP_LEVEL
+            ), raw
+        return raw, None
+
+    def write(self, lines):
+        """Write the given list of (newline-terminated) strings"""
+        data = "".join(lines).encode("utf-8")
+        while data:
+            if not self._file:
+                self._file, self._raw = self._open()
+            # Fill the current file up to the last line that fits in it
+            # (a file always gets at least one line, however long it is)
+            cut = len(data)
+            if self._file_bytes + cut > self.shard_bytes:
+                cut = data.rfind(b"\n", 0, self.shard_bytes - self._file_bytes) + 1
+                if not cut and not self._file_bytes:
+                    cut = data.find(b"\n") + 1 or len(data)
+            if cut:
+                self._file.write(data[:cut])
+                self._file_bytes += cut
+                self.bytes += cut
+                data = data[cut:]
+            if data:
+                self.close()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            if self._raw:
+                self._raw.close()
+            self._file = self._raw = None
+
 
 class NlpFormatter(BaseFormatter):
     """A Formatter class to output only the text of messages,
@@ -11,11 +102,93 @@ class NlpFormatter(BaseFormatter):
     def name():
         return "nlp"
 
-    def _format(self, context_id, file, *args, **kwargs):
+    def _format(self, context_id, file, *args, after=None, until=None, **kwargs):
         """Format the given context as text and output to 'file'"""
-        entity = self.get_entity(context_id)
+        for row in self.iter_message_rows(
+            context_id,
+            columns=("text",),
+            after=after,
+            until=until,
+            include_service=False,
+        ):
+            if row.text:
+                print(row.text, file=file)
+
+    def iter_corpus_rows(self, contexts=None, batch_size=CORPUS_BATCH_SIZE):
+        """
+        Yield lists of ``(ContextID, ID, Date, Text)`` rows of the messages
+        that belong in a corpus (see CORPUS_QUERY), for the given context
+        IDs or all of them. A forwarded post is kept the first time it was
+        seen in those contexts, even if it was seen before in another one.
+        """
+        if contexts is None:
+            cursors = [
+                self.dbconn.execute(CORPUS_QUERY.format(forwards="", messages=""))
+            ]
+        else:
+            contexts = list(contexts)
+            query = CORPUS_QUERY.format(
+                forwards=" AND F.ID IN (SELECT ForwardID FROM Message "
+                "WHERE ContextID IN ({}))".format(",".join("?" * len(contexts))),
+                messages=" AND Message.ContextID = ?",
+            )
+            cursors = (
+                self.dbconn.execute(query, (*contexts, cid)) for cid in contexts
+            )
+        for cur in cursors:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def write_corpus(
+        self,
+        directory,
+        contexts=None,
+        fmt="jsonl",
+        compress=False,
+        shard_bytes=CORPUS_SHARD_BYTES,
+    ):
+        """
+        Write the text of the messages of the given contexts (or all of
+        them) as a corpus into `directory`, in shards of `shard_bytes`.
+
+        In the "jsonl" format every line is an object with the context_id,
+        id, date and text of a message. In the "text" format every line is
+        the text of a message, with its own newlines replaced by spaces.
+
+        Returns a dictionary with the messages, bytes (uncompressed) and
+        files written, and the seconds it took.
+        """
+        if fmt not in CORPUS_FORMATS:
+            raise ValueError("Unknown corpus format {}".format(fmt))
+
+        start = time.perf_counter()
+        encode = json.JSONEncoder(ensure_ascii=False).encode
+        writer = CorpusWriter(directory, fmt, compress, shard_bytes)
+        messages = 0
+        try:
+            for rows in self.iter_corpus_rows(contexts):
+                if fmt == "jsonl":
+                    lines = [
+                        '{{"context_id":{},"id":{},"date":{},"text":{}}}\n'.format(
+                            context_id, msg_id, int(date), encode(text)
+                        )
+                        for context_id, msg_id, date, text in rows
+                    ]
+                else:
+                    lines = [
+                        " ".join(text.splitlines()) + "\n" for _, _, _, text in rows
+                    ]
+                writer.write(lines)
+                messages += len(rows)
+        finally:
+            writer.close()
 
-        for message in self.get_messages_from_context(context_id, order="ASC"):
-            if not message.text or message.service_action is not None:
-                continue
-            print(message.text)
+        return {
+            "messages": messages,
+            "bytes": writer.bytes,
+            "files": writer.files,
+            "seconds": time.perf_counter() - start,
+        }
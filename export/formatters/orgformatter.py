@@ -0,0 +1,127 @@
+"""
+Formatter to write a context as an Org document, with a headline per
+message carrying its date, properties and media links.
+"""
+import datetime
+import os
+
+from . import BaseFormatter
+from .. import richtext
+
+# Messages rendered before they are written to the file at once
+WRITE_BATCH = 200
+
+HEADLINE_LENGTH = 60
+
+COLUMNS = (
+    "id",
+    "date",
+    "from_id",
+    "text",
+    "reply_message_id",
+    "forward_from_id",
+    "forward_channel_post",
+    "forward_post_author",
+    "post_author",
+    "view_count",
+    "media_id",
+    "formatting",
+    "service_action",
+)
+
+
+class OrgFormatter(BaseFormatter):
+    """A Formatter class to output Org documents"""
+
+    @staticmethod
+    def name():
+        return "org"
+
+    def _entity_name(self, peer_id):
+        try:
+            return self.get_display_name(self.get_entity(peer_id))
+        except ValueError:
+            return ""
+
+    def generate_message_org(self, context_id, row, directory):
+        """
+        Return the Org entry for a row of ``COLUMNS``, with media linked
+        relative to `directory`.
+        """
+        date = datetime.datetime.fromtimestamp(row.date, datetime.timezone.utc)
+        text = row.text or ""
+        if row.service_action:
+            title = "Service action {}".format(row.service_action)
+        else:
+            title = " ".join(text.split())[:HEADLINE_LENGTH] or "Message {}".format(
+                row.id
+            )
+
+        properties = [(":ID:", "{}-{}".format(context_id, row.id))]
+        if row.from_id:
+            sender = self.get_display_name(self.get_user(row.from_id))
+            properties.append((":FROM:", sender or row.from_id))
+        if row.post_author:
+            properties.append((":AUTHOR:", row.post_author))
+        if row.view_count is not None:
+            properties.append((":VIEWS:", row.view_count))
+        if row.reply_message_id:
+            properties.append(
+                (":REPLY_TO:", "{}-{}".format(context_id, row.reply_message_id))
+            )
+        if row.forward_from_id:
+            properties.append(
+                (
+                    ":FORWARDED_FROM:",
+                    self._entity_name(row.forward_from_id) or row.forward_from_id,
+                )
+            )
+        if row.forward_channel_post:
+            properties.append((":FORWARDED_POST:", row.forward_channel_post))
+        if row.forward_post_author:
+            properties.append((":FORWARDED_AUTHOR:", row.forward_post_author))
+
+        lines = ["* {}".format(title), ":PROPERTIES:"]
+        lines.extend("{} {}".format(key, value) for key, value in properties)
+        lines.append(":END:")
+        lines.append(date.strftime("[%Y-%m-%d %a %H:%M]"))
+        if text:
+            # Rendering also keeps lines from being read as headlines
+            lines.append(richtext.render(text, row.formatting, "org"))
+
+        if row.media_id:
+            media = self.get_media(row.media_id)
+            filename = self.get_media_filename(
+                media, context_id, row.from_id, row.date, output=directory
+            )
+            if filename:
+                link = os.path.relpath(filename, directory)
+                if media.type.startswith("photo"):
+                    lines.append("[[file:{}]]".format(link))
+                else:
+                    lines.append(
+                        "[[file:{}][{}]]".format(link, media.name or media.type)
+                    )
+        return "\n".join(lines) + "\n"
+
+    def _format(self, context_id, file, *args, after=None, until=None, **kwargs):
+        """Format the given context as Org and output to 'file'"""
+        name = getattr(file, "name", None)
+        if isinstance(name, str) and os.path.isfile(name):
+            directory = os.path.dirname(os.path.abspath(name))
+        else:
+            directory = os.getcwd()
+
+        if after is None:
+            entity_name = self._entity_name(context_id) or "unnamed"
+            file.write("#+TITLE: {}\n#+STARTUP: overview\n\n".format(entity_name))
+
+        batch = []
+        for row in self.iter_message_rows(
+            context_id, columns=COLUMNS, after=after, until=until
+        ):
+            batch.append(self.generate_message_org(context_id, row, directory))
+            if len(batch) == WRITE_BATCH:
+                file.write("".join(batch))
+                batch.clear()
+        file.write("".join(batch))
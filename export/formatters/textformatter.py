@@ -35,11 +35,14 @@ class TextFormatter(BaseFormatter):
         when = message.date.strftime("[%d.%m.%y %H.%M.%S]")
         return "{}, {}:{} {}".format(who, when, reply or "", message.text)
 
-    def _format(self, context_id, file, *args, **kwargs):
+    def _format(self, context_id, file, *args, after=None, until=None, **kwargs):
         """Format the given context as text and output to 'file'"""
-        entity = self.get_entity(context_id)
-        name = self.get_display_name(entity) or "unnamed"
-
-        print('== Conversation with "{}" =='.format(name), file=file)
-        for message in self.get_messages_from_context(context_id, order="ASC"):
-            print(self.generate_message(message))
+        if after is None:
+            entity = self.get_entity(context_id)
+            name = self.get_display_name(entity) or "unnamed"
+            print('== Conversation with "{}" =='.format(name), file=file)
+
+        for message in self.get_messages_from_context(
+            context_id, order="ASC", after=after, until=until
+        ):
+            print(self.generate_message(message), file=file)
@@ -0,0 +1,63 @@
+"""
+Remember up to which message every context was formatted, so that later
+runs only need to append what is new.
+"""
+import os
+import sqlite3
+
+LOCK_TIMEOUT = 30
+
+
+def get_watermarks_filename(db_filename):
+    """Return the file where the watermarks of a database are kept"""
+    return "{}.watermarks.db".format(os.path.splitext(db_filename)[0])
+
+
+class Watermarks:
+    """
+    The last formatted ``(Date, ID)`` per formatter and context, in their
+    own small database next to the export database (which formatters only
+    ever open read-only).
+    """
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename, timeout=LOCK_TIMEOUT)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS Watermark("
+            "Formatter TEXT NOT NULL,"
+            "ContextID INT NOT NULL,"
+            "Date INT NOT NULL,"
+            "ID INT NOT NULL,"
+            "PRIMARY KEY (Formatter, ContextID))"
+        )
+        self.conn.commit()
+
+    def get(self, formatter, context_id):
+        """Return the ``(date, id)`` formatted last, or None"""
+        row = self.conn.execute(
+            "SELECT Date, ID FROM Watermark WHERE Formatter = ? AND ContextID = ?",
+            (formatter, context_id),
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def set(self, formatter, context_id, position):
+        """Record that the context was formatted up to ``(date, id)``"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO Watermark VALUES (?,?,?,?)",
+            (formatter, context_id, *position),
+        )
+        self.conn.commit()
+
+    def clear(self, formatter, context_id=None):
+        """Forget the watermarks of a formatter (for a single context)"""
+        if context_id is None:
+            self.conn.execute("DELETE FROM Watermark WHERE Formatter = ?", (formatter,))
+        else:
+            self.conn.execute(
+                "DELETE FROM Watermark WHERE Formatter = ? AND ContextID = ?",
+                (formatter, context_id),
+            )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,101 @@
+"""
+Format many contexts of an export database at once, spreading them over a
+pool of processes which each open the database read-only.
+
+Contexts are handed out largest first (by their number of messages), so
+that the long ones start early and the small ones fill the gaps at the end
+instead of one huge chat being left running alone on a single core.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import sqlite3
+
+import tqdm
+
+from export.formatters import NAME_TO_FORMATTER
+
+logger = logging.getLogger(__name__)
+
+# The formatter of the current worker process, set by _init_worker
+_formatter = None
+
+
+def estimate_sizes(conn, contexts=None):
+    """
+    Return a list of ``(context_id, message_count)`` for the given context
+    IDs (or all of them), sorted from the largest to the smallest.
+    """
+    counts = dict(
+        conn.execute("SELECT ContextID, COUNT(*) FROM Message GROUP BY ContextID")
+    )
+    if contexts is None:
+        contexts = counts
+    return sorted(
+        ((cid, counts.get(cid, 0)) for cid in contexts),
+        key=lambda x: x[1],
+        reverse=True,
+    )
+
+
+def _init_worker(db_path, formatter_name, reply_depth, config):
+    global _formatter
+    _formatter = NAME_TO_FORMATTER[formatter_name](
+        db_path, reply_depth=reply_depth, config=config
+    )
+
+
+def _format_context(context_id, output_directory, full):
+    _formatter.format(context_id, output_directory, full=full)
+    # Entities are rarely shared between contexts, don't let them pile up
+    _formatter.clear_cache()
+
+
+def format_parallel(
+    db_path,
+    formatter_name,
+    output_directory,
+    contexts=None,
+    workers=None,
+    reply_depth=1,
+    config=None,
+    full=False,
+):
+    """
+    Format the given contexts (all of them if None) of the database at
+    `db_path` with the named formatter, every context into its own file
+    of `output_directory`, using `workers` processes (default one per CPU).
+    `config` is passed to the formatters, and must be picklable (a dict).
+    Unless `full` is set, existing output is only appended to.
+    """
+    conn = sqlite3.connect("file:{}?mode=ro".format(db_path), uri=True)
+    try:
+        sizes = estimate_sizes(conn, contexts)
+    finally:
+        conn.close()
+
+    workers = min(workers or os.cpu_count() or 1, len(sizes)) or 1
+    bar = tqdm.tqdm(
+        total=sum(count for _, count in sizes),
+        unit="msg",
+        desc=formatter_name,
+        unit_scale=True,
+    )
+    with bar, concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(db_path, formatter_name, reply_depth, config),
+    ) as pool:
+        futures = {
+            pool.submit(_format_context, cid, output_directory, full): (cid, count)
+            for cid, count in sizes
+        }
+        for future in concurrent.futures.as_completed(futures):
+            cid, count = futures[future]
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Failed to format context %s", cid)
+            bar.update(count)
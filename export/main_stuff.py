@@ -7,8 +7,11 @@ import re
 import appdirs
 
 import tqdm
+from telethon import TelegramClient
+
 from export.dumper import logger
 from export.formatters import NAME_TO_FORMATTER
+from export.formatters.nlpformatter import CORPUS_FORMATS
 
 
 class TqdmLoggingHandler(logging.Handler):
@@ -53,6 +56,10 @@ def load_config(filename):
         "MaxChunks": "0",
         "LibraryLogLevel": "WARNING",
         "MediaFilenameFmt": "usermedia/{name}-{context_id}/{type}-{filename}",
+        "ThumbnailsFirst": "no",
+        "Takeout": "no",
+        "MetricsFile": "",
+        "MetricsInterval": "30",
     }
 
     config = configparser.ConfigParser(defaults)
@@ -98,6 +105,30 @@ def load_config(filename):
     return config
 
 
+async def start_client(config, loop, proxy=None, session_name=None, phone=None):
+    """
+    Create and start a TelegramClient for the given config. The session
+    name and phone number default to the ones in the TelegramAPI section;
+    the session file always lives in the output directory.
+    """
+    api = config["TelegramAPI"]
+    absolute_session_name = os.path.join(
+        config["Dumper"]["OutputDirectory"], session_name or api["SessionName"]
+    )
+    client = TelegramClient(
+        absolute_session_name,
+        api["ApiId"],
+        api["ApiHash"],
+        loop=loop,
+        proxy=proxy,
+    )
+    if config.has_option("TelegramAPI", "SecondFactorPassword"):
+        return await client.start(
+            phone or api["PhoneNumber"], password=api["SecondFactorPassword"]
+        )
+    return await client.start(phone or api["PhoneNumber"])
+
+
 def parse_args():
     """Parse command-line arguments to the script"""
     parser = argparse.ArgumentParser(
@@ -145,6 +176,66 @@ def parse_args():
         choices=NAME_TO_FORMATTER,
     )
 
+    parser.add_argument(
+        "--export-columnar",
+        metavar="DIR",
+        help="exports the Message, Media, User and Channel tables into DIR "
+        "as one binary file per column (see export/columnar.py) and exits.",
+    )
+
+    parser.add_argument(
+        "--corpus",
+        metavar="DIR",
+        help="writes the text of the dumped messages (without service "
+        "messages, empty texts or repeated forwards) as a corpus into DIR "
+        "and exits. Use with --format-contexts to only include some.",
+    )
+
+    parser.add_argument(
+        "--corpus-format",
+        default="jsonl",
+        choices=CORPUS_FORMATS,
+        help="jsonl (default) writes an object per message, text only its "
+        "text on a line.",
+    )
+
+    parser.add_argument(
+        "--corpus-gzip",
+        action="store_true",
+        help="compresses the corpus files with gzip.",
+    )
+
+    parser.add_argument(
+        "--corpus-shard-mb",
+        type=int,
+        default=256,
+        help="size in MB (before compression) after which the corpus "
+        "continues in a new file (default 256).",
+    )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="with --format, formats every message again instead of "
+        "appending the new ones to the output of the previous run.",
+    )
+
+    parser.add_argument(
+        "--format-workers",
+        type=int,
+        default=1,
+        help="number of processes formatting contexts in parallel with "
+        "--format (default 1, 0 for one per CPU).",
+    )
+
+    parser.add_argument(
+        "--reply-depth",
+        type=int,
+        default=1,
+        help="how many levels of a reply chain formatters resolve "
+        "for every message (default 1, 0 for none).",
+    )
+
     parser.add_argument(
         "--download-past-media",
         action="store_true",
@@ -153,6 +244,23 @@ def parse_args():
         "but not downloaded).",
     )
 
+    parser.add_argument(
+        "--takeout",
+        action="store_true",
+        help="export through a takeout session, which has more lenient "
+        "flood limits (Takeout in the config file does the same). "
+        "Telegram may ask to confirm it from another app first.",
+    )
+
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help="split the dialogs across this many worker processes, each "
+        "with its own session (see ShardSessions in the example config). "
+        "A single writer process owns the database.",
+    )
+
     parser.add_argument(
         "--proxy",
         type=str,
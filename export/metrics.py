@@ -0,0 +1,206 @@
+"""Counters, gauges and latency histograms describing an export run"""
+import bisect
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+PROMETHEUS_PREFIX = "telegram_export_"
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+
+
+def _key(name, labels):
+    """Return the ``name{label="value",...}`` key for a metric"""
+    if not labels:
+        return name
+    return "{}{{{}}}".format(
+        name, ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+    )
+
+
+class Histogram:
+    """A fixed-bucket histogram of observed values"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """Add a value to the histogram"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Return an estimate of the given quantile (0 to 1), which is the
+        upper bound of the bucket it falls in (or the maximum if it is
+        beyond the last bucket).
+        """
+        if not self.count:
+            return 0.0
+        wanted = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+            "buckets": dict(zip(map(str, self.buckets + ("+Inf",)), self.counts)),
+        }
+
+
+class Metrics:
+    """
+    A registry of named metrics. Every metric may have labels (given as
+    keyword arguments), and each combination of labels is kept apart.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter"""
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name, value, **labels):
+        """Set a gauge to the given value"""
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        """Add an observation (usually seconds) to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Observe the time spent in the with-block into a histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        Return a JSON-serializable dictionary with the current value of
+        every metric. Counters also have their average rate per second.
+        """
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            "time": time.time(),
+            "elapsed": elapsed,
+            "counters": {_key(n, dict(l)): v for (n, l), v in self.counters.items()},
+            "rates": {
+                _key(n, dict(l)): v / elapsed for (n, l), v in self.counters.items()
+            },
+            "gauges": {_key(n, dict(l)): v for (n, l), v in self.gauges.items()},
+            "histograms": {
+                _key(n, dict(l)): h.to_dict() for (n, l), h in self.histograms.items()
+            },
+        }
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = []
+        typed = set()
+
+        def add_type(kind, full_name):
+            # Only one TYPE line is allowed for every metric family
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append("# TYPE {} {}".format(full_name, kind))
+
+        def add(kind, name, labels, value):
+            full_name = PROMETHEUS_PREFIX + name
+            add_type(kind, full_name)
+            lines.append("{} {}".format(_key(full_name, labels), value))
+
+        for (name, labels), value in sorted(self.counters.items()):
+            add("counter", name, dict(labels), value)
+        for (name, labels), value in sorted(self.gauges.items()):
+            add("gauge", name, dict(labels), value)
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            labels = dict(labels)
+            full_name = PROMETHEUS_PREFIX + name
+            add_type("histogram", full_name)
+            cumulative = 0
+            for bound, count in zip(
+                histogram.buckets + ("+Inf",), histogram.counts
+            ):
+                cumulative += count
+                lines.append(
+                    "{} {}".format(
+                        _key(full_name + "_bucket", dict(labels, le=bound)),
+                        cumulative,
+                    )
+                )
+            lines.append(
+                "{} {}".format(_key(full_name + "_sum", labels), histogram.sum)
+            )
+            lines.append(
+                "{} {}".format(_key(full_name + "_count", labels), histogram.count)
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """
+        Atomically write a snapshot to the given file. Files ending in
+        ``.prom`` are written in the Prometheus textfile format, anything
+        else as JSON.
+        """
+        if filename.endswith(".prom"):
+            data = self.to_prometheus()
+        else:
+            data = json.dumps(self.snapshot(), indent=2)
+        tmp = "{}.tmp".format(filename)
+        with open(tmp, "w") as file:
+            file.write(data)
+        os.replace(tmp, filename)
+
+    def summary(self):
+        """Return a human-readable, multi-line summary of the run"""
+        elapsed = max(time.time() - self.started, 1e-9)
+        lines = ["Export metrics after {:.1f}s:".format(elapsed)]
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            lines.append(
+                "  {}: {} in {:.2f}s (mean {:.3f}s, p95 {:.3f}s, max {:.3f}s)".format(
+                    _key(name, dict(labels)),
+                    histogram.count,
+                    histogram.sum,
+                    histogram.sum / histogram.count if histogram.count else 0,
+                    histogram.quantile(0.95),
+                    histogram.max,
+                )
+            )
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(
+                "  {}: {:g} ({:.2f}/s)".format(
+                    _key(name, dict(labels)), value, value / elapsed
+                )
+            )
+        return "\n".join(lines)
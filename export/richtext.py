@@ -0,0 +1,256 @@
+"""
+Render message texts with their Formatting (the ``kind,offset,length[,extra]``
+entities joined by ``;`` that ``utils.encode_msg_entities`` stores) into
+HTML, Markdown or Org markup.
+
+The entities are parsed straight from the string, their UTF-16 offsets are
+converted in a single walk over the text, and the markup is produced in one
+pass over the entity boundaries, so rendering is linear in the length of
+the text (plus sorting the entities). Rendered texts are cached, since the
+same forwarded posts tend to appear in many chats.
+"""
+import bisect
+import functools
+import html
+import re
+from urllib.parse import urlsplit
+
+FORMATS = ("html", "markdown", "org")
+
+CACHE_SIZE = 16384
+
+# Markup to open and close every kind of entity, per format. Links are
+# handled separately, since they need the URL.
+MARKUP = {
+    "html": {
+        "bold": ("<b>", "</b>"),
+        "italic": ("<i>", "</i>"),
+        "code": ("<code>", "</code>"),
+        "pre": ("<pre>", "</pre>"),
+    },
+    "markdown": {
+        "bold": ("**", "**"),
+        "italic": ("_", "_"),
+        "code": ("`", "`"),
+        "pre": ("```\n", "\n```"),
+    },
+    "org": {
+        "bold": ("*", "*"),
+        "italic": ("/", "/"),
+        "code": ("~", "~"),
+    },
+}
+
+# Org has no inline markup for multi-line code, pre entities become blocks
+ORG_BLOCK = ("#+begin_src", "#+end_src")
+
+LINK_KINDS = ("texturl", "url", "mentionname")
+
+# Links to anything else (javascript:, data:, file:...) are left as text
+URL_SCHEMES = ("http", "https", "tg", "mailto")
+VERBATIM_KINDS = ("code", "pre")
+
+# Characters that take two UTF-16 code units
+ASTRAL = re.compile("[\U00010000-\U0010ffff]")
+
+MARKDOWN_SPECIAL = re.compile(r"([\\`*_\[\]()#+\-!<>~|])")
+
+# Lines Org would read as headlines or keywords
+ORG_SPECIAL_LINE = re.compile(r"^(?=\*|#\+)", re.M)
+
+
+def parse_formatting(formatting):
+    """
+    Return the ``(kind, offset, length, extra)`` tuples of an encoded
+    Formatting string, in UTF-16 code units like Telegram sends them.
+    """
+    if not formatting:
+        return []
+    entities = []
+    for part in formatting.split(";"):
+        kind, offset, length, *extra = part.split(",", 3)
+        length = int(length)
+        if length <= 0:
+            continue
+        extra = extra[0].replace("%2c", ",").replace("%3b", ";") if extra else None
+        entities.append((kind, int(offset), length, extra))
+    return entities
+
+
+def _utf16_to_index(text, offsets):
+    """
+    Return ``{utf16_offset: index}`` for the given UTF-16 offsets. Only the
+    characters outside the BMP (which take two code units) are looked up.
+    """
+    astral = [m.start() + i for i, m in enumerate(ASTRAL.finditer(text))]
+    if not astral:
+        return {offset: min(offset, len(text)) for offset in offsets}
+    return {
+        offset: min(offset - bisect.bisect_left(astral, offset), len(text))
+        for offset in offsets
+    }
+
+
+def _escape(fmt, text, verbatim, line_start=True):
+    """
+    Escape a piece of text, which comes right after a newline (or at the
+    start) if `line_start` is set.
+    """
+    if fmt == "html":
+        return html.escape(text, quote=False)
+    if fmt == "markdown" and not verbatim:
+        return MARKDOWN_SPECIAL.sub(r"\\\1", text)
+    if fmt == "org":
+        # Indent lines out of being headlines or keywords, or inside code
+        # blocks put a comma before them, like Org itself does
+        mark = "," if verbatim else " "
+        if line_start:
+            return ORG_SPECIAL_LINE.sub(mark, text)
+        first, newline, rest = text.partition("\n")
+        return first + newline + ORG_SPECIAL_LINE.sub(mark, rest)
+    return text
+
+
+def _safe_url(url):
+    """
+    Return the URL to link to, assuming http for URLs without a scheme
+    (like Telegram does), or None if its scheme is not in URL_SCHEMES.
+    """
+    url = url.strip()
+    try:
+        scheme = urlsplit(url).scheme.lower()
+    except ValueError:
+        return None
+    if not scheme:
+        if url.startswith("//") or ":" in url.split("/", 1)[0]:
+            return None
+        return "http://" + url
+    return url if scheme in URL_SCHEMES else None
+
+
+def _open(fmt, kind, extra, inner, line_start=True, line_end=True):
+    """
+    Return the (open, close) markup for an entity around `inner`, which
+    starts and ends lines if `line_start` and `line_end` are set.
+    """
+    if fmt == "org" and kind == "pre":
+        begin, end = ORG_BLOCK
+        if not inner.endswith("\n"):
+            end = "\n" + end
+        return (
+            ("" if line_start else "\n") + begin + "\n",
+            end + ("" if line_end else "\n"),
+        )
+    if kind in LINK_KINDS:
+        if kind == "url":
+            url = inner
+        elif kind == "mentionname":
+            url = "tg://user?id={}".format(extra)
+        else:
+            url = extra or ""
+        url = _safe_url(url)
+        if not url:
+            return "", ""
+        if fmt == "html":
+            return '<a href="{}">'.format(html.escape(url)), "</a>"
+        if fmt == "markdown":
+            if url == inner:
+                return "<", ">"
+            return "[", "]({})".format(url.replace(")", "%29"))
+        if url == inner:
+            return "", ""
+        return "[[{}][".format(url.replace("]", "%5D")), "]]"
+
+    markup = MARKUP[fmt].get(kind)
+    if not markup:
+        return "", ""
+    # Emphasis markers don't work next to whitespace in Markdown or Org
+    if fmt != "html" and (inner[:1].isspace() or inner[-1:].isspace()):
+        return "", ""
+    return markup
+
+
+def render(text, formatting, fmt="html"):
+    """
+    Render the text of a message with its encoded Formatting in the given
+    format ("html", "markdown" or "org"). The text is escaped as needed.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format {}".format(fmt))
+    if not text:
+        return ""
+    return _render(text, formatting or "", fmt)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _render(text, formatting, fmt):
+    entities = parse_formatting(formatting)
+    if not entities:
+        return _escape(fmt, text, False)
+
+    index = _utf16_to_index(text, {o for _, s, n, _ in entities for o in (s, s + n)})
+    # (start, end, kind, extra) in Python indices, outermost first
+    spans = sorted(
+        (
+            (index[offset], index[offset + length], kind, extra)
+            for kind, offset, length, extra in entities
+        ),
+        key=lambda span: (span[0], -span[1]),
+    )
+    spans = [span for span in spans if span[0] < span[1]]
+    boundaries = sorted({i for span in spans for i in span[:2]})
+
+    out = []
+    stack = []  # [(end, close, kind, opening)]
+    verbatim = 0
+    pos = 0
+    next_span = 0
+
+    def line_start():
+        last = next((piece for piece in reversed(out) if piece), "\n")
+        return last.endswith("\n")
+
+    for boundary in boundaries:
+        out.append(_escape(fmt, text[pos:boundary], verbatim, line_start()))
+        pos = boundary
+
+        # Close what ends here. An entity crossing another one that is
+        # still open is closed and reopened around it, so tags stay nested.
+        if any(end == boundary for end, _, _, _ in stack):
+            reopen = []
+            while stack and any(end == boundary for end, _, _, _ in stack):
+                end, close, kind, opening = stack.pop()
+                out.append(close)
+                if kind in VERBATIM_KINDS:
+                    verbatim -= 1
+                if end != boundary:
+                    reopen.append((end, close, kind, opening))
+            for entry in reversed(reopen):
+                out.append(entry[3])
+                stack.append(entry)
+                if entry[2] in VERBATIM_KINDS:
+                    verbatim += 1
+
+        while next_span < len(spans) and spans[next_span][0] == boundary:
+            start, end, kind, extra = spans[next_span]
+            next_span += 1
+            opening, close = _open(
+                fmt,
+                kind,
+                extra,
+                text[start:end],
+                line_start(),
+                end == len(text) or text[end] == "\n",
+            )
+            out.append(opening)
+            stack.append((end, close, kind, opening))
+            if kind in VERBATIM_KINDS:
+                verbatim += 1
+
+    out.append(_escape(fmt, text[pos:], verbatim, line_start()))
+    return "".join(out)
+
+
+def cache_info():
+    """Return the statistics of the rendering cache"""
+    return _render.cache_info()
@@ -0,0 +1,412 @@
+"""
+Run an export split across several worker processes, each one with its own
+Telegram session, feeding a single writer process which owns the database.
+
+Every worker acts on the dialogs with ``abs(peer_id) % shards == index`` and
+dumps them into its own shard database (which keeps resume information and
+lets the Downloader work unchanged). Whenever a worker commits, the rows it
+inserted are sent to the writer, which merges them into the main database,
+deduplicating Media and entities that several workers have seen and mapping
+the shard-local Media IDs to the final ones.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import signal
+import time
+
+from export.dumper import Dumper
+from export.exporter import Exporter
+from export.main_stuff import load_config, start_client
+from export.media import Media
+
+logger = logging.getLogger(__name__)
+
+# Tables whose rows are sent from the workers to the writer. Resume
+# information is private to every shard and never leaves its database.
+SHARED_TABLES = ("Message", "Media", "Forward", "User", "Channel")
+
+WRITER_QUEUE_SIZE = 64
+REPLY_TIMEOUT = 30
+
+
+def get_shard_sessions(config, shards):
+    """
+    Return a list of ``(session_name, phone_number)`` for every shard.
+
+    Session names come from ``ShardSessions`` (and phone numbers from
+    ``ShardPhoneNumbers``) in the TelegramAPI section. If no sessions
+    are configured, ``<SessionName>-<index>`` is used for all of them.
+    A phone number of None means the one from ``PhoneNumber``.
+    """
+    api = config["TelegramAPI"]
+    sessions = [x.strip() for x in api.get("ShardSessions", "").split(",") if x.strip()]
+    phones = [x.strip() for x in api.get("ShardPhoneNumbers", "").split(",")]
+    if not sessions:
+        sessions = ["{}-{}".format(api["SessionName"], i) for i in range(shards)]
+    if len(sessions) < shards:
+        raise ValueError(
+            "{} shards requested but only {} ShardSessions "
+            "configured".format(shards, len(sessions))
+        )
+    return [
+        (session, (phones[i] if i < len(phones) else None) or None)
+        for i, session in enumerate(sessions[:shards])
+    ]
+
+
+class ShardDumper(Dumper):
+    """
+    A Dumper for a shard worker. Rows are dumped into the shard database as
+    usual, and every commit also sends them to the writer process.
+    """
+
+    def __init__(self, config, shard, queue, replies):
+        """
+        `queue` is shared by all the workers and read by the writer,
+        `replies` is where the writer sends back this shard's Media IDs.
+        """
+        super().__init__(config)
+        self.shard = shard
+        self._queue = queue
+        self._replies = replies
+        self._outbox = []
+        self._global_media_ids = {}
+        # {local Media ID: [(temporary path, get_filename)]}
+        self._unnamed_files = {}
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ShardMedia("
+            "LocalID INT NOT NULL,"
+            "GlobalID INT NOT NULL,"
+            "PRIMARY KEY (LocalID))"
+        )
+
+    def check_self_user(self, self_id):
+        super().check_self_user(self_id)
+        self._outbox.append(("SelfInformation", (self_id,), None))
+
+    def get_file_media_id(self, media_id):
+        """
+        Files are named after the Media ID in the main database, which is
+        only known once the writer has merged the Media row. Until then,
+        None: the file is downloaded under a temporary name instead, and
+        renamed when the writer replies (see ``name_media_file``).
+        """
+        self._receive_media_ids()
+        return self._get_global_media_id(media_id)
+
+    def _get_global_media_id(self, media_id):
+        global_id = self._global_media_ids.get(media_id)
+        if global_id is None:
+            row = self.conn.execute(
+                "SELECT GlobalID FROM ShardMedia WHERE LocalID = ?", (media_id,)
+            ).fetchone()
+            if row:
+                global_id = self._global_media_ids[media_id] = row[0]
+        return global_id
+
+    def get_pending_file_media_id(self, media_id):
+        return "shard{}-{}".format(self.shard, media_id)
+
+    def name_media_file(self, media_id, path, get_filename):
+        self._unnamed_files.setdefault(media_id, []).append((path, get_filename))
+        self._name_files()
+
+    def _name_files(self):
+        """Rename the downloaded files whose Media ID is now known"""
+        for media_id in list(self._unnamed_files):
+            global_id = self._get_global_media_id(media_id)
+            if global_id is None:
+                continue
+            for path, get_filename in self._unnamed_files.pop(media_id):
+                filename = get_filename(global_id)
+                if os.path.isfile(filename):
+                    os.remove(path)  # another shard downloaded it already
+                else:
+                    os.replace(path, filename)
+
+    def wait_for_media_ids(self):
+        """
+        Send what is left to the writer and wait (up to REPLY_TIMEOUT) until
+        every downloaded file could be given its final name. Returns whether
+        they all were.
+        """
+        self.commit()
+        deadline = time.time() + REPLY_TIMEOUT
+        try:
+            while self._unnamed_files:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._receive_media_ids(timeout=remaining):
+                    logger.warning(
+                        "The writer did not report the IDs of media %s, their "
+                        "files keep their temporary names",
+                        sorted(self._unnamed_files),
+                    )
+                    return False
+            return True
+        finally:
+            self.conn.commit()  # the ShardMedia rows received meanwhile
+
+    def _receive_media_ids(self, timeout=None):
+        """
+        Store the Media ID mappings the writer has sent back, waiting up to
+        `timeout` seconds for the first one. Returns whether any arrived.
+        """
+        received = False
+        while True:
+            try:
+                if timeout and not received:
+                    media_ids = self._replies.get(timeout=timeout)
+                else:
+                    media_ids = self._replies.get_nowait()
+            except queue_module.Empty:
+                return received
+            received = True
+            self._global_media_ids.update(media_ids)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ShardMedia VALUES (?,?)", media_ids.items()
+            )
+            self._name_files()
+
+    def _insert(self, into, values):
+        rowid = super()._insert(into, values)
+        if into in SHARED_TABLES:
+            self._outbox.append((into, values, rowid))
+        return rowid
+
+    def commit(self):
+        self._receive_media_ids()
+        super().commit()
+        if self._outbox:
+            self._queue.put((self.shard, self._outbox))
+            self._outbox = []
+
+
+class ShardWriter:
+    """
+    Merges the rows sent by the shard workers into the Dumper's database.
+    """
+
+    def __init__(self, dumper):
+        self.dumper = dumper
+        self._media_ids = {}
+        self.dumper.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ShardMedia("
+            "Shard INT NOT NULL,"
+            "LocalID INT NOT NULL,"
+            "GlobalID INT NOT NULL,"
+            "PRIMARY KEY (Shard, LocalID))"
+        )
+
+    def _get_media_id(self, shard, local_id):
+        """Map a shard-local Media ID to the ID in the main database"""
+        if local_id is None:
+            return None
+        global_id = self._media_ids.get((shard, local_id))
+        if global_id is None:
+            row = self.dumper.conn.execute(
+                "SELECT GlobalID FROM ShardMedia WHERE Shard = ? AND LocalID = ?",
+                (shard, local_id),
+            ).fetchone()
+            if not row:
+                logger.warning("Unknown media %s from shard %s", local_id, shard)
+                return None
+            global_id = self._media_ids[(shard, local_id)] = row[0]
+        return global_id
+
+    def _dump_media(self, shard, local_id, values):
+        """
+        Dump a Media row through the Dumper, so that media already
+        dumped by another shard is reused instead of duplicated.
+        """
+        row = Media(
+            name=values[1],
+            mime_type=values[2],
+            size=values[3],
+            thumbnail_id=self._get_media_id(shard, values[4]),
+            type=values[5],
+            local_id=values[6],
+            volume_id=values[7],
+            secret=values[8],
+            file_reference=values[9],
+            access_hash=values[10],
+            id=values[11],
+            extra=values[12],
+        )
+        global_id = self.dumper.commit_media(row)
+        self._media_ids[(shard, local_id)] = global_id
+        self.dumper.conn.execute(
+            "INSERT OR REPLACE INTO ShardMedia VALUES (?,?,?)",
+            (shard, local_id, global_id),
+        )
+        return global_id
+
+    def write(self, shard, rows):
+        """
+        Write the ``(table, values, local_row_id)`` rows sent by a shard
+        and commit them. Returns the ``{local: global}`` Media IDs of the
+        media rows that were written.
+        """
+        media_ids = {}
+        forward_ids = {}
+        for table, values, local_id in rows:
+            if table == "Media":
+                media_ids[local_id] = self._dump_media(shard, local_id, values)
+            elif table == "Forward":
+                forward_ids[local_id] = self.dumper._insert("Forward", values)
+            elif table == "Message":
+                values = list(values)
+                values[6] = forward_ids.get(values[6])
+                values[9] = self._get_media_id(shard, values[9])
+                self.dumper._insert("Message", tuple(values))
+            elif table == "User":
+                values = values[:9] + (self._get_media_id(shard, values[9]),)
+                self.dumper._insert_if_valid_date(
+                    "User", values, date_column=1, where=("ID", values[0])
+                )
+            elif table == "Channel":
+                values = (
+                    values[:5] + (self._get_media_id(shard, values[5]),) + values[6:]
+                )
+                self.dumper._insert_if_valid_date(
+                    "Channel", values, date_column=1, where=("ID", values[0])
+                )
+            elif table == "SelfInformation":
+                cur = self.dumper.conn.execute("SELECT UserID FROM SelfInformation")
+                if not cur.fetchone():
+                    self.dumper._insert("SelfInformation", values)
+        self.dumper.commit()
+        return media_ids
+
+
+def _writer_main(config_file, queue, replies, shards):
+    """Entry point of the writer process"""
+    # Interrupting the export should let the workers flush what they have,
+    # so the writer keeps going until every one of them is done.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    config = load_config(config_file)
+    writer = ShardWriter(Dumper(config["Dumper"]))
+    finished = set()
+    while len(finished) < shards:
+        shard, rows = queue.get()
+        if rows is None:
+            finished.add(shard)
+            continue
+        media_ids = writer.write(shard, rows)
+        if media_ids:
+            replies[shard].put(media_ids)
+    logger.info(writer.dumper.metrics.summary())
+    writer.dumper.conn.close()
+
+
+async def _run_worker(
+    config, dumper, shard, shards, loop, proxy, past_media, takeout
+):
+    """Run the Exporter of a single shard"""
+    session, phone = get_shard_sessions(config, shards)[shard]
+    client = await start_client(
+        config, loop, proxy=proxy, session_name=session, phone=phone
+    )
+    exporter = Exporter(
+        client, config, dumper, loop, shard=(shard, shards), takeout=takeout
+    )
+    try:
+        if past_media:
+            await exporter.download_past_media()
+        else:
+            await exporter.start()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        dumper.wait_for_media_ids()
+        await exporter.close()
+
+
+def _worker_main(
+    config_file, shard, shards, queue, replies, contexts, proxy, past_media, takeout
+):
+    """Entry point of a shard worker process"""
+    config = load_config(config_file)
+    dumper_config = config["Dumper"]
+    if dumper_config["DBFileName"] != ":memory:":
+        dumper_config["DBFileName"] = "{}-shard{}".format(
+            dumper_config["DBFileName"], shard
+        )
+    if contexts:
+        dumper_config["Whitelist"] = contexts
+    if dumper_config.get("MetricsFile"):
+        name, ext = os.path.splitext(dumper_config["MetricsFile"])
+        dumper_config["MetricsFile"] = "{}-shard{}{}".format(name, shard, ext)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        dumper = ShardDumper(dumper_config, shard, queue, replies)
+        loop.run_until_complete(
+            _run_worker(
+                config, dumper, shard, shards, loop, proxy, past_media, takeout
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.put((shard, None))
+        loop.close()
+
+
+def run_sharded(
+    config_file, shards, contexts=None, proxy=None, past_media=False, takeout=False
+):
+    """
+    Run a sharded export with the given number of worker processes and
+    wait for it to finish. Returns a non-zero value if any worker failed.
+
+    Every session must have been authorised beforehand (e.g. by running a
+    normal export once with it), since workers cannot prompt for codes.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue(maxsize=WRITER_QUEUE_SIZE)
+    replies = [ctx.Queue() for _ in range(shards)]
+    writer = ctx.Process(
+        target=_writer_main,
+        args=(config_file, queue, replies, shards),
+        name="export-writer",
+    )
+    writer.start()
+    workers = [
+        ctx.Process(
+            target=_worker_main,
+            args=(
+                config_file,
+                i,
+                shards,
+                queue,
+                replies,
+                contexts,
+                proxy,
+                past_media,
+                takeout,
+            ),
+            name="export-shard{}".format(i),
+        )
+        for i in range(shards)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        # Workers might still be flushing after an interrupt. Only once all
+        # of them are gone it is safe to tell the writer to stop for those
+        # that died without saying goodbye (it ignores repeated goodbyes).
+        for worker in workers:
+            worker.join()
+        for i in range(shards):
+            queue.put((i, None))
+        writer.join()
+
+    return max(worker.exitcode or 0 for worker in workers)
@@ -0,0 +1,188 @@
+import configparser
+import datetime
+import os
+import tempfile
+import unittest
+
+from export.dumper import Dumper
+from export.formatters import NAME_TO_FORMATTER
+from export.formatters.baseformatter import BaseFormatter
+from export.formatting import format_parallel
+
+CHANNEL_ID = -1001000000000
+
+
+class Formatter(BaseFormatter):
+    @staticmethod
+    def name():
+        return "test"
+
+    def _format(self, context_id, file, *args, **kwargs):
+        pass
+
+
+def make_dumper(output_directory=None):
+    config = configparser.ConfigParser()
+    if output_directory:
+        config.read_dict(
+            {"Dumper": {"DBFileName": "export", "OutputDirectory": output_directory}}
+        )
+    else:
+        config.read_dict({"Dumper": {"DBFileName": ":memory:"}})
+    dumper = Dumper(config["Dumper"])
+    dumper.check_self_user(1)
+    # Two snapshots of the channel and of every user, at 100 and 200
+    for date, suffix in ((100, "old"), (200, "new")):
+        dumper._insert(
+            "Channel",
+            (CHANNEL_ID, date, None, "Channel " + suffix, None, None, None),
+        )
+        for user_id in range(10, 20):
+            dumper._insert(
+                "User",
+                (user_id, date, "User", suffix, None, None, None, 0, 0, None),
+            )
+    # Every message replies to the previous one
+    for msg_id in range(1, 101):
+        dumper._insert(
+            "Message",
+            (msg_id, CHANNEL_ID, 150 + msg_id, 10 + msg_id % 10, "Hi",
+             msg_id - 1 or None, None, None, None, None, None, None),
+        )
+    dumper.commit()
+    return dumper
+
+
+class TestBaseFormatter(unittest.TestCase):
+
+    def setUp(self):
+        self.dumper = make_dumper()
+        self.formatter = Formatter(self.dumper.conn)
+
+    def tearDown(self):
+        self.dumper.conn.close()
+
+    def test_get_user_at_date(self):
+        self.assertEqual(self.formatter.get_user(10).last_name, "new")
+        self.assertEqual(self.formatter.get_user(10, at_date=150).last_name, "old")
+        self.assertEqual(self.formatter.get_user(10, at_date=200).last_name, "new")
+        # Before any snapshot, the earliest one is the best guess
+        self.assertEqual(self.formatter.get_user(10, at_date=50).last_name, "old")
+        self.assertEqual(
+            self.formatter.get_user(10).date_updated,
+            datetime.datetime.fromtimestamp(200),
+        )
+        self.assertIsNone(self.formatter.get_user(99))
+
+    def test_get_entity(self):
+        self.assertEqual(self.formatter.get_display_name(CHANNEL_ID), "Channel new")
+        self.assertEqual(
+            self.formatter.get_channel(CHANNEL_ID, at_date=199).title, "Channel old"
+        )
+
+    def test_entities_loaded_once(self):
+        queries = []
+        self.dumper.conn.set_trace_callback(queries.append)
+        messages = list(self.formatter.get_messages_from_context(CHANNEL_ID))
+        self.assertEqual(len(messages), 100)
+        self.assertEqual(messages[0].from_user.last_name, "new")
+        self.assertEqual(messages[0].context.title, "Channel new")
+        # The messages, their replies, the users of the context
+        # and the context itself
+        self.assertEqual(len(queries), 4)
+
+        queries.clear()
+        self.formatter.clear_cache()
+        self.formatter.get_user(10)
+        self.assertEqual(len(queries), 1)
+
+    def test_reply_depth(self):
+        messages = list(self.formatter.get_messages_from_context(CHANNEL_ID))
+        self.assertEqual(messages[0].reply_message.id, 99)
+        self.assertIsNone(messages[0].reply_message.reply_message)
+        self.assertIsNone(messages[-1].reply_message)
+
+        formatter = Formatter(self.dumper.conn, reply_depth=3)
+        queries = []
+        self.dumper.conn.set_trace_callback(queries.append)
+        message = formatter.get_message_by_id(CHANNEL_ID, 50)
+        self.assertEqual(message.reply_message.reply_message.reply_message.id, 47)
+        self.assertIsNone(message.reply_message.reply_message.reply_message.reply_message)
+        # The message and one query per level of replies (plus entities)
+        self.assertEqual(sum(q.count("FROM Message") for q in queries), 4)
+
+        formatter = Formatter(self.dumper.conn, reply_depth=0)
+        self.assertIsNone(formatter.get_message_by_id(CHANNEL_ID, 50).reply_message)
+
+    def test_iter_message_rows(self):
+        queries = []
+        self.dumper.conn.set_trace_callback(queries.append)
+        rows = list(
+            self.formatter.iter_message_rows(
+                CHANNEL_ID, columns=("id", "text"), batch_size=30
+            )
+        )
+        self.assertEqual([row.id for row in rows], list(range(1, 101)))
+        self.assertEqual(rows[0]._fields, ("id", "text"))
+        self.assertEqual(len(queries), 4)
+        self.assertFalse(any("User" in q or "Channel" in q for q in queries))
+
+        # Resume after the 40th message, in both directions
+        rows = self.formatter.iter_message_rows(CHANNEL_ID, after=(190, 40))
+        self.assertEqual(next(rows).id, 41)
+        rows = self.formatter.iter_message_rows(
+            CHANNEL_ID, columns=("id",), after=(190, 40), order="DESC"
+        )
+        self.assertEqual(next(rows).id, 39)
+
+
+class TestFormatParallel(unittest.TestCase):
+
+    def test_format_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dumper = make_dumper(tmp)
+            dumper.conn.close()
+            output = os.path.join(tmp, "text")
+            os.mkdir(output)
+            format_parallel(dumper.db_path, "text", output, workers=2)
+            with open(os.path.join(output, str(CHANNEL_ID))) as file:
+                lines = file.read().splitlines()
+        self.assertEqual(lines[0], '== Conversation with "Channel new" ==')
+        self.assertEqual(len(lines), 101)
+
+
+class TestWatermarks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dumper = make_dumper(self.tmp.name)
+        self.output = os.path.join(self.tmp.name, "text")
+        os.mkdir(self.output)
+
+    def tearDown(self):
+        self.dumper.conn.close()
+        self.tmp.cleanup()
+
+    def format(self, **kwargs):
+        formatter = NAME_TO_FORMATTER["text"](self.dumper.db_path)
+        formatter.format(CHANNEL_ID, self.output, **kwargs)
+        formatter.dbconn.close()
+        with open(os.path.join(self.output, str(CHANNEL_ID))) as file:
+            return file.read().splitlines()
+
+    def test_append(self):
+        self.assertEqual(len(self.format()), 101)
+        self.assertEqual(len(self.format()), 101)
+
+        self.dumper._insert(
+            "Message",
+            (101, CHANNEL_ID, 300, 10, "Later", None, None, None, None, None,
+             None, None),
+        )
+        self.dumper.commit()
+        lines = self.format()
+        self.assertEqual(len(lines), 102)
+        self.assertTrue(lines[-1].endswith("Later"))
+        self.assertEqual(sum(line.startswith("==") for line in lines), 1)
+
+        self.assertEqual(self.format(full=True), lines)
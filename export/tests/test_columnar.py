@@ -0,0 +1,80 @@
+import array
+import json
+import os
+import tempfile
+import unittest
+
+from benchmarks.synthetic import make_database
+from export.columnar import ColumnarReader, export_columnar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TestColumnar(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dumper = make_database(self.tmp.name, channels=2, messages=300)
+        self.directory = os.path.join(self.tmp.name, "columnar")
+        self.schema = export_columnar(self.dumper.conn, self.directory, chunk_rows=64)
+
+    def tearDown(self):
+        self.dumper.conn.close()
+        self.tmp.cleanup()
+
+    def read(self, table, filename, typecode):
+        values = array.array(typecode)
+        with open(os.path.join(self.directory, table, filename), "rb") as file:
+            values.frombytes(file.read())
+        return values
+
+    def test_columns(self):
+        conn = self.dumper.conn
+        self.assertEqual(self.schema["tables"]["Message"]["rows"], 600)
+
+        rows = conn.execute(
+            "SELECT MediaID, Message, ServiceAction FROM Message ORDER BY rowid"
+        ).fetchall()
+        media = self.read("Message", "MediaID.bin", "q")
+        nulls = self.read("Message", "MediaID.nulls.bin", "B")
+        self.assertEqual(
+            [None if null else value for value, null in zip(media, nulls)],
+            [row[0] for row in rows],
+        )
+
+        offsets = self.read("Message", "Message.offsets.bin", "q")
+        with open(os.path.join(self.directory, "Message", "Message.data.bin"), "rb") as f:
+            data = f.read()
+        texts = [
+            data[start:end].decode("utf-8")
+            for start, end in zip(offsets, offsets[1:])
+        ]
+        self.assertEqual(texts, [row[1] or "" for row in rows])
+
+        with open(
+            os.path.join(self.directory, "Message", "ServiceAction.dict.json")
+        ) as file:
+            dictionary = json.load(file)
+        codes = self.read("Message", "ServiceAction.bin", "i")
+        self.assertEqual(
+            [None if code < 0 else dictionary[code] for code in codes],
+            [row[2] for row in rows],
+        )
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_reader(self):
+        reader = ColumnarReader(self.directory)
+        views = reader.array("Message", "ViewCount")
+        self.assertEqual(
+            int(views.sum()),
+            self.dumper.conn.execute("SELECT SUM(ViewCount) FROM Message").fetchone()[0],
+        )
+        self.assertEqual(
+            int(reader.nulls("Message", "MediaID").sum()),
+            self.dumper.conn.execute(
+                "SELECT COUNT(*) FROM Message WHERE MediaID IS NULL"
+            ).fetchone()[0],
+        )
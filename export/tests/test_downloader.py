@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from benchmarks.fake_client import FakeClient
+from benchmarks.ingest import make_config, no_delays, run
+from export.downloader import Downloader
+from export.dumper import Dumper
+
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_export_fake_channels(self):
+        client = FakeClient(
+            channels=2,
+            messages=250,
+            media_ratio=0.2,
+            media_size=4096,
+            flood_rate=0.05,
+            flood_seconds=0,
+        )
+        result = run(client, self.tmp.name)
+        self.assertEqual(result["messages"], 500)
+
+        conn = sqlite3.connect(os.path.join(self.tmp.name, "export.db"))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM Message").fetchone()[0], 500)
+        self.assertEqual(
+            conn.execute("SELECT COUNT(DISTINCT ID) FROM Channel").fetchone()[0],
+            2,
+        )
+        with_media = conn.execute(
+            "SELECT COUNT(*) FROM Message WHERE MediaID IS NOT NULL"
+        ).fetchone()[0]
+        conn.close()
+
+        downloaded = [
+            name
+            for _, _, files in os.walk(os.path.join(self.tmp.name, "usermedia"))
+            for name in files
+        ]
+        self.assertEqual(len(downloaded), with_media)
+
+    def test_thumbnails_first(self):
+        client = FakeClient(channels=1, messages=100, media_ratio=0.3, media_size=4096)
+        run(client, self.tmp.name, thumbnails_first=True)
+
+        conn = sqlite3.connect(os.path.join(self.tmp.name, "export.db"))
+        with_media = conn.execute(
+            "SELECT COUNT(*) FROM Message WHERE MediaID IS NOT NULL"
+        ).fetchone()[0]
+        conn.close()
+
+        downloaded = [
+            name
+            for _, _, files in os.walk(os.path.join(self.tmp.name, "usermedia"))
+            for name in files
+        ]
+        thumbs = [name for name in downloaded if name.endswith(".thumb.jpg")]
+        self.assertEqual(len(thumbs), with_media)
+        self.assertEqual(len(downloaded), 2 * with_media)
+
+    def test_promote_media(self):
+        config = make_config(self.tmp.name, thumbnails_first=True)
+        dumper = Dumper(config["Dumper"])
+
+        async def enqueue():
+            downloader = Downloader(
+                FakeClient(), config["Dumper"], dumper, asyncio.get_running_loop()
+            )
+            for media_id in range(1, 4):
+                downloader.enqueue_media(media_id, 1, 2, 0)
+            self.assertTrue(downloader.promote_media(3))
+            self.assertFalse(downloader.promote_media(42))
+
+            order = []
+            while not downloader._media_queue.empty():
+                _, _, thumbnail, item = downloader._media_queue.get_nowait()
+                order.append((item[0], thumbnail))
+            return order
+
+        order = asyncio.run(enqueue())
+        dumper.conn.close()
+        self.assertEqual(
+            order,
+            [(3, False), (1, True), (2, True), (3, True), (1, False), (2, False),
+             (3, False)],
+        )
+
+    def test_promoted_media_downloaded_once(self):
+        config = make_config(self.tmp.name)
+        dumper = Dumper(config["Dumper"])
+        client = FakeClient(channels=1, media_ratio=1, media_size=1024)
+        channel = next(iter(client.channels.values()))
+        media_ids = [
+            dumper.dump_media(client._make_message(channel, i).media)
+            for i in range(1, 4)
+        ]
+
+        async def download():
+            downloader = Downloader(
+                client, config["Dumper"], dumper, asyncio.get_running_loop()
+            )
+            downloads = []
+            download_media = downloader._download_media
+
+            async def record(media_id, *args, **kwargs):
+                downloads.append(media_id)
+                return await download_media(media_id, *args, **kwargs)
+
+            downloader._download_media = record
+            for media_id in media_ids:
+                downloader.enqueue_media(media_id, channel.id, channel.id, 0)
+            self.assertTrue(downloader.promote_media(media_ids[-1]))
+
+            downloader._running = True
+            bar = SimpleNamespace(total=0, update=lambda n: None)
+            consumer = asyncio.ensure_future(
+                downloader._media_consumer(downloader._media_queue, bar)
+            )
+            await downloader._media_queue.join()
+            consumer.cancel()
+            return downloads
+
+        with no_delays():
+            downloads = asyncio.run(download())
+        dumper.conn.close()
+        self.assertEqual(downloads, [media_ids[-1]] + media_ids[:-1])
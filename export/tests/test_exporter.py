@@ -0,0 +1,111 @@
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from benchmarks.fake_client import FakeClient
+from benchmarks.ingest import make_config, no_delays
+from export.dumper import Dumper
+from export.exporter import Exporter
+
+
+class TakeoutClient(FakeClient):
+    """
+    A FakeClient that can start takeout sessions, recording the scopes each
+    was started with and whether it was finalized as successful.
+    """
+
+    def __init__(self, *args, takeout_id=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = SimpleNamespace(takeout_id=takeout_id)
+        self.takeouts = []
+        self.finalized = []
+
+    def takeout(self, finalize=True, **scopes):
+        self.takeouts.append(scopes)
+        return _Takeout(self, finalize)
+
+
+class _Takeout:
+    def __init__(self, client, finalize):
+        self.client = client
+        self.finalize = finalize
+
+    async def __aenter__(self):
+        self.client.session.takeout_id = 1
+        return self.client
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.finalize:
+            self.client.finalized.append(exc_type is None)
+            self.client.session.takeout_id = None
+        return False
+
+
+class TestTakeout(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = make_config(self.tmp.name)
+        self.dumper = Dumper(self.config["Dumper"])
+
+    def tearDown(self):
+        self.dumper.conn.close()
+        self.tmp.cleanup()
+
+    def run_exporter(self, client, method=None):
+        async def run():
+            exporter = Exporter(
+                client,
+                self.config,
+                self.dumper,
+                asyncio.get_running_loop(),
+                takeout=True,
+            )
+            try:
+                if method:
+                    return await exporter._run(method)
+                return await exporter.start()
+            finally:
+                self.assertIs(exporter.client, client)
+                self.assertIs(exporter.downloader.client, client)
+
+        with no_delays():
+            return asyncio.run(run())
+
+    def test_finalize_on_success(self):
+        client = TakeoutClient(channels=1, messages=20)
+        self.run_exporter(client)
+        self.assertEqual(client.finalized, [True])
+        self.assertEqual(len(client.takeouts), 1)
+        self.assertTrue(client.takeouts[0]["channels"])
+        count = self.dumper.conn.execute("SELECT COUNT(*) FROM Message").fetchone()
+        self.assertEqual(count[0], 20)
+
+    def test_finalize_unsuccessful_on_error(self):
+        client = TakeoutClient(channels=1, messages=20)
+
+        async def fail():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            self.run_exporter(client, fail)
+        self.assertEqual(client.finalized, [False])
+
+    def test_finalize_unsuccessful_on_cancel(self):
+        client = TakeoutClient(channels=1, messages=20)
+
+        async def cancel():
+            raise asyncio.CancelledError
+
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_exporter(client, cancel)
+        self.assertEqual(client.finalized, [False])
+
+    def test_resume(self):
+        client = TakeoutClient(channels=1, messages=20, takeout_id=42)
+        self.run_exporter(client)
+        # The unfinished session is picked up as is, without asking again
+        # for the data it needs access to
+        self.assertEqual(client.takeouts, [{}])
+        self.assertEqual(client.finalized, [True])
@@ -0,0 +1,158 @@
+import datetime
+import os
+import re
+import sqlite3
+import tempfile
+import unittest
+from urllib.parse import unquote
+
+from benchmarks.fake_client import FakeClient
+from benchmarks.ingest import make_config, run
+from export.formatters import HtmlFormatter
+
+
+class TestHtmlFormatter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        run(FakeClient(channels=1, messages=120, media_ratio=0.2), self.tmp.name)
+        self.db = os.path.join(self.tmp.name, "export.db")
+        self.config = make_config(self.tmp.name)["Dumper"]
+        conn = sqlite3.connect(self.db)
+        self.context_id = conn.execute("SELECT ContextID FROM Message").fetchone()[0]
+        conn.close()
+        self.site = os.path.join(self.tmp.name, "html", str(self.context_id))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def generate(self):
+        formatter = HtmlFormatter(self.db, config=self.config, page_size=50)
+        try:
+            return formatter.generate_site(self.context_id, self.tmp.name)
+        finally:
+            formatter.dbconn.close()
+
+    def test_site(self):
+        self.assertEqual(self.generate(), 3)
+        self.assertEqual(
+            sorted(os.listdir(self.site)),
+            [
+                "2020-01-2.html",
+                "2020-01-3.html",
+                "2020-01.html",
+                "index.html",
+                "manifest.json",
+            ],
+        )
+        with open(os.path.join(self.site, "2020-01.html")) as file:
+            page = file.read()
+        self.assertIn('href="2020-01-2.html"', page)
+
+        links = re.findall(r'<img src="([^"]+)"', page)
+        self.assertTrue(links)
+        for link in links:
+            path = os.path.join(self.site, unquote(link))
+            self.assertTrue(os.path.isfile(path), link)
+
+    def test_incremental(self):
+        self.generate()
+        self.assertEqual(self.generate(), 0)
+
+        conn = sqlite3.connect(self.db)
+        date = datetime.datetime(2020, 3, 1, tzinfo=datetime.timezone.utc)
+        conn.execute(
+            "INSERT INTO Message (ID, ContextID, Date, Message) VALUES (?, ?, ?, ?)",
+            (1000, self.context_id, date.timestamp(), "Later"),
+        )
+        conn.commit()
+        conn.close()
+
+        modified = os.path.getmtime(os.path.join(self.site, "2020-01.html"))
+        self.assertEqual(self.generate(), 1)
+        self.assertEqual(
+            os.path.getmtime(os.path.join(self.site, "2020-01.html")), modified
+        )
+        with open(os.path.join(self.site, "index.html")) as file:
+            self.assertIn('href="2020-03.html"', file.read())
+
+    def test_incremental_pages(self):
+        self.generate()
+        conn = sqlite3.connect(self.db)
+        date = conn.execute("SELECT MAX(Date) FROM Message").fetchone()[0]
+        conn.execute(
+            "INSERT INTO Message (ID, ContextID, Date, Message) VALUES (?, ?, ?, ?)",
+            (1000, self.context_id, date + 60, "Later"),
+        )
+        conn.commit()
+        conn.close()
+
+        modified = os.path.getmtime(os.path.join(self.site, "2020-01.html"))
+        # Only the last (and new) pages of the month are written again
+        self.assertEqual(self.generate(), 1)
+        self.assertEqual(
+            os.path.getmtime(os.path.join(self.site, "2020-01.html")), modified
+        )
+        with open(os.path.join(self.site, "2020-01-3.html")) as file:
+            self.assertIn('id="m1000"', file.read())
+
+    def test_reply_links(self):
+        conn = sqlite3.connect(self.db)
+        first, last = conn.execute(
+            "SELECT MIN(ID), MAX(ID) FROM Message WHERE ContextID = ?",
+            (self.context_id,),
+        ).fetchone()
+        date = datetime.datetime(2020, 3, 1, tzinfo=datetime.timezone.utc)
+        conn.executemany(
+            "INSERT INTO Message (ID, ContextID, Date, Message, ReplyMessageID)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [
+                (1000, self.context_id, date.timestamp(), "Reply", first),
+                (1001, self.context_id, date.timestamp() + 1, "Reply", 1000),
+            ],
+        )
+        conn.execute(
+            "UPDATE Message SET ReplyMessageID = ? WHERE ID = ?", (first, last)
+        )
+        conn.commit()
+        conn.close()
+        self.generate()
+
+        with open(os.path.join(self.site, "2020-01-3.html")) as file:
+            self.assertIn('href="2020-01.html#m{}"'.format(first), file.read())
+        with open(os.path.join(self.site, "2020-03.html")) as file:
+            page = file.read()
+        self.assertIn('href="2020-01.html#m{}"'.format(first), page)
+        self.assertIn('href="2020-03.html#m1000"', page)
+
+    def test_reply_links_moved(self):
+        conn = sqlite3.connect(self.db)
+        first_date, last = conn.execute(
+            "SELECT MIN(Date), MAX(ID) FROM Message WHERE ContextID = ?",
+            (self.context_id,),
+        ).fetchone()
+        date = datetime.datetime(2020, 3, 1, tzinfo=datetime.timezone.utc)
+        conn.execute(
+            "INSERT INTO Message (ID, ContextID, Date, Message, ReplyMessageID)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (1000, self.context_id, date.timestamp(), "Reply", last),
+        )
+        conn.commit()
+        self.generate()
+        with open(os.path.join(self.site, "2020-03.html")) as file:
+            self.assertIn('href="2020-01-3.html#m{}"'.format(last), file.read())
+
+        # Older messages of January push the replied one to a later page,
+        # so March is written again even if it did not change
+        conn.executemany(
+            "INSERT INTO Message (ID, ContextID, Date, Message) VALUES (?, ?, ?, ?)",
+            [
+                (2000 + i, self.context_id, first_date - 60 + i, "Earlier")
+                for i in range(40)
+            ],
+        )
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.generate(), 4 + 1)  # every page of January
+        with open(os.path.join(self.site, "2020-03.html")) as file:
+            self.assertIn('href="2020-01-4.html#m{}"'.format(last), file.read())
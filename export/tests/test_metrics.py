@@ -0,0 +1,128 @@
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+from telethon.tl import functions
+
+from benchmarks.fake_client import FakeClient
+from benchmarks.ingest import make_config
+from export.downloader import Downloader
+from export.dumper import Dumper
+from export.metrics import Histogram, Metrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_quantile(self):
+        histogram = Histogram(buckets=(1, 2, 5))
+        self.assertEqual(histogram.quantile(0.5), 0.0)
+        for value in (0.5, 0.5, 1.5, 3, 4):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 2, 0])
+        self.assertEqual(histogram.quantile(0.4), 1)
+        self.assertEqual(histogram.quantile(0.5), 2)
+        # The bound of the last bucket is past every observation
+        self.assertEqual(histogram.quantile(0.95), 4)
+
+    def test_quantile_beyond_buckets(self):
+        histogram = Histogram(buckets=(1,))
+        histogram.observe(0.5)
+        histogram.observe(7)
+        self.assertEqual(histogram.counts, [1, 1])
+        self.assertEqual(histogram.quantile(0.5), 1)
+        self.assertEqual(histogram.quantile(1), 7)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_to_prometheus(self):
+        metrics = Metrics()
+        metrics.inc("messages_total", 3, context="1")
+        metrics.inc("messages_total", context="2")
+        metrics.set("queue_depth", 5, queue="media")
+        metrics.histograms[("request_seconds", (("request", "Get"),))] = Histogram(
+            buckets=(0.1, 1)
+        )
+        metrics.observe("request_seconds", 0.05, request="Get")
+        metrics.observe("request_seconds", 2, request="Get")
+
+        self.assertEqual(
+            metrics.to_prometheus(),
+            "# TYPE telegram_export_messages_total counter\n"
+            'telegram_export_messages_total{context="1"} 3.0\n'
+            'telegram_export_messages_total{context="2"} 1.0\n'
+            "# TYPE telegram_export_queue_depth gauge\n"
+            'telegram_export_queue_depth{queue="media"} 5\n'
+            "# TYPE telegram_export_request_seconds histogram\n"
+            'telegram_export_request_seconds_bucket{le="0.1",request="Get"} 1\n'
+            'telegram_export_request_seconds_bucket{le="1",request="Get"} 1\n'
+            'telegram_export_request_seconds_bucket{le="+Inf",request="Get"} 2\n'
+            'telegram_export_request_seconds_sum{request="Get"} 2.05\n'
+            'telegram_export_request_seconds_count{request="Get"} 2\n',
+        )
+
+    def test_to_prometheus_histogram_labels(self):
+        metrics = Metrics()
+        metrics.observe("request_seconds", 0.05, request="Get")
+        metrics.observe("request_seconds", 0.5, request="Send")
+        text = metrics.to_prometheus()
+        self.assertEqual(
+            text.count("# TYPE telegram_export_request_seconds histogram\n"), 1
+        )
+        self.assertTrue(text.startswith("# TYPE "))
+        self.assertIn('telegram_export_request_seconds_count{request="Get"} 1\n', text)
+        self.assertIn('telegram_export_request_seconds_count{request="Send"} 1\n', text)
+
+
+class TestRequestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = make_config(self.tmp.name)
+        self.dumper = Dumper(self.config["Dumper"])
+
+    def tearDown(self):
+        self.dumper.conn.close()
+        self.tmp.cleanup()
+
+    def test_flood_wait_retry(self):
+        client = FakeClient(channels=1, flood_rate=0.5, flood_seconds=3, seed=1)
+        channel = next(iter(client.channels.values()))
+        sleeps = []
+
+        async def sleep(delay):
+            sleeps.append(delay)
+
+        async def request():
+            downloader = Downloader(
+                client, self.config["Dumper"], self.dumper, asyncio.get_running_loop()
+            )
+            with mock.patch("asyncio.sleep", sleep):
+                results = [
+                    await downloader._request(
+                        functions.channels.GetFullChannelRequest(channel)
+                    )
+                    for _ in range(10)
+                ]
+            return downloader.metrics, results
+
+        metrics, results = asyncio.run(request())
+        self.assertEqual(len(results), 10)
+        self.assertTrue(client.flood_waits)
+        self.assertEqual(sleeps, [3] * client.flood_waits)
+
+        labels = (("request", "GetFullChannelRequest"),)
+        self.assertEqual(
+            metrics.counters[("floodwait_seconds_total", labels)],
+            3 * client.flood_waits,
+        )
+        self.assertEqual(
+            metrics.counters[("sleep_seconds_total", (("stage", "floodwait"),))],
+            3 * client.flood_waits,
+        )
+        # Every attempt is timed, the ones that hit the flood limit too
+        self.assertEqual(
+            metrics.histograms[("request_seconds", labels)].count, client.requests
+        )
+        self.assertEqual(client.requests, 10 + client.flood_waits)
@@ -0,0 +1,75 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+from benchmarks.synthetic import make_database
+from export.formatters import NlpFormatter
+
+
+class TestNlpFormatter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dumper = make_database(self.tmp.name, channels=3, messages=500)
+        self.formatter = NlpFormatter(self.dumper.conn)
+
+    def tearDown(self):
+        self.dumper.conn.close()
+        self.tmp.cleanup()
+
+    def expected_count(self, contexts=None):
+        """Count the messages a corpus should have the slow way"""
+        first_forward = {}
+        rows = [
+            row[1:]
+            for row in self.dumper.conn.execute(
+                "SELECT Message.ContextID, Message.Message, Message.ServiceAction, "
+                "Forward.ID, Forward.FromID, Forward.ChannelPost FROM Message "
+                "LEFT JOIN Forward ON Forward.ID = Message.ForwardID"
+            )
+            if contexts is None or row[0] in contexts
+        ]
+        for _, _, fwd_id, fwd_from, fwd_post in rows:
+            if fwd_id is not None:
+                original = (fwd_from, fwd_post)
+                first_forward[original] = min(
+                    fwd_id, first_forward.get(original, fwd_id)
+                )
+        return sum(
+            1
+            for text, service, fwd_id, fwd_from, fwd_post in rows
+            if text
+            and service is None
+            and (fwd_id is None or first_forward[(fwd_from, fwd_post)] == fwd_id)
+        )
+
+    def test_jsonl_corpus(self):
+        directory = os.path.join(self.tmp.name, "corpus")
+        result = self.formatter.write_corpus(
+            directory, compress=True, shard_bytes=32 * 1024
+        )
+        self.assertGreater(len(result["files"]), 1)
+
+        lines = []
+        for filename in result["files"]:
+            with gzip.open(filename, "rt", encoding="utf-8") as file:
+                lines.extend(json.loads(line) for line in file)
+        self.assertEqual(len(lines), result["messages"])
+        self.assertTrue(all(line["text"] for line in lines))
+
+        self.assertEqual(result["messages"], self.expected_count())
+
+    def test_text_corpus(self):
+        directory = os.path.join(self.tmp.name, "corpus")
+        context_id = self.dumper.conn.execute(
+            "SELECT ContextID FROM Message"
+        ).fetchone()[0]
+        result = self.formatter.write_corpus(
+            directory, contexts=[context_id], fmt="text"
+        )
+        with open(result["files"][0], encoding="utf-8") as file:
+            self.assertEqual(len(file.read().splitlines()), result["messages"])
+        self.assertLess(result["messages"], 500)
+        self.assertEqual(result["messages"], self.expected_count([context_id]))
@@ -0,0 +1,73 @@
+import os
+import re
+import sqlite3
+import tempfile
+import unittest
+
+from benchmarks.fake_client import FakeClient
+from benchmarks.ingest import make_config, run
+from export.formatters import OrgFormatter
+
+
+class TestOrgFormatter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        run(FakeClient(channels=1, messages=150, media_ratio=0.2), self.tmp.name)
+        self.db = os.path.join(self.tmp.name, "export.db")
+        conn = sqlite3.connect(self.db)
+        self.context_id = conn.execute("SELECT ContextID FROM Message").fetchone()[0]
+        conn.close()
+        self.output = os.path.join(self.tmp.name, "org")
+        os.mkdir(self.output)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def format(self):
+        formatter = OrgFormatter(self.db, config=make_config(self.tmp.name)["Dumper"])
+        formatter.format(self.context_id, self.output)
+        formatter.dbconn.close()
+        with open(os.path.join(self.output, str(self.context_id))) as file:
+            return file.read()
+
+    def test_format(self):
+        org = self.format()
+        self.assertTrue(org.startswith("#+TITLE: Channel 0\n"))
+        self.assertEqual(len(re.findall(r"^\* ", org, re.M)), 150)
+        self.assertIn(":VIEWS:", org)
+        self.assertIn(":FORWARDED_POST:", org)
+
+        links = re.findall(r"\[\[file:([^\]]+)\]\]", org)
+        self.assertTrue(links)
+        for link in links:
+            self.assertTrue(os.path.isfile(os.path.join(self.output, link)), link)
+
+    def test_forwards_joined(self):
+        formatter = OrgFormatter(self.db, config=make_config(self.tmp.name)["Dumper"])
+        queries = []
+        formatter.dbconn.set_trace_callback(queries.append)
+        formatter.format(self.context_id, self.output)
+        posts = formatter.dbconn.execute(
+            "SELECT COUNT(*) FROM Message JOIN Forward ON Forward.ID = ForwardID"
+            " WHERE ChannelPost IS NOT NULL"
+        ).fetchone()[0]
+        formatter.dbconn.close()
+        with open(os.path.join(self.output, str(self.context_id))) as file:
+            self.assertEqual(file.read().count(":FORWARDED_POST:"), posts)
+        # Forwards come with their messages rather than one query each
+        self.assertFalse([q for q in queries if "FROM Forward WHERE" in q])
+
+    def test_append(self):
+        self.format()
+        conn = sqlite3.connect(self.db)
+        conn.execute(
+            "INSERT INTO Message (ID, ContextID, Date, Message) VALUES (?, ?, ?, ?)",
+            (1000, self.context_id, 2000000000, "* Later"),
+        )
+        conn.commit()
+        conn.close()
+        org = self.format()
+        self.assertEqual(len(re.findall(r"^\* ", org, re.M)), 151)
+        self.assertEqual(org.count("#+TITLE:"), 1)
+        self.assertTrue(org.endswith("\n * Later\n"))
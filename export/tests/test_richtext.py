@@ -0,0 +1,121 @@
+import unittest
+
+from telethon.tl import types
+
+from export import richtext, utils
+
+
+class TestRichText(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(richtext.render("a < b", None), "a &lt; b")
+        self.assertEqual(richtext.render("a_b", "", "markdown"), "a\\_b")
+        self.assertEqual(richtext.render("", "bold,0,5", "org"), "")
+        with self.assertRaises(ValueError):
+            richtext.render("text", None, "rtf")
+
+    def test_formats(self):
+        formatting = "bold,0,5;texturl,6,4,https://example.com/a%2cb"
+        self.assertEqual(
+            richtext.render("hello link", formatting),
+            '<b>hello</b> <a href="https://example.com/a,b">link</a>',
+        )
+        self.assertEqual(
+            richtext.render("hello link", formatting, "markdown"),
+            "**hello** [link](https://example.com/a,b)",
+        )
+        self.assertEqual(
+            richtext.render("hello link", formatting, "org"),
+            "*hello* [[https://example.com/a,b][link]]",
+        )
+        self.assertEqual(
+            richtext.render("ask bob", "mentionname,4,3,42", "org"),
+            "ask [[tg://user?id=42][bob]]",
+        )
+
+    def test_url_schemes(self):
+        self.assertEqual(
+            richtext.render("click", "texturl,0,5,javascript:alert(1)"), "click"
+        )
+        self.assertEqual(
+            richtext.render("click", "texturl,0,5,JavaScript:alert(1)", "markdown"),
+            "click",
+        )
+        self.assertEqual(
+            richtext.render("data:text/html,x", "url,0,16", "org"),
+            "data:text/html,x",
+        )
+        self.assertEqual(
+            richtext.render("mail", "texturl,0,4,mailto:a@b.org"),
+            '<a href="mailto:a@b.org">mail</a>',
+        )
+        # Telegram detects URLs without a scheme too
+        self.assertEqual(
+            richtext.render("see example.com", "url,4,11"),
+            'see <a href="http://example.com">example.com</a>',
+        )
+        self.assertEqual(
+            richtext.render("see example.com", "url,4,11", "org"),
+            "see [[http://example.com][example.com]]",
+        )
+
+    def test_utf16_offsets(self):
+        # The emoji takes two UTF-16 code units
+        text = "👍 a 👍 b"
+        self.assertEqual(
+            richtext.render(text, "bold,3,1;italic,8,1"),
+            "👍 <b>a</b> 👍 <i>b</i>",
+        )
+
+    def test_nesting(self):
+        self.assertEqual(
+            richtext.render("abcd", "bold,0,4;italic,1,2"), "<b>a<i>bc</i>d</b>"
+        )
+        # Crossing entities are split so that the tags stay nested
+        self.assertEqual(
+            richtext.render("abcd", "bold,0,3;italic,1,3"),
+            "<b>a<i>bc</i></b><i>d</i>",
+        )
+
+    def test_code_is_verbatim(self):
+        self.assertEqual(
+            richtext.render("run a_b now", "code,4,3", "markdown"),
+            "run `a_b` now",
+        )
+        self.assertEqual(
+            richtext.render("x <y>", "pre,0,5"), "<pre>x &lt;y&gt;</pre>"
+        )
+
+    def test_org_pre_block(self):
+        self.assertEqual(
+            richtext.render("run:\nf(x)\n* y\nthen", "pre,5,9", "org"),
+            "run:\n#+begin_src\nf(x)\n,* y\n#+end_src\nthen",
+        )
+        self.assertEqual(
+            richtext.render("run f(x) now", "pre,4,4", "org"),
+            "run \n#+begin_src\nf(x)\n#+end_src\n now",
+        )
+
+    def test_org_lines(self):
+        self.assertEqual(
+            richtext.render("* a\n#+b\nc *d", None, "org"), " * a\n #+b\nc *d"
+        )
+        self.assertEqual(
+            richtext.render("x *y*\n* z", "bold,0,1", "org"), "*x* *y*\n * z"
+        )
+
+    def test_whitespace_emphasis(self):
+        self.assertEqual(richtext.render("a b", "bold,0,2", "org"), "a b")
+        self.assertEqual(richtext.render("a b", "bold,0,2"), "<b>a </b>b")
+
+    def test_encoded_entities(self):
+        entities = [
+            types.MessageEntityBold(0, 2),
+            types.MessageEntityTextUrl(3, 4, "https://x.org/?a=1;b=2"),
+        ]
+        formatting = utils.encode_msg_entities(entities)
+        self.assertEqual(utils.decode_msg_entities(formatting), entities)
+        self.assertEqual(
+            richtext.render("hi link", formatting),
+            '<b>hi</b> <a href="https://x.org/?a=1;b=2">link</a>',
+        )
@@ -0,0 +1,233 @@
+import asyncio
+import datetime
+import os
+import queue
+import sqlite3
+import tempfile
+import unittest
+
+from benchmarks.fake_client import FakeClient, SELF_USER_ID
+from benchmarks.ingest import make_config, no_delays
+from export.downloader import Downloader
+from export import utils as export_utils
+from export.dumper import Dumper
+from export.exporter import Exporter
+from export.sharding import ShardDumper, ShardWriter
+
+
+class TestSharding(unittest.TestCase):
+    """Shard workers and the writer, talking through in-process queues"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = make_config(self.tmp.name)
+        self.writer = ShardWriter(Dumper(self.config["Dumper"]))
+        self.queue = queue.Queue()
+        self.replies = [queue.Queue(), queue.Queue()]
+        self.shards = [self.make_shard(i) for i in range(2)]
+
+    def tearDown(self):
+        for dumper in self.shards + [self.writer.dumper]:
+            dumper.conn.close()
+        self.tmp.cleanup()
+
+    def make_shard(self, index):
+        config = make_config(self.tmp.name)
+        config["Dumper"]["DBFileName"] = "export-shard{}".format(index)
+        return ShardDumper(
+            config["Dumper"], index, self.queue, self.replies[index]
+        )
+
+    def drain(self):
+        """Run the writer over everything the shards sent so far"""
+        while True:
+            try:
+                shard, rows = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            media_ids = self.writer.write(shard, rows)
+            if media_ids:
+                self.replies[shard].put(media_ids)
+
+    async def export(self, client, index):
+        dumper = self.shards[index]
+        exporter = Exporter(
+            client, self.config, dumper, asyncio.get_running_loop(), shard=(index, 2)
+        )
+        try:
+            await exporter.start()
+        finally:
+            dumper.commit()
+
+    def test_export(self):
+        for index in range(2):
+            client = FakeClient(
+                channels=2,
+                messages=60,
+                media_ratio=0.3,
+                media_size=1024,
+                forward_ratio=0.3,
+            )
+            with no_delays():
+                asyncio.run(self.export(client, index))
+            self.drain()
+            self.assertTrue(self.shards[index].wait_for_media_ids())
+
+        conn = sqlite3.connect(self.writer.dumper.db_path)
+        for index, shard in enumerate(self.shards):
+            conn.execute("ATTACH ? AS shard{}".format(index), (shard.db_path,))
+        count = conn.execute("SELECT COUNT(*) FROM Message").fetchone()[0]
+        self.assertEqual(count, 120)
+        self.assertEqual(
+            conn.execute("SELECT UserID FROM SelfInformation").fetchall(),
+            [(SELF_USER_ID,)],
+        )
+        for index in range(2):
+            # Every message points to the same media and forward as in its
+            # shard, under the IDs of the main database
+            shard_messages = conn.execute(
+                "SELECT COUNT(*), COUNT(MediaID), COUNT(ForwardID)"
+                " FROM shard{}.Message".format(index)
+            ).fetchone()
+            self.assertEqual(shard_messages[0], 60)
+            self.assertTrue(shard_messages[1] and shard_messages[2])
+            matching = conn.execute(
+                "SELECT COUNT(*), COUNT(m.MediaID), COUNT(m.ForwardID)"
+                " FROM shard{0}.Message AS s"
+                " JOIN Message AS m ON m.ID = s.ID AND m.ContextID = s.ContextID"
+                " LEFT JOIN shard{0}.Media AS sm ON sm.ID = s.MediaID"
+                " LEFT JOIN Media AS mm ON mm.ID = m.MediaID"
+                " LEFT JOIN shard{0}.Forward AS sf ON sf.ID = s.ForwardID"
+                " LEFT JOIN Forward AS mf ON mf.ID = m.ForwardID"
+                " WHERE sm.MediaID IS mm.MediaID"
+                " AND sf.FromID IS mf.FromID"
+                " AND sf.ChannelPost IS mf.ChannelPost".format(index)
+            ).fetchone()
+            self.assertEqual(matching, shard_messages)
+
+        # Files are named after the Media IDs of the main database
+        media_ids = {row[0] for row in conn.execute("SELECT ID FROM Media")}
+        conn.close()
+        files = [
+            name
+            for _, _, names in os.walk(os.path.join(self.tmp.name, "usermedia"))
+            for name in names
+        ]
+        self.assertTrue(files)
+        for name in files:
+            self.assertNotIn("shard", name)
+            self.assertIn(int(name.split(".")[-2]), media_ids)
+
+    def test_media_dedup(self):
+        client = FakeClient(channels=1, messages=1, media_ratio=1)
+        channel = next(iter(client.channels.values()))
+        media = client._make_message(channel, 1).media
+        local_ids = []
+        for shard in self.shards:
+            # Something else first, so local IDs differ between the shards
+            if shard.shard:
+                shard.dump_media(client._make_message(channel, 1).media.photo.sizes[0])
+            local_ids.append(shard.dump_media(media))
+            shard.commit()
+        self.drain()
+
+        global_ids = [
+            shard.get_file_media_id(local_id)
+            for shard, local_id in zip(self.shards, local_ids)
+        ]
+        self.assertIsNotNone(global_ids[0])
+        self.assertEqual(global_ids[0], global_ids[1])
+        copies = self.writer.dumper.conn.execute(
+            "SELECT COUNT(*) FROM Media WHERE MediaID = ?", (media.photo.id,)
+        ).fetchone()[0]
+        self.assertEqual(copies, 1)
+
+    def test_file_named_when_known(self):
+        shard = self.shards[0]
+        local_id = shard.dump_media(
+            FakeClient(media_ratio=1)._make_message(
+                next(iter(FakeClient().channels.values())), 1
+            ).media
+        )
+        # The writer has not seen the media yet, so the file gets a
+        # temporary name until it replies
+        self.assertIsNone(shard.get_file_media_id(local_id))
+        path = os.path.join(self.tmp.name, "photo.shard0-{}.jpg".format(local_id))
+        with open(path, "wb"):
+            pass
+        shard.name_media_file(
+            local_id,
+            path,
+            lambda media_id: os.path.join(
+                self.tmp.name, "photo.{}.jpg".format(media_id)
+            ),
+        )
+        self.assertTrue(os.path.isfile(path))
+        shard.commit()
+        self.drain()
+        self.assertTrue(shard.wait_for_media_ids())
+        self.assertFalse(os.path.isfile(path))
+        global_id = shard.get_file_media_id(local_id)
+        filename = os.path.join(self.tmp.name, "photo.{}.jpg".format(global_id))
+        self.assertTrue(os.path.isfile(filename))
+
+    def test_existing_file_not_downloaded(self):
+        client = FakeClient(media_ratio=1, media_size=1024)
+        channel = next(iter(client.channels.values()))
+        media = client._make_message(channel, 1).media
+
+        # The first shard saved the file already, under its final name
+        first = self.shards[0]
+        first_id = first.dump_media(media)
+        first.commit()
+        self.drain()
+        global_id = first.get_file_media_id(first_id)
+
+        second = self.shards[1]
+        local_id = second.dump_media(media)
+
+        async def download():
+            downloader = Downloader(
+                client, self.config["Dumper"], second, asyncio.get_running_loop()
+            )
+
+            media_type, name, mime_type = second.conn.execute(
+                "SELECT Type, Name, MimeType FROM Media WHERE ID = ?", (local_id,)
+            ).fetchone()
+
+            def get_filename(media_id):
+                return export_utils.get_media_filename(
+                    downloader.media_fmt,
+                    media_id,
+                    media_type,
+                    name,
+                    mime_type,
+                    date,
+                    channel.id,
+                    sender_id=channel.id,
+                    context_name=downloader._get_name(channel.id),
+                    sender_name=downloader._get_name(channel.id),
+                )
+
+            filename = get_filename(global_id)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, "wb"):
+                pass
+
+            async def drain_soon():
+                await asyncio.sleep(0.05)
+                self.drain()
+
+            # The writer only replies while the download waits for it
+            drain = asyncio.ensure_future(drain_soon())
+            downloaded = await downloader._download_media(
+                local_id, channel.id, channel.id, date, bar=None
+            )
+            await drain
+            return downloaded, filename
+
+        date = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        downloaded, filename = asyncio.run(download())
+        self.assertFalse(downloaded)
+        self.assertEqual(client.bytes_served, 0)
+        self.assertEqual(os.path.getsize(filename), 0)
@@ -1,6 +1,8 @@
 """Utility functions for telegram-export which aren't specific to one purpose"""
 
 import mimetypes
+import os
+from collections import defaultdict
 
 from telethon.tl import types
 from urllib.parse import urlparse
@@ -66,11 +68,14 @@ def decode_msg_entities(string):
         kind, offset, length = split[0], int(split[1]), int(split[2])
         if kind in TEXT_TO_ENTITY:
             if kind == "texturl":
-                parsed.append(types.MessageEntityTextUrl(offset, length, split[-1]))
+                url = split[-1].replace("%2c", ",").replace("%3b", ";")
+                parsed.append(types.MessageEntityTextUrl(offset, length, url))
             elif kind == "mentionname":
                 parsed.append(
                     types.MessageEntityMentionName(offset, length, int(split[-1]))
                 )
+            elif kind == "pre":
+                parsed.append(types.MessageEntityPre(offset, length, ""))
             else:
                 parsed.append(TEXT_TO_ENTITY[kind](offset, length))
     return parsed
@@ -120,6 +125,50 @@ def get_extension(mime):
     )
 
 
+def get_media_filename(
+    media_fmt,
+    media_id,
+    media_type,
+    name,
+    mime_type,
+    date,
+    context_id,
+    sender_id=None,
+    context_name=None,
+    sender_name=None,
+    thumbnail=False,
+):
+    """
+    Returns the filename under which the media with the given ID and
+    Media row values is saved, for the MediaFilenameFmt `media_fmt`
+    and the date (UTC datetime) of the message it belongs to.
+    """
+    media_subtype = media_type.split(".")[-1] if media_type else None
+    formatter = defaultdict(
+        str,
+        context_id=context_id,
+        sender_id=sender_id,
+        type=media_subtype or "unknown",
+        name=context_name or "unknown",
+        sender_name=sender_name or "unknown",
+    )
+
+    ext = None
+    if name:
+        filename, ext = os.path.splitext(name)
+    else:
+        filename = date.strftime(f"{formatter['type']}_%Y-%m-%d_%H-%M-%S")
+
+    if not ext:
+        ext = get_extension(mime_type)
+    if thumbnail:
+        # Thumbnails are always JPEG, whatever the full file is
+        ext = ".thumb.jpg"
+
+    formatter["filename"] = filename
+    return date.strftime(media_fmt).format_map(formatter) + f".{media_id}{ext}"
+
+
 def get_file_location(media):
     """
     Helper method to turn arbitrary media into (InputFileLocation, size/None).
@@ -4,11 +4,11 @@ from pyrogram import Client
 from pyrogram import filters
 
 from Message import process_media, process_text, process_author
-from app import app as flask_app
-from app import db
+from app import create_app, db
 from config import ACCOUNT, PHONE_NR, API_ID, API_HASH
 from models.message import Message
 
+flask_app = create_app(read_only=False)
 app = Client(ACCOUNT, phone_number=PHONE_NR, api_id=API_ID, api_hash=API_HASH)
 
 
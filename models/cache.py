@@ -0,0 +1,54 @@
+"""
+A small in-process cache for what the app builds from the database (query
+results, rendered pages). Entries are stored with the data version they
+were built from (see ``queries.data_version``), so whenever the Dumper
+commits or something is marked read they are simply built again.
+"""
+import threading
+from collections import OrderedDict
+
+# The number of entries kept, least recently used ones are dropped first
+CACHE_ENTRIES = 1024
+
+
+class VersionedCache:
+    """A thread-safe LRU of ``{key: (version, value)}``"""
+
+    def __init__(self, maxsize=CACHE_ENTRIES):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, version, build):
+        """
+        Return the value cached for `key` if it was built from `version`,
+        or build it with ``build()`` and cache it. A `version` of None means
+        the data cannot tell when it changes, so nothing is cached.
+        """
+        if version is None:
+            return build()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Built outside the lock, two requests may build the same entry
+        value = build()
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,47 @@
+"""
+How the app connects to the export database. It only ever reads it, so it
+opens it read only (``mode=ro``) with ``PRAGMA query_only``: its pooled
+connections never take the write lock, and since the Dumper keeps the
+database in WAL mode they are not blocked while it writes either. What has
+been read is written through a separate engine (see ``readstate``).
+"""
+from urllib.parse import quote, unquote
+
+from sqlalchemy import create_engine, event
+
+from models import readstate
+
+# Connections kept open by each process serving the app
+POOL_SIZE = 8
+
+
+def get_uri(filename, read_only=True):
+    """Return the SQLAlchemy URI of a database file"""
+    if not read_only:
+        return "sqlite:///{}".format(filename)
+    return "sqlite:///file:{}?mode=ro&uri=true".format(quote(filename))
+
+
+def get_filename(url):
+    """Return the file of the database at the SQLAlchemy `url`"""
+    if url.query.get("uri"):
+        return unquote(url.database[len("file:"):])
+    return url.database
+
+
+def set_query_only(engine):
+    """Make every connection of `engine` refuse to write"""
+
+    @event.listens_for(engine, "connect")
+    def query_only(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA query_only = ON")
+
+
+def create_state_engine(url, state_filename):
+    """
+    Return an engine on the database at `url` (read only), with the read
+    state in `state_filename` attached to be written to.
+    """
+    engine = create_engine(url, pool_size=1)
+    readstate.attach(engine, state_filename)
+    return engine
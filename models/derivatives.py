@@ -0,0 +1,100 @@
+"""
+Downscaled copies of the downloaded images, at a few fixed widths and in
+WebP and JPEG, so pages do not embed the full resolution photos. They are
+generated with Pillow (the "images" extra) when first requested, or in a
+batch with ``flask derivatives``, and kept on disk as
+``<root>/<media id // 1000>/<media id>-<width>.<format>``.
+"""
+import os
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+WIDTHS = (320, 640, 1280)
+
+# {format in the URL: (Pillow format, MIME type)}
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+
+QUALITY = 80
+
+
+def get_derivatives_root(db_filename):
+    """Return the directory derivatives are kept in, next to the database"""
+    return os.path.join(os.path.dirname(os.path.abspath(db_filename)), "derivatives")
+
+
+class Derivatives:
+    """The derivatives of the images in `media_files` (see ``MediaFiles``)"""
+
+    def __init__(self, media_files, root):
+        self.media_files = media_files
+        self.root = root
+
+    def path(self, media_id, width, fmt):
+        return os.path.join(
+            self.root, str(media_id // 1000), "{}-{}.{}".format(media_id, width, fmt)
+        )
+
+    def get(self, media_id, width, fmt):
+        """
+        Return the path of a derivative, generating it if needed, or None
+        if the media was not downloaded, is not an image, or Pillow is
+        not installed.
+        """
+        path = self.path(media_id, width, fmt)
+        if os.path.isfile(path):
+            return path
+        self._generate(media_id, [(width, fmt)])
+        return path if os.path.isfile(path) else None
+
+    def generate(self, media_id):
+        """
+        Generate every missing derivative of a media, reading it only once.
+        Return whether it has them all.
+        """
+        missing = [
+            (width, fmt)
+            for width in WIDTHS
+            for fmt in FORMATS
+            if not os.path.isfile(self.path(media_id, width, fmt))
+        ]
+        return not missing or self._generate(media_id, missing)
+
+    def _generate(self, media_id, variants):
+        source = self.media_files.get(media_id)
+        if Image is None or not source:
+            return False
+        try:
+            with Image.open(source) as image:
+                image = ImageOps.exif_transpose(image)
+                # The largest first, each one is scaled down from the last
+                for width in sorted({w for w, _ in variants}, reverse=True):
+                    if image.width > width:
+                        image = image.copy()
+                        image.thumbnail((width, image.height), Image.LANCZOS)
+                    for fmt in {f for w, f in variants if w == width}:
+                        self._save(image, self.path(media_id, width, fmt), fmt)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return False
+        return True
+
+    @staticmethod
+    def _save(image, path, fmt):
+        """Save atomically, so a derivative is never served half written"""
+        modes = ("RGB", "L") if fmt == "jpeg" else ("RGB", "RGBA")
+        if image.mode not in modes:
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            if image.mode not in modes:
+                image = image.convert("RGB")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                image.save(file, format=FORMATS[fmt][0], quality=QUALITY)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
@@ -0,0 +1,156 @@
+"""
+Push the posts the Dumper archives to the pages open in browsers. A single
+poller thread serves every subscriber: it checks ``PRAGMA data_version``
+(which only changes when another connection commits) on its own connection,
+and only then looks for the posts of each channel past its (Date, ID)
+watermark. Posts dumped again (which the Dumper replaces with new rows) or
+older ones filled in later are not new, and are not pushed. Each new post
+is rendered once and queued to the subscribers of its channel, so the cost
+does not depend on the number of open pages.
+"""
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+from models import queries
+
+POLL_INTERVAL = 1
+
+# Subscribers that fall this many posts behind are dropped (and reconnect)
+MAX_PENDING = 256
+
+# The (Date, ID) of the latest message of every channel
+LAST_POSTS = "SELECT ContextID, LastDate, LastID FROM ContextSummary"
+
+# The same, for databases without ContextSummary (the ID is the one of a
+# row with the latest Date)
+LAST_POSTS_AGGREGATE = "SELECT ContextID, MAX(Date), ID FROM Message GROUP BY ContextID"
+
+# The posts of a channel after its watermark, up to its latest message
+NEW_POSTS = (
+    queries.POSTS
+    + """  AND m.ContextID = :channel
+  AND (m.Date, m.ID) > (:date, :message_id)
+  AND (m.Date, m.ID) <= (:until_date, :until_id)
+ORDER BY m.Date, m.ID"""
+)
+
+
+class Subscription:
+    """The new posts of some channels (all of them if None) for a client"""
+
+    def __init__(self, channel_ids=None):
+        self.channel_ids = set(channel_ids) if channel_ids else None
+        self.closed = False
+        self._queue = queue.Queue(MAX_PENDING)
+
+    def wants(self, channel_id):
+        return self.channel_ids is None or channel_id in self.channel_ids
+
+    def put(self, event):
+        """Queue an event, or close the subscription if it is too far behind"""
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.closed = True
+
+    def get(self, timeout=None):
+        """Return the next event, or None if there was none in `timeout`"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LiveFeed:
+    """
+    Tail the Message table of `engine` for as long as anyone subscribes,
+    and queue ``render(post)`` (see ``queries.post_dict``) for each new post.
+    """
+
+    def __init__(self, engine, render=None, interval=POLL_INTERVAL):
+        self.engine = engine
+        self.render = render or (lambda post: post)
+        self.interval = interval
+        self._subscriptions = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def subscribe(self, channel_ids=None):
+        """Subscribe to the new posts of some channels while in the block"""
+        subscription = Subscription(channel_ids)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="live-feed", daemon=True
+                )
+                self._thread.start()
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                self._subscriptions.discard(subscription)
+
+    def _run(self):
+        with self.engine.connect() as conn:
+            data_version = None
+            watermarks = self._last_posts(conn)
+            while True:
+                with self._lock:
+                    if not self._subscriptions:
+                        self._thread = None
+                        return
+                version = conn.exec_driver_sql("PRAGMA data_version").scalar()
+                if version != data_version:
+                    if data_version is not None:
+                        watermarks = self._publish(conn, watermarks)
+                    data_version = version
+                conn.rollback()
+                time.sleep(self.interval)
+
+    @staticmethod
+    def _last_posts(conn):
+        """Return ``{channel id: (Date, ID) of its latest message}``"""
+        query = LAST_POSTS if queries.has_summary(conn) else LAST_POSTS_AGGREGATE
+        return {row[0]: (row[1], row[2]) for row in conn.execute(text(query))}
+
+    def _publish(self, conn, watermarks):
+        """
+        Queue the posts past the ``{channel id: (Date, ID)}`` `watermarks`,
+        and return the new ones
+        """
+        latest = self._last_posts(conn)
+        for channel_id, until in latest.items():
+            after = watermarks.get(channel_id, (float("-inf"), 0))
+            if until <= after:
+                continue
+            with self._lock:
+                subscriptions = [
+                    s for s in self._subscriptions if s.wants(channel_id)
+                ]
+            if not subscriptions:
+                continue
+            rows = conn.execute(
+                text(NEW_POSTS),
+                {
+                    "channel": channel_id,
+                    "date": after[0],
+                    "message_id": after[1],
+                    "until_date": until[0],
+                    "until_id": until[1],
+                },
+            ).all()
+            for row in rows:
+                event = self.render(queries.post_dict(row))
+                for subscription in subscriptions:
+                    subscription.put(event)
+            with self._lock:
+                self._subscriptions.difference_update(
+                    s for s in subscriptions if s.closed
+                )
+        return latest
@@ -0,0 +1,101 @@
+"""
+Find the files the Downloader saved for every Media row. Their names come
+from MediaFilenameFmt, which the app does not know, but always end in
+``.<media id><ext>`` (see ``export.utils.get_media_filename``), so the
+media directory is indexed by that suffix. The extension is always there:
+``.thumb.jpg`` for thumbnails, otherwise the one of the original file name
+or else of its MIME type (``export.utils.get_extension``).
+"""
+import os
+import re
+import threading
+import time
+
+# The last ".<digits>" followed by one extension (as os.path.splitext
+# gives it), or by ".thumb.jpg"
+FILENAME_ID = re.compile(r"\.(\d+)(\.thumb\.jpg|\.[^.]*)$")
+
+# Scanning the directory again for a missing file happens at most this often.
+# Only the first scan blocks a request; the next ones run in the background,
+# and a missing file is reported as such until they are done.
+RESCAN_INTERVAL = 10
+
+
+def get_media_root(db_filename):
+    """
+    Return the directory media is saved under, next to the database:
+    the "usermedia" directory of the default MediaFilenameFmt if it exists.
+    """
+    root = os.path.dirname(os.path.abspath(db_filename))
+    usermedia = os.path.join(root, "usermedia")
+    return usermedia if os.path.isdir(usermedia) else root
+
+
+def parse_filename(filename):
+    """
+    Return the ``(media id, thumbnail)`` of a file the Downloader saved,
+    or None if the name does not end like one.
+    """
+    match = FILENAME_ID.search(filename)
+    if not match:
+        return None
+    return int(match.group(1)), match.group(2) == ".thumb.jpg"
+
+
+class MediaFiles:
+    """The ``{(media id, thumbnail): path}`` of the files under a directory"""
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self._files = {}
+        self._scanned = None
+        self._scanning = False
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        files = {}
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                key = parse_filename(filename)
+                if key:
+                    files[key] = os.path.join(directory, filename)
+        self._files = files
+        self._scanned = time.monotonic()
+
+    def _scan_in_background(self):
+        try:
+            self._scan()
+        finally:
+            self._scanning = False
+
+    def _rescan(self):
+        """Scan the first time, or start scanning again if it is time to"""
+        with self._lock:
+            if self._scanned is None:
+                self._scan()
+            elif (
+                not self._scanning
+                and time.monotonic() - self._scanned > RESCAN_INTERVAL
+            ):
+                self._scanning = True
+                threading.Thread(target=self._scan_in_background, daemon=True).start()
+
+    def _is_inside_root(self, path):
+        """Whether `path` (after following links) is under the root"""
+        path = os.path.realpath(path)
+        return os.path.commonpath((self.root, path)) == self.root
+
+    def get(self, media_id, thumbnail=False):
+        """
+        Return the path of the file of a media (or its thumbnail), or None.
+        Paths outside the root (e.g. through symbolic links) are never
+        returned.
+        """
+        key = (media_id, thumbnail)
+        path = self._files.get(key)
+        if not path or not os.path.isfile(path):
+            self._rescan()
+            path = self._files.get(key)
+        if path and os.path.isfile(path) and self._is_inside_root(path):
+            return path
+        return None
@@ -0,0 +1,385 @@
+"""
+Queries the pages of the app are built from. They go through plain SQL
+and return rows rather than ORM objects, since Message is only unique per
+(ID, ContextID) and every page needs just a few columns of many rows.
+"""
+import itertools
+
+from sqlalchemy import text
+
+from models import readstate
+
+POSTS_PER_CHANNEL = 5
+
+# The latest snapshot of every channel (Channel keeps one per DateUpdated),
+# each found through the (ID, DateUpdated) primary key
+LATEST_CHANNELS = """
+SELECT ID, Title, About, Username, PictureID
+FROM Channel AS ch
+WHERE DateUpdated = (SELECT MAX(DateUpdated) FROM Channel WHERE ID = ch.ID)
+"""
+
+# The latest non-empty posts of every channel, and its number of unread
+# messages. Each channel looks its posts up backwards through the
+# MessageContextDate index, so the cost depends on the number of channels
+# (and unread messages) and not on the size of the archive.
+HOME_PAGE = """
+SELECT c.ID AS ChannelID, c.Title, c.About, c.Unread,
+       m.ID, m.Date, m.Message, m.MediaID, m.Formatting, m.ViewCount
+FROM (
+    SELECT l.*, {unread} AS Unread,
+           (SELECT MAX(Date) FROM Message WHERE ContextID = l.ID) AS LastDate
+    FROM ({latest}) AS l
+    LEFT JOIN state.ReadState AS r ON r.ContextID = l.ID
+) AS c
+JOIN Message AS m ON m.rowid IN (
+    SELECT rowid FROM Message
+    WHERE ContextID = c.ID AND Message != ''
+    ORDER BY Date DESC, ID DESC
+    LIMIT :per_channel
+)
+ORDER BY {order}, m.Date DESC, m.ID DESC
+"""
+
+# How the home page can be sorted: by number of unread messages, or with
+# the channels that have unread messages first, the latest active first
+HOME_PAGE_ORDERS = {
+    "unread": "c.Unread DESC, c.ID",
+    "latest": "c.Unread > 0 DESC, c.LastDate DESC, c.ID",
+}
+
+CHANNEL = "SELECT * FROM ({}) WHERE ID = :id".format(LATEST_CHANNELS)
+
+FEED_PAGE_SIZE = 50
+MAX_FEED_PAGE_SIZE = 200
+
+# The fields of a post, as returned by ``post_dict``
+POST_FIELDS = ("id", "channel", "date", "text", "formatting", "views", "media")
+
+# Posts (not service messages, and with text or media) with their media
+POSTS = """
+SELECT m.ID, m.ContextID, m.Date, m.Message, m.Formatting, m.ViewCount,
+       m.MediaID, md.Type AS MediaType, md.Name AS MediaName,
+       md.MimeType AS MediaMimeType, md.Size AS MediaSize
+FROM Message AS m
+LEFT JOIN Media AS md ON md.ID = m.MediaID
+WHERE m.ServiceAction IS NULL
+  AND (m.Message != '' OR m.MediaID IS NOT NULL)
+"""
+
+# A page of the posts of a channel on one side of the (Date, ID) cursor:
+# older ones ({side} is <, newest first) or newer ones (>, oldest first).
+# Every page is a range scan over the MessageContextDate index starting at
+# the cursor, so later pages cost the same as the first one.
+CHANNEL_FEED = (
+    POSTS
+    + """
+  AND m.ContextID = :id
+  AND (m.Date, m.ID) {side} (:date, :message_id)
+ORDER BY m.Date {order}, m.ID {order}
+LIMIT :limit
+"""
+)
+
+POST = POSTS + "  AND m.ContextID = :context AND m.ID = :id"
+
+# The posts containing :pattern in every channel (or just {channel}), the
+# newest first, older than the (Date, ContextID, ID) cursor. Without the
+# {match} of the search index, LIKE has to read every message.
+SEARCH = (
+    POSTS
+    + """
+  AND m.Message LIKE :pattern ESCAPE '\\'{match}
+  AND (m.Date, m.ContextID, m.ID) < (:date, :context, :message_id){channel}
+ORDER BY m.Date DESC, m.ContextID DESC, m.ID DESC
+LIMIT :limit
+"""
+)
+
+# Only the messages the MessageSearch index of the Dumper finds, which is
+# built from trigrams (so the query needs at least MIN_INDEXED_QUERY
+# characters) and matches case-insensitively like LIKE does
+SEARCH_MATCH = """
+  AND m.rowid IN (SELECT rowid FROM MessageSearch WHERE MessageSearch MATCH :match)"""
+
+MIN_INDEXED_QUERY = 3
+
+# One row per context with messages, kept up to date by the Dumper
+CHANNEL_LIST = """
+SELECT s.ContextID, s.Title, s.MessageCount, s.LastDate, {unread} AS Unread
+FROM ContextSummary AS s
+LEFT JOIN state.ReadState AS r ON r.ContextID = s.ContextID
+ORDER BY s.LastDate DESC
+"""
+
+# The same, for databases last written before ContextSummary existed
+CHANNEL_LIST_AGGREGATE = """
+SELECT m.ContextID, c.Title, COUNT(*) AS MessageCount, MAX(m.Date) AS LastDate,
+       {unread} AS Unread
+FROM Message AS m
+LEFT JOIN ({latest}) AS c ON c.ID = m.ContextID
+LEFT JOIN state.ReadState AS r ON r.ContextID = m.ContextID
+GROUP BY m.ContextID
+ORDER BY LastDate DESC
+"""
+
+
+def has_summary(session):
+    """Whether the database has the ContextSummary table of the Dumper"""
+    return bool(
+        session.execute(
+            text(
+                "SELECT 1 FROM sqlite_master "
+                "WHERE type='table' AND name='ContextSummary'"
+            )
+        ).first()
+    )
+
+
+def has_search_index(session):
+    """Whether the database has the MessageSearch index of the Dumper"""
+    return bool(
+        session.execute(
+            text(
+                "SELECT 1 FROM sqlite_master "
+                "WHERE type='table' AND name='MessageSearch'"
+            )
+        ).first()
+    )
+
+
+def unread_count(session, context):
+    """
+    Return the SQL expression of the number of unread messages of the
+    context given by the SQL expression `context`, whose ReadState is `r`.
+    """
+    if has_summary(session):
+        total = "(SELECT MessageCount FROM ContextSummary WHERE ContextID = {})"
+    else:
+        total = "(SELECT COUNT(*) FROM Message WHERE ContextID = {})"
+    return readstate.UNREAD_COUNT.format(context=context, total=total.format(context))
+
+
+def data_version(session, context_id=None):
+    """
+    Return what pages built from the archive (or only from one context)
+    and the read state can be cached with: it changes whenever the Dumper
+    commits something new for them, or something is marked read. None if
+    the database has no ContextVersion table to tell.
+    """
+    has_versions = session.execute(
+        text(
+            "SELECT 1 FROM sqlite_master "
+            "WHERE type='table' AND name='ContextVersion'"
+        )
+    ).first()
+    if not has_versions:
+        return None
+    if context_id is None:
+        version = "SELECT MAX(Version) FROM ContextVersion"
+    else:
+        version = "SELECT Version FROM ContextVersion WHERE ContextID = :id"
+    return tuple(
+        session.execute(
+            text(
+                "SELECT ({}), (SELECT Version FROM state.StateVersion)".format(
+                    version
+                )
+            ),
+            {"id": context_id},
+        ).one()
+    )
+
+
+def group_posts(rows):
+    """
+    Group rows of posts sorted by ChannelID into a list of channels,
+    ``{"id", "title", "description", "unread", "posts"}``.
+    """
+    return [
+        {
+            "id": channel_id,
+            "title": posts[0].Title,
+            "description": posts[0].About,
+            "unread": posts[0].Unread,
+            "posts": posts,
+        }
+        for channel_id, posts in (
+            (key, list(group))
+            for key, group in itertools.groupby(rows, key=lambda r: r.ChannelID)
+        )
+    ]
+
+
+def home_page(session, per_channel=POSTS_PER_CHANNEL, order="unread"):
+    """
+    Return the channels with their latest `per_channel` posts, in a
+    single query (see ``group_posts``), sorted as in ``HOME_PAGE_ORDERS``.
+    """
+    query = HOME_PAGE.format(
+        unread=unread_count(session, "l.ID"),
+        latest=LATEST_CHANNELS,
+        order=HOME_PAGE_ORDERS[order],
+    )
+    rows = session.execute(text(query), {"per_channel": per_channel}).all()
+    return group_posts(rows)
+
+
+def get_channel(session, channel_id):
+    """Return the latest snapshot of a channel, or None"""
+    return session.execute(text(CHANNEL), {"id": channel_id}).first()
+
+
+def get_media(session, media_id):
+    """Return the ``(ID, Type, Name, MimeType, Size)`` of a media, or None"""
+    return session.execute(
+        text("SELECT ID, Type, Name, MimeType, Size FROM Media WHERE ID = :id"),
+        {"id": media_id},
+    ).first()
+
+
+def image_media_ids(session):
+    """Return the IDs of every image media, the latest first"""
+    return session.execute(
+        text(
+            "SELECT ID FROM Media WHERE Type LIKE 'photo%' OR MimeType LIKE 'image/%'"
+            " ORDER BY ID DESC"
+        )
+    ).scalars().all()
+
+
+def channel_list(session):
+    """
+    Return the ``(ContextID, Title, MessageCount, LastDate, Unread)`` of
+    every context, the most recently active first.
+    """
+    if has_summary(session):
+        query = CHANNEL_LIST.format(unread=unread_count(session, "s.ContextID"))
+    else:
+        query = CHANNEL_LIST_AGGREGATE.format(
+            unread=unread_count(session, "m.ContextID"), latest=LATEST_CHANNELS
+        )
+    return session.execute(text(query)).all()
+
+
+def parse_cursor(cursor, parts=2):
+    """
+    Return the ``(date, id)`` of a cursor as given by ``channel_feed``
+    (or the ``(date, context id, id)`` of one given by ``search``, with
+    `parts` 3), or None if it is missing. Raises ValueError if it is
+    malformed.
+    """
+    if not cursor:
+        return None
+    date, *ids = cursor.split(":")
+    if len(ids) != parts - 1:
+        raise ValueError("Invalid cursor {!r}".format(cursor))
+    return (float(date), *map(int, ids))
+
+
+def post_dict(row):
+    """Return a row of ``POSTS`` as a dict of ``POST_FIELDS``"""
+    return {
+        "id": row.ID,
+        "channel": row.ContextID,
+        "date": row.Date,
+        "text": row.Message,
+        "formatting": row.Formatting,
+        "views": row.ViewCount,
+        "media": (
+            {
+                "id": row.MediaID,
+                "type": row.MediaType,
+                "name": row.MediaName,
+                "mime_type": row.MediaMimeType,
+                "size": row.MediaSize,
+            }
+            if row.MediaID
+            else None
+        ),
+    }
+
+
+def channel_feed(session, channel_id, before=None, limit=FEED_PAGE_SIZE, after=None):
+    """
+    Return a page of the posts of a channel, newest first, older than the
+    ``(date, id)`` cursor `before` (all of them if None), as a dict with
+    the "posts" and the "next" cursor (None on the last page).
+
+    With a cursor `after` instead, return the posts newer than it, oldest
+    first, and as "next" the cursor of the newest post returned (`after`
+    itself if there are none), to sync from again later.
+    """
+    limit = max(1, min(limit, MAX_FEED_PAGE_SIZE))
+    if after is None:
+        date, message_id = before or (float("inf"), 0)
+        query = CHANNEL_FEED.format(side="<", order="DESC")
+    else:
+        date, message_id = after
+        query = CHANNEL_FEED.format(side=">", order="ASC")
+    rows = session.execute(
+        text(query),
+        {"id": channel_id, "date": date, "message_id": message_id, "limit": limit},
+    ).all()
+    if after is not None:
+        last = rows[-1] if rows else None
+        next_cursor = "{!r}:{}".format(*after)
+    else:
+        last = rows[-1] if len(rows) == limit else None
+        next_cursor = None
+    return {
+        "posts": [post_dict(row) for row in rows],
+        "next": "{!r}:{}".format(last.Date, last.ID) if last else next_cursor,
+    }
+
+
+def get_post(session, channel_id, post_id):
+    """Return a post of a channel (see ``post_dict``), or None"""
+    row = session.execute(text(POST), {"context": channel_id, "id": post_id}).first()
+    return post_dict(row) if row else None
+
+
+def search(session, query, channel_id=None, before=None, limit=FEED_PAGE_SIZE):
+    """
+    Return a page of the posts containing `query` (in a single channel if
+    given), newest first, older than the ``(date, context id, id)`` cursor
+    `before`, as a dict with the "posts" and the "next" cursor.
+
+    Searching every channel goes through the search index, so it needs a
+    query of at least MIN_INDEXED_QUERY characters and a database with the
+    index; otherwise it raises ValueError. Without the index, searching a
+    channel reads all of its messages.
+    """
+    limit = max(1, min(limit, MAX_FEED_PAGE_SIZE))
+    date, context_id, message_id = before or (float("inf"), 0, 0)
+    pattern = "%{}%".format(
+        query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    )
+    indexed = len(query) >= MIN_INDEXED_QUERY and has_search_index(session)
+    if not indexed and channel_id is None:
+        raise ValueError(
+            "Search for at least {} characters, or in a single channel".format(
+                MIN_INDEXED_QUERY
+            )
+        )
+    channel = "\n  AND m.ContextID = :channel" if channel_id is not None else ""
+    rows = session.execute(
+        text(SEARCH.format(channel=channel, match=SEARCH_MATCH if indexed else "")),
+        {
+            "pattern": pattern,
+            # A single FTS5 string, matched as a substring by trigrams
+            "match": '"{}"'.format(query.replace('"', '""')),
+            "channel": channel_id,
+            "date": date,
+            "context": context_id,
+            "message_id": message_id,
+            "limit": limit,
+        },
+    ).all()
+    last = rows[-1] if len(rows) == limit else None
+    return {
+        "posts": [post_dict(row) for row in rows],
+        "next": (
+            "{!r}:{}:{}".format(last.Date, last.ContextID, last.ID) if last else None
+        ),
+    }
@@ -0,0 +1,160 @@
+"""
+What has been read in every channel. This is kept in its own small database,
+attached as "state" to the connections of the app, so that the export
+database is only ever read.
+
+The read state of a channel is a watermark, the (Date, ID) of the last
+message read, plus sparse exceptions: messages after the watermark that
+were read one by one, and messages before it marked unread again. Marking
+a channel read up to a message moves the watermark and drops the
+exceptions it covers, so it does not depend on the size of the channel.
+"""
+import os
+
+from sqlalchemy import event, text
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS state.ReadState("
+    "ContextID INT NOT NULL,"
+    "Date INT NOT NULL,"
+    "ID INT NOT NULL,"
+    "PRIMARY KEY (ContextID))",
+    "CREATE TABLE IF NOT EXISTS state.ReadException("
+    "ContextID INT NOT NULL,"
+    "Date INT NOT NULL,"
+    "ID INT NOT NULL,"
+    "Read INT NOT NULL,"
+    "PRIMARY KEY (ContextID, Date, ID))",
+    # A single row, bumped on every change (see ``bump_version``)
+    "CREATE TABLE IF NOT EXISTS state.StateVersion(Version INT NOT NULL)",
+    "INSERT INTO state.StateVersion"
+    " SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM state.StateVersion)",
+)
+
+# The number of unread messages of the context {context}, given its
+# ReadState row as `r` (NULL if nothing was read) and {total}, its number
+# of messages. Messages after the watermark are counted over the
+# MessageContextDate index, then corrected by the exceptions.
+UNREAD_COUNT = """(
+    CASE WHEN r.ContextID IS NULL THEN {total}
+    ELSE (
+        SELECT COUNT(*) FROM Message
+        WHERE ContextID = {context} AND (Date, ID) > (r.Date, r.ID)
+    )
+    END + (
+        SELECT IFNULL(SUM(1 - 2 * Read), 0) FROM state.ReadException
+        WHERE ContextID = {context}
+    )
+)"""
+
+
+def get_state_filename(db_filename):
+    """Return the file where the read state of a database is kept"""
+    return "{}.state.db".format(os.path.splitext(db_filename)[0])
+
+
+def attach(engine, filename):
+    """Attach the read state in `filename` to every connection of `engine`"""
+
+    @event.listens_for(engine, "connect")
+    def attach_state(dbapi_connection, connection_record):
+        dbapi_connection.execute("ATTACH DATABASE ? AS state", (filename,))
+        for statement in SCHEMA:
+            dbapi_connection.execute(statement)
+        dbapi_connection.commit()
+
+
+def bump_version(session):
+    """Record that the read state changed, for caches built from it"""
+    session.execute(text("UPDATE state.StateVersion SET Version = Version + 1"))
+
+
+def get_watermark(session, context_id):
+    """Return the ``(date, id)`` a channel was read up to, or None"""
+    row = session.execute(
+        text("SELECT Date, ID FROM state.ReadState WHERE ContextID = :context"),
+        {"context": context_id},
+    ).first()
+    return tuple(row) if row else None
+
+
+def _get_position(session, context_id, message_id=None):
+    """The ``(date, id)`` of a message (the latest one if None), or None"""
+    if message_id is None:
+        row = session.execute(
+            text(
+                "SELECT Date, ID FROM Message WHERE ContextID = :context"
+                " ORDER BY Date DESC, ID DESC LIMIT 1"
+            ),
+            {"context": context_id},
+        ).first()
+    else:
+        row = session.execute(
+            text(
+                "SELECT Date, ID FROM Message"
+                " WHERE ContextID = :context AND ID = :id"
+            ),
+            {"context": context_id, "id": message_id},
+        ).first()
+    return tuple(row) if row else None
+
+
+def mark_read(session, context_id, message_id=None):
+    """
+    Mark a channel read up to the given message (its latest one if None),
+    and return its ``(date, id)``, or None if there is no such message.
+    The watermark never moves back.
+    """
+    position = _get_position(session, context_id, message_id)
+    if not position:
+        return None
+    params = {"context": context_id, "date": position[0], "id": position[1]}
+    session.execute(
+        text(
+            "INSERT INTO state.ReadState VALUES (:context, :date, :id)"
+            " ON CONFLICT (ContextID) DO UPDATE"
+            " SET Date = excluded.Date, ID = excluded.ID"
+            " WHERE (excluded.Date, excluded.ID) > (Date, ID)"
+        ),
+        params,
+    )
+    session.execute(
+        text(
+            "DELETE FROM state.ReadException"
+            " WHERE ContextID = :context AND (Date, ID) <= (:date, :id)"
+        ),
+        params,
+    )
+    bump_version(session)
+    return position
+
+
+def set_message_read(session, context_id, message_id, read=True):
+    """
+    Mark a single message read (or unread), and return its ``(date, id)``,
+    or None if there is no such message.
+    """
+    position = _get_position(session, context_id, message_id)
+    if not position:
+        return None
+    watermark = get_watermark(session, context_id)
+    params = {"context": context_id, "date": position[0], "id": position[1]}
+    after_watermark = watermark is None or position > watermark
+    if after_watermark == read:
+        session.execute(
+            text(
+                "INSERT OR REPLACE INTO state.ReadException"
+                " VALUES (:context, :date, :id, :read)"
+            ),
+            dict(params, read=int(read)),
+        )
+    else:
+        session.execute(
+            text(
+                "DELETE FROM state.ReadException"
+                " WHERE ContextID = :context AND Date = :date AND ID = :id"
+            ),
+            params,
+        )
+    bump_version(session)
+    return position
@@ -0,0 +1,354 @@
+import io
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app import create_app, db
+from benchmarks.synthetic import make_database
+from export.dumper import Dumper
+from models import derivatives
+
+tmp = None
+app = None
+archive = None
+config = None
+db_path = None
+context_id = None
+
+
+def setUpModule():
+    global tmp, app, archive, config, db_path, context_id
+    tmp = tempfile.TemporaryDirectory()
+    dumper = make_database(tmp.name, channels=2, messages=30, media_ratio=0.5)
+    dumper.conn.close()
+    config = dumper.config
+    db_path = dumper.db_path
+    conn = sqlite3.connect(dumper.db_path)
+    context_id = conn.execute("SELECT MIN(ContextID) FROM Message").fetchone()[0]
+    conn.execute("UPDATE Media SET MimeType = 'video/mp4' WHERE ID = 2")
+    conn.commit()
+    conn.close()
+
+    media = os.path.join(tmp.name, "usermedia", "Channel 0-1")
+    os.makedirs(media)
+    with open(os.path.join(media, "photo-photo_2020-01-01.1.jpg"), "wb") as file:
+        file.write(bytes(range(256)) * 4)
+    with open(os.path.join(media, "photo-photo_2020-01-01.1.thumb.jpg"), "wb") as file:
+        file.write(b"thumb")
+    with open(os.path.join(media, "video-clip.2.mp4"), "wb") as file:
+        file.write(b"video")
+    with open(os.path.join(tmp.name, "secret.3.txt"), "wb") as file:
+        file.write(b"outside of usermedia")
+    if derivatives.Image:
+        image = derivatives.Image.new("RGB", (2000, 1000), "teal")
+        image.save(os.path.join(media, "photo-big.5.jpg"))
+    os.symlink(
+        os.path.join(tmp.name, "secret.3.txt"), os.path.join(media, "link.3.txt")
+    )
+
+    for name in ("TG_TO_ORG_MEDIA", "TG_TO_ORG_STATE_DB", "TG_TO_ORG_DERIVATIVES"):
+        os.environ.pop(name, None)
+    app = create_app(dumper.db_path)
+    archive = app.extensions["archive"]
+
+
+def tearDownModule():
+    tmp.cleanup()
+
+
+class TestMedia(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_serve(self):
+        response = self.client.get("/media/1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/jpeg")
+        self.assertEqual(len(response.data), 1024)
+        self.assertTrue(response.headers["ETag"])
+        self.assertTrue(response.headers["Last-Modified"])
+
+        response = self.client.get("/media/2")
+        self.assertEqual(response.mimetype, "video/mp4")
+        self.assertEqual(self.client.get("/media/1?thumbnail=1").data, b"thumb")
+        # Without a thumbnail, the file itself is served
+        self.assertEqual(self.client.get("/media/2?thumbnail=1").data, b"video")
+
+    def test_range(self):
+        response = self.client.get("/media/1", headers={"Range": "bytes=256-511"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, bytes(range(256)))
+        self.assertEqual(response.headers["Content-Range"], "bytes 256-511/1024")
+
+    def test_conditional(self):
+        etag = self.client.get("/media/1").headers["ETag"]
+        response = self.client.get("/media/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_not_found(self):
+        # Unknown media, media that was not downloaded, files outside the root
+        self.assertEqual(self.client.get("/media/1000000").status_code, 404)
+        self.assertEqual(self.client.get("/media/4").status_code, 404)
+        self.assertEqual(self.client.get("/media/3").status_code, 404)
+        self.assertEqual(self.client.get("/mp4/../app.py").status_code, 404)
+
+
+class TestPages(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_pages(self):
+        for path in ("/", "/channels", "/channel/{}".format(context_id)):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200, path)
+            self.assertNotIn(b"Something is broken", response.data, path)
+        page = self.client.get("/channel/{}".format(context_id)).data
+        self.assertIn(b"/media/", page)
+
+
+class TestPageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.cache = archive.page_cache
+        self.cache.clear()
+
+    def test_repeated_loads(self):
+        for path in ("/", "/channels", "/channel/{}".format(context_id)):
+            first = self.client.get(path).data
+            self.assertEqual(self.client.get(path).data, first, path)
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 3))
+
+    def test_dumper_commit(self):
+        path = "/channel/{}".format(context_id)
+        self.client.get(path)
+        dumper = Dumper(config)
+        dumper._insert(
+            "Message",
+            (1000, context_id, 2 * 10**9, None, "Fresh post") + (None,) * 7,
+        )
+        dumper.commit()
+        dumper.conn.close()
+        self.assertIn(b"Fresh post", self.client.get(path).data)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_mark_read(self):
+        self.client.get("/channels")
+        self.client.post("/api/channel/{}/read".format(context_id))
+        self.assertIn(b"0 unread", self.client.get("/channels").data)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_mark_read_next(self):
+        path = "/api/channel/{}/read".format(context_id)
+        response = self.client.post(path, data={"next": "/channels?page=2"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.location, "/channels?page=2")
+        for url in (
+            "//example.com",
+            "/\\example.com",
+            "/\t/example.com",
+            "https://example.com/",
+            "channels",
+        ):
+            response = self.client.post(path, data={"next": url})
+            self.assertEqual(response.status_code, 200, url)
+
+
+class TestApi(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_channels(self):
+        response = self.client.get("/api/v1/channels?fields=id,title")
+        self.assertEqual(response.status_code, 200)
+        channels = response.get_json()["channels"]
+        self.assertEqual(len(channels), 2)
+        self.assertEqual(set(channels[0]), {"id", "title"})
+        self.assertNotIn(b'": ', response.data)
+        response = self.client.get("/api/v1/channels/{}".format(context_id))
+        self.assertEqual(response.get_json()["id"], context_id)
+        self.assertEqual(self.client.get("/api/v1/channels/1").status_code, 404)
+
+    def test_conditional(self):
+        path = "/api/v1/channels/{}/posts?limit=5".format(context_id)
+        response = self.client.get(path)
+        etag = response.headers["ETag"]
+        response = self.client.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.data)
+
+    def test_sync(self):
+        path = "/api/v1/channels/{}/posts".format(context_id)
+        newest = self.client.get(path + "?limit=10&fields=id").get_json()
+        self.assertEqual(list(newest["posts"][0]), ["id"])
+        older = self.client.get(path + "?limit=10&before=" + newest["next"])
+        self.assertEqual(len(older.get_json()["posts"]), 10)
+        # Syncing from the oldest post of the first page gets the rest of it
+        oldest, latest = (
+            self.client.get("{}/{}".format(path, post["id"])).get_json()
+            for post in (newest["posts"][-1], newest["posts"][0])
+        )
+        cursor = "{!r}:{}".format(oldest["date"], oldest["id"])
+        newer = self.client.get(path + "?fields=id&after=" + cursor).get_json()
+        self.assertEqual(newer["posts"][::-1], newest["posts"][:-1])
+        self.assertEqual(newer["next"], "{!r}:{}".format(latest["date"], latest["id"]))
+
+    def test_media(self):
+        media = self.client.get("/api/v1/media/1").get_json()
+        self.assertEqual(media["url"], "/media/1")
+        self.assertEqual(self.client.get("/api/v1/media/1000000").status_code, 404)
+
+    def test_search(self):
+        page = self.client.get("/api/v1/search?q=Lore&limit=3").get_json()
+        self.assertEqual(len(page["posts"]), 3)
+        self.assertTrue(all("lore" in post["text"] for post in page["posts"]))
+        following = self.client.get(
+            "/api/v1/search?q=Lore&limit=3&before=" + page["next"]
+        ).get_json()
+        seen = {(p["channel"], p["id"]) for p in page["posts"]}
+        self.assertFalse(seen & {(p["channel"], p["id"]) for p in following["posts"]})
+        page = self.client.get("/api/v1/search?q=%25%25%25").get_json()
+        self.assertEqual(page["posts"], [])
+        # Too short for the index, but fine in a single channel
+        page = self.client.get(
+            "/api/v1/search?q=a&limit=3&channel={}".format(context_id)
+        ).get_json()
+        self.assertEqual(len(page["posts"]), 3)
+
+    def test_bad_requests(self):
+        for path in (
+            "/api/v1/search",
+            "/api/v1/search?q=lorem&before=1:2",
+            "/api/v1/search?q=a",
+            "/api/v1/channels?fields=id,secret",
+            "/api/v1/channels/{}/posts?before=x".format(context_id),
+        ):
+            self.assertEqual(self.client.get(path).status_code, 400, path)
+
+
+class TestLiveFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.live_feed = archive.live_feed
+        self.live_feed.interval = 0.01
+
+    def dump(self, context, message_id, text):
+        dumper = Dumper(config)
+        dumper._insert(
+            "Message",
+            (message_id, context, 3 * 10**9, None, text) + (None,) * 7,
+        )
+        dumper.commit()
+        dumper.conn.close()
+
+    def test_new_posts(self):
+        conn = sqlite3.connect(db_path)
+        other = conn.execute("SELECT MAX(ContextID) FROM Message").fetchone()[0]
+        conn.close()
+        with (
+            self.live_feed.subscribe([context_id]) as first,
+            self.live_feed.subscribe() as every,
+        ):
+            time.sleep(0.1)  # let the poller start tailing
+            self.dump(context_id, 2000, "Live post")
+            self.dump(other, 2001, "Other channel")
+            event = first.get(timeout=5)
+            self.assertEqual((event["channel"], event["id"]), (context_id, 2000))
+            self.assertIn("Live post", event["html"])
+            self.assertIn('data-id="2000"', event["html"])
+            self.assertEqual(every.get(timeout=5)["id"], 2000)
+            self.assertEqual(every.get(timeout=5)["id"], 2001)
+            self.assertIsNone(first.get(timeout=0.1))
+        # The poller stops once nobody is subscribed
+        time.sleep(0.1)
+        self.assertIsNone(self.live_feed._thread)
+
+    def test_redumped_posts(self):
+        self.dump(context_id, 2000, "Live post")
+        with self.live_feed.subscribe([context_id]) as subscription:
+            time.sleep(0.1)  # let the poller start tailing
+            # Dumping a post again replaces its row, but it is not new
+            self.dump(context_id, 2000, "Live post")
+            self.dump(context_id, 2003, "Next post")
+            self.assertEqual(subscription.get(timeout=5)["id"], 2003)
+            self.assertIsNone(subscription.get(timeout=0.1))
+
+    def test_stream(self):
+        client = app.test_client()
+        response = client.get(
+            "/api/live?channel={}".format(context_id), buffered=False
+        )
+        self.assertEqual(response.mimetype, "text/event-stream")
+        chunks = iter(response.response)
+        self.assertEqual(next(chunks), b"retry: 5000\n\n")
+        time.sleep(0.1)
+        self.dump(context_id, 2010, "Streamed")
+        chunk = next(chunks)
+        self.assertTrue(chunk.startswith(b"event: post\ndata: {"))
+        self.assertIn(b'"id":2010', chunk)
+        response.close()
+
+
+class TestDerivatives(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_not_resized(self):
+        # Not an image (or no Pillow to resize it): the media itself
+        response = self.client.get("/media/1/640.jpeg")
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith("/media/1"))
+        self.assertEqual(self.client.get("/media/1/500.jpeg").status_code, 404)
+        self.assertEqual(self.client.get("/media/1/640.gif").status_code, 404)
+
+    def test_page(self):
+        page = self.client.get("/channel/{}".format(context_id)).data
+        self.assertRegex(page, rb"/media/\d+/320\.webp 320w")
+
+    @unittest.skipUnless(derivatives.Image, "Pillow is not installed")
+    def test_resize(self):
+        response = self.client.get("/media/5/640.webp")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/webp")
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, 365 * 24 * 3600)
+        with derivatives.Image.open(io.BytesIO(response.data)) as image:
+            self.assertEqual(image.size, (640, 320))
+
+        result = app.test_cli_runner().invoke(args=["derivatives", "--workers", "2"])
+        self.assertIn("1 of", result.output)
+        self.assertTrue(os.path.isfile(archive.derivatives.path(5, 320, "jpeg")))
+
+    @unittest.skipIf(derivatives.Image, "Pillow is installed")
+    def test_batch_needs_pillow(self):
+        result = app.test_cli_runner().invoke(args=["derivatives"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("Pillow", result.output)
+
+
+class TestReadOnly(unittest.TestCase):
+
+    def test_read_only(self):
+        with app.app_context():
+            with self.assertRaises(OperationalError):
+                db.session.execute(text("DELETE FROM Message"))
+            db.session.rollback()
+            # The read state is written through its own engine
+            response = app.test_client().post(
+                "/api/channel/{}/read".format(context_id)
+            )
+            self.assertEqual(response.status_code, 200)
+
+    def test_journal_mode(self):
+        conn = sqlite3.connect(db_path)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        conn.close()
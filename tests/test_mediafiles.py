@@ -0,0 +1,100 @@
+import datetime
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from export.utils import get_media_filename
+from models import mediafiles
+from models.mediafiles import MediaFiles, parse_filename
+
+DATE = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class TestParseFilename(unittest.TestCase):
+
+    def filename(self, media_id, name=None, mime_type=None, thumbnail=False):
+        return get_media_filename(
+            "usermedia/{name}-{context_id}/{type}-{filename}",
+            media_id,
+            "document",
+            name,
+            mime_type,
+            DATE,
+            -1001000000000,
+            context_name="Channel 1.5",
+            thumbnail=thumbnail,
+        )
+
+    def test_downloaded_names(self):
+        for name, mime_type in (
+            ("report.pdf", None),
+            ("name.12.57", None),
+            ("x.5", None),
+            ("v1.2.3", None),
+            ("archive.tar.gz", None),
+            ("no extension", "image/jpeg"),
+            (None, "application/x-unknown"),
+            ("trailing.", None),
+        ):
+            for thumbnail in (False, True):
+                filename = self.filename(42, name, mime_type, thumbnail)
+                self.assertEqual(
+                    parse_filename(filename.split("/")[-1]),
+                    (42, thumbnail),
+                    filename,
+                )
+
+    def test_other_names(self):
+        for filename in ("x.5", "notes.txt", "photo.shard0-12.jpg", "42", ".42"):
+            self.assertIsNone(parse_filename(filename), filename)
+
+
+class TestMediaFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.media_files = MediaFiles(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def touch(self, filename):
+        path = os.path.join(self.tmp.name, filename)
+        open(path, "w").close()
+        return os.path.realpath(path)
+
+    def test_rescan_in_background(self):
+        first = self.touch("photo.1.jpg")
+        self.assertEqual(self.media_files.get(1), first)
+        second = self.touch("photo.2.jpg")
+
+        walked = threading.Event()
+        walks = []
+        release = threading.Event()
+        walk = os.walk
+
+        def slow_walk(top):
+            walks.append(top)
+            walked.set()
+            release.wait(5)
+            return walk(top)
+
+        with (
+            mock.patch.object(mediafiles, "RESCAN_INTERVAL", -1),
+            mock.patch.object(mediafiles.os, "walk", slow_walk),
+        ):
+            # The miss does not wait for the scan, nor does a second one
+            # start another
+            self.assertIsNone(self.media_files.get(2))
+            self.assertTrue(walked.wait(5))
+            self.assertIsNone(self.media_files.get(3))
+            self.assertEqual(self.media_files.get(1), first)
+            release.set()
+            deadline = time.monotonic() + 5
+            while self.media_files._scanning and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(len(walks), 1)
+        self.assertEqual(self.media_files.get(2), second)
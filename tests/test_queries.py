@@ -0,0 +1,321 @@
+import sqlite3
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from benchmarks.synthetic import make_database
+from export.dumper import Dumper
+from models import queries, readstate
+
+
+def connect(db):
+    """An engine and session on `db`, with its read state attached"""
+    engine = create_engine("sqlite:///" + db)
+    readstate.attach(engine, readstate.get_state_filename(db))
+    return engine, Session(engine)
+
+
+class TestHomePage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        dumper = make_database(
+            self.tmp.name, channels=5, messages=50, empty_ratio=0.3, snapshots=2
+        )
+        dumper.conn.close()
+        self.db = dumper.db_path
+        self.engine, self.session = connect(self.db)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmp.cleanup()
+
+    def expected(self, per_channel):
+        """The home page as built before, with a query per channel"""
+        conn = sqlite3.connect(self.db)
+        channels = conn.execute("SELECT DISTINCT ID FROM Channel ORDER BY ID")
+        expected = {}
+        for (channel_id,) in channels.fetchall():
+            expected[channel_id] = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT ID FROM Message WHERE ContextID = ? AND Message != ''"
+                    " ORDER BY Date DESC, ID DESC LIMIT ?",
+                    (channel_id, per_channel),
+                )
+            ]
+        conn.close()
+        return expected
+
+    def test_home_page(self):
+        channels = queries.home_page(self.session)
+        self.assertEqual(
+            {c["id"]: [post.ID for post in c["posts"]] for c in channels},
+            self.expected(queries.POSTS_PER_CHANNEL),
+        )
+        for channel in channels:
+            self.assertNotIn("(old)", channel["title"])
+            self.assertTrue(all(post.Message for post in channel["posts"]))
+
+    def test_get_channel(self):
+        channel_id = queries.home_page(self.session, per_channel=1)[0]["id"]
+        channel = queries.get_channel(self.session, channel_id)
+        self.assertEqual(channel.ID, channel_id)
+        self.assertNotIn("(old)", channel.Title)
+        self.assertIsNone(queries.get_channel(self.session, 1))
+
+
+class TestChannelList(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dumper = make_database(self.tmp.name, channels=4, messages=30)
+        self.engine, self.session = connect(self.dumper.db_path)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.dumper.conn.close()
+        self.tmp.cleanup()
+
+    def aggregate(self):
+        query = queries.CHANNEL_LIST_AGGREGATE.format(
+            unread=queries.unread_count(self.session, "m.ContextID"),
+            latest=queries.LATEST_CHANNELS,
+        )
+        return [tuple(row) for row in self.session.execute(text(query)).all()]
+
+    def channel_list(self):
+        self.session.rollback()  # see what the Dumper committed since
+        return [tuple(row) for row in queries.channel_list(self.session)]
+
+    def test_summary_matches_aggregate(self):
+        self.assertEqual(len(self.channel_list()), 4)
+        self.assertEqual(self.channel_list(), self.aggregate())
+
+    def test_dumper_updates_summary(self):
+        context_id, title, count, last_date, unread = self.channel_list()[-1]
+        self.dumper._insert(
+            "Message",
+            (1000, context_id, last_date + 10**6, None, "new") + (None,) * 7,
+        )
+        self.dumper._insert(
+            "Channel", (context_id, last_date, None, "Renamed", None, None, None)
+        )
+        self.dumper.commit()
+        self.assertEqual(
+            self.channel_list()[0],
+            (context_id, "Renamed", count + 1, last_date + 10**6, unread + 1),
+        )
+        self.assertEqual(self.channel_list(), self.aggregate())
+
+    def test_replaced_messages_counted_once(self):
+        context_id, title, count, last_date, unread = self.channel_list()[-1]
+        message_id = self.dumper.conn.execute(
+            "SELECT MAX(ID) FROM Message WHERE ContextID = ?", (context_id,)
+        ).fetchone()[0]
+        for message in (
+            (message_id, context_id, last_date, None, "edited"),
+            (1000, context_id, last_date + 1, None, "new"),
+            (1000, context_id, last_date + 1, None, "new, edited"),
+        ):
+            self.dumper._insert("Message", message + (None,) * 7)
+        self.dumper.commit()
+        self.assertEqual(
+            self.channel_list()[0][:4], (context_id, title, count + 1, last_date + 1)
+        )
+        self.assertEqual(self.channel_list(), self.aggregate())
+
+    def test_data_version(self):
+        (first, _, _, last_date, _), (other, *_) = self.channel_list()[-2:]
+        before = queries.data_version(self.session), queries.data_version(
+            self.session, other
+        )
+        self.dumper._insert(
+            "Message", (1000, first, last_date + 1, None, "new") + (None,) * 7
+        )
+        self.dumper.commit()
+        self.session.rollback()
+        self.assertNotEqual(queries.data_version(self.session), before[0])
+        self.assertEqual(queries.data_version(self.session, other), before[1])
+        readstate.mark_read(self.session, other)
+        self.assertNotEqual(queries.data_version(self.session, other), before[1])
+
+    def test_backfill(self):
+        expected = self.channel_list()
+        self.dumper.conn.execute("DROP TABLE ContextSummary")
+        self.dumper.conn.commit()
+        self.session.rollback()
+        self.assertEqual(self.channel_list(), expected)
+        self.dumper.conn.close()
+        self.dumper = Dumper(self.dumper.config)
+        self.assertEqual(self.channel_list(), expected)
+
+
+class TestChannelFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        dumper = make_database(
+            self.tmp.name, channels=2, messages=120, empty_ratio=0.2, media_ratio=0.3
+        )
+        dumper.conn.close()
+        self.db = dumper.db_path
+        self.dumper_config = dumper.config
+        self.engine, self.session = connect(self.db)
+        self.channel_id = queries.channel_list(self.session)[0].ContextID
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmp.cleanup()
+
+    def test_pages(self):
+        conn = sqlite3.connect(self.db)
+        expected = [
+            row[0]
+            for row in conn.execute(
+                "SELECT ID FROM Message WHERE ContextID = ?"
+                " AND ServiceAction IS NULL AND (Message != '' OR MediaID IS NOT NULL)"
+                " ORDER BY Date DESC, ID DESC",
+                (self.channel_id,),
+            )
+        ]
+        media_ids = dict(
+            conn.execute(
+                "SELECT ID, MediaID FROM Message WHERE ContextID = ?",
+                (self.channel_id,),
+            )
+        )
+        conn.close()
+
+        seen = []
+        cursor = None
+        while True:
+            page = queries.channel_feed(
+                self.session, self.channel_id, queries.parse_cursor(cursor), limit=25
+            )
+            self.assertLessEqual(len(page["posts"]), 25)
+            for post in page["posts"]:
+                seen.append(post["id"])
+                media = post["media"]
+                self.assertEqual(media and media["id"], media_ids[post["id"]])
+                if media:
+                    self.assertEqual(media["type"], "photo")
+            cursor = page["next"]
+            if not cursor:
+                break
+        self.assertEqual(seen, expected)
+
+    def search(self, query, channel_id=None):
+        page = queries.search(self.session, query, channel_id, limit=1000)
+        return [(post["channel"], post["id"]) for post in page["posts"]]
+
+    def test_search_index(self):
+        # The index finds the same posts as reading them all would
+        indexed = self.search("Ore", self.channel_id)
+        self.assertTrue(indexed)
+        queries.MIN_INDEXED_QUERY = 100
+        try:
+            self.assertEqual(self.search("Ore", self.channel_id), indexed)
+            with self.assertRaises(ValueError):
+                self.search("Ore")
+        finally:
+            queries.MIN_INDEXED_QUERY = 3
+
+        dumper = Dumper(self.dumper_config)
+        message_id = indexed[0][1]
+        dumper._insert(
+            "Message",
+            (message_id, self.channel_id, 1, None, "Replaced zyxw") + (None,) * 7,
+        )
+        dumper.commit()
+        dumper.conn.execute(
+            "UPDATE Message SET Message = 'Updated wxyz'"
+            " WHERE ContextID = ? AND ID = ?",
+            indexed[1],
+        )
+        dumper.conn.execute(
+            "DELETE FROM Message WHERE ContextID = ? AND ID = ?", indexed[2]
+        )
+        dumper.conn.commit()
+        dumper.conn.close()
+        self.session.rollback()
+        self.assertEqual(self.search("ZYX"), [(self.channel_id, message_id)])
+        self.assertEqual(self.search("XYZ"), [indexed[1]])
+        self.assertEqual(self.search("Ore", self.channel_id), indexed[3:])
+
+    def test_parse_cursor(self):
+        self.assertIsNone(queries.parse_cursor(None))
+        self.assertEqual(queries.parse_cursor("1577836800.5:12"), (1577836800.5, 12))
+        with self.assertRaises(ValueError):
+            queries.parse_cursor("12")
+
+
+class TestReadState(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        dumper = make_database(self.tmp.name, channels=3, messages=40)
+        dumper.conn.close()
+        self.db = dumper.db_path
+        self.engine, self.session = connect(self.db)
+        conn = sqlite3.connect(self.db)
+        self.context_id = conn.execute(
+            "SELECT MIN(ContextID) FROM Message"
+        ).fetchone()[0]
+        self.ids = [
+            row[0]
+            for row in conn.execute(
+                "SELECT ID FROM Message WHERE ContextID = ? ORDER BY Date, ID",
+                (self.context_id,),
+            )
+        ]
+        conn.close()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmp.cleanup()
+
+    def unread(self):
+        return {row.ContextID: row.Unread for row in queries.channel_list(self.session)}
+
+    def test_watermark(self):
+        self.assertEqual(self.unread()[self.context_id], 40)
+        readstate.mark_read(self.session, self.context_id, self.ids[9])
+        self.assertEqual(self.unread()[self.context_id], 30)
+        # The watermark never moves back
+        readstate.mark_read(self.session, self.context_id, self.ids[4])
+        self.assertEqual(self.unread()[self.context_id], 30)
+        readstate.mark_read(self.session, self.context_id)
+        self.assertEqual(self.unread()[self.context_id], 0)
+        self.assertIsNone(readstate.mark_read(self.session, self.context_id, 10**6))
+
+    def test_exceptions(self):
+        readstate.mark_read(self.session, self.context_id, self.ids[9])
+        readstate.set_message_read(self.session, self.context_id, self.ids[20])
+        readstate.set_message_read(self.session, self.context_id, self.ids[21])
+        readstate.set_message_read(self.session, self.context_id, self.ids[3], False)
+        self.assertEqual(self.unread()[self.context_id], 29)
+        readstate.set_message_read(self.session, self.context_id, self.ids[21], False)
+        readstate.set_message_read(self.session, self.context_id, self.ids[3])
+        self.assertEqual(self.unread()[self.context_id], 29)
+        # Reading up to a message drops the exceptions before it
+        readstate.mark_read(self.session, self.context_id, self.ids[25])
+        self.assertEqual(self.unread()[self.context_id], 14)
+        exceptions = self.session.execute(
+            text("SELECT COUNT(*) FROM state.ReadException")
+        ).scalar()
+        self.assertEqual(exceptions, 0)
+
+    def test_home_page_order(self):
+        readstate.mark_read(self.session, self.context_id)
+        channels = queries.home_page(self.session)
+        self.assertEqual([c["unread"] for c in channels], [40, 40, 0])
+        self.assertEqual(channels[-1]["id"], self.context_id)
+        channels = queries.home_page(self.session, order="latest")
+        self.assertEqual(channels[-1]["id"], self.context_id)
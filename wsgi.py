@@ -0,0 +1,21 @@
+"""
+The entry point to serve the app in production, with several worker
+processes, e.g. with gunicorn (the "serve" extra):
+
+    TG_TO_ORG_DB=/path/to/export.db gunicorn -w 4 -k gthread --threads 8 wsgi:app
+
+Each worker reads the export database through its own pool of read-only
+connections (see models/database.py), so they neither wait for each other
+nor for the Dumper, which can keep exporting to the same database meanwhile.
+Live feeds (/api/live) hold a thread each for as long as the page is open,
+so give the workers enough threads. The configuration is read from the
+environment: TG_TO_ORG_DB, TG_TO_ORG_STATE_DB, TG_TO_ORG_MEDIA and
+TG_TO_ORG_DERIVATIVES.
+
+    python -m benchmarks.serving --workers 1 2 4
+
+load tests it with more and more workers while the Dumper writes.
+"""
+from app import create_app
+
+app = create_app()